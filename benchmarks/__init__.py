@@ -0,0 +1 @@
+"""Бенчмарки BabyCareBot (см. run_benchmarks.py)"""
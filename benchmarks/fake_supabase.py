@@ -0,0 +1,575 @@
+"""
+Хранилище таблиц в памяти, совместимое с той частью API supabase-py/PostgREST,
+которой пользуется бот: select/insert/upsert/update/delete, фильтры, order, limit,
+range, count='exact', rpc и триггеры схемы. У каждого вызова execute настраиваемая задержка,
+а счетчики запросов по таблицам и операциям показывают число обращений к БД
+"""
+
+import itertools
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional
+
+import timeutils
+
+# Колонки с индексом: фильтры eq/in_ по ним не просматривают всю таблицу
+INDEXED_COLUMNS = ('family_id', 'user_id', 'id')
+
+
+class FakeAPIError(Exception):
+    """Ошибка в формате postgrest.APIError (есть поле code)"""
+
+    def __init__(self, message: str, code: str):
+        super().__init__(message)
+        self.message = message
+        self.code = code
+
+
+class _Result:
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+
+@lru_cache(maxsize=2_000_000)
+def _parse_timestamp(value: str):
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return value
+
+
+def _cmp_value(value):
+    if isinstance(value, str):
+        return _parse_timestamp(value)
+    return value
+
+
+def _matches(row: Dict[str, Any], op: str, column: str, value) -> bool:
+    current = row.get(column)
+    if op == 'eq':
+        return current == value
+    if op == 'neq':
+        return current != value
+    if op == 'in':
+        return current in value
+    if op == 'is':
+        return current is value
+    if op == 'or':
+        return any(_matches(row, *condition) for condition in value)
+    if current is None:
+        return False
+    current, value = _cmp_value(current), _cmp_value(value)
+    if op == 'gt':
+        return current > value
+    if op == 'gte':
+        return current >= value
+    if op == 'lt':
+        return current < value
+    return current <= value
+
+
+class _Table:
+    """Строки таблицы и индексы по INDEXED_COLUMNS"""
+
+    def __init__(self):
+        self.rows: List[Dict[str, Any]] = []
+        self.indexes: Dict[str, Dict[Any, List[Dict[str, Any]]]] = {column: {} for column in INDEXED_COLUMNS}
+        self.version = 0
+        # Последний отсортированный результат select: страницы range читают его повторно
+        self.page_cache = None
+
+    def add(self, row: Dict[str, Any]):
+        self.rows.append(row)
+        for column, index in self.indexes.items():
+            if column in row:
+                index.setdefault(row[column], []).append(row)
+        self.changed()
+
+    def reindex(self):
+        for column in INDEXED_COLUMNS:
+            index = {}
+            for row in self.rows:
+                if column in row:
+                    index.setdefault(row[column], []).append(row)
+            self.indexes[column] = index
+        self.changed()
+
+    def rows_updated(self, payload: Dict[str, Any]):
+        """Строки изменены на месте; индексы пересобираются, только если менялись их колонки"""
+        if any(column in payload for column in INDEXED_COLUMNS):
+            self.reindex()
+        else:
+            self.changed()
+
+    def changed(self):
+        self.version += 1
+        self.page_cache = None
+
+
+class _Query:
+    def __init__(self, db: 'FakeSupabase', table: str):
+        self.db = db
+        self.table = table
+        self.op = 'select'
+        self.columns = '*'
+        self.payload = None
+        self.on_conflict = None
+        self.filters = []
+        self.orders = []
+        self.limit_n = None
+        self.offset = 0
+        self.count = None
+        self.head = False
+
+    # ---- построение запроса ----
+
+    def select(self, columns: str = '*', count: Optional[str] = None, head: bool = False):
+        self.columns, self.count, self.head = columns, count, head
+        return self
+
+    def insert(self, payload):
+        self.op, self.payload = 'insert', payload
+        return self
+
+    def upsert(self, payload, on_conflict: Optional[str] = None):
+        self.op, self.payload, self.on_conflict = 'upsert', payload, on_conflict
+        return self
+
+    def update(self, payload):
+        self.op, self.payload = 'update', payload
+        return self
+
+    def delete(self):
+        self.op = 'delete'
+        return self
+
+    def _filter(self, op, column, value):
+        self.filters.append((op, column, value))
+        return self
+
+    def eq(self, column, value):
+        return self._filter('eq', column, value)
+
+    def neq(self, column, value):
+        return self._filter('neq', column, value)
+
+    def gt(self, column, value):
+        return self._filter('gt', column, value)
+
+    def gte(self, column, value):
+        return self._filter('gte', column, value)
+
+    def lt(self, column, value):
+        return self._filter('lt', column, value)
+
+    def lte(self, column, value):
+        return self._filter('lte', column, value)
+
+    def in_(self, column, values):
+        return self._filter('in', column, frozenset(values))
+
+    def is_(self, column, value):
+        return self._filter('is', column, None if value in (None, 'null') else value)
+
+    def or_(self, filters: str):
+        """Условия PostgREST через запятую: 'колонка.оператор.значение'"""
+        conditions = []
+        for condition in filters.split(','):
+            column, op, value = condition.split('.', 2)
+            value = value.strip('"')
+            conditions.append((op, column, None if op == 'is' and value == 'null' else value))
+        return self._filter('or', None, tuple(conditions))
+
+    def order(self, column, desc: bool = False):
+        self.orders.append((column, desc))
+        return self
+
+    def limit(self, n: int):
+        self.limit_n = n
+        return self
+
+    def range(self, start: int, end: int):
+        self.offset, self.limit_n = start, end - start + 1
+        return self
+
+    # ---- выполнение ----
+
+    def _candidates(self, table: _Table) -> List[Dict[str, Any]]:
+        for op, column, value in self.filters:
+            if column in table.indexes and op == 'eq':
+                return table.indexes[column].get(value, [])
+            if column in table.indexes and op == 'in':
+                rows = []
+                for item in value:
+                    rows.extend(table.indexes[column].get(item, []))
+                return rows
+        return table.rows
+
+    def _matched(self, table: _Table) -> List[Dict[str, Any]]:
+        return [
+            row for row in self._candidates(table)
+            if all(_matches(row, op, column, value) for op, column, value in self.filters)
+        ]
+
+    def _project(self, row: Dict[str, Any]) -> Dict[str, Any]:
+        if self.columns.strip() == '*':
+            return dict(row)
+        return {column.strip(): row.get(column.strip()) for column in self.columns.split(',')}
+
+    def _payload_rows(self) -> List[Dict[str, Any]]:
+        return self.payload if isinstance(self.payload, list) else [self.payload]
+
+    def execute(self) -> _Result:
+        self.db.record_call(self.table, self.op)
+        with self.db.lock:
+            table = self.db.get_table(self.table)
+            if self.op == 'insert':
+                inserted = []
+                for item in self._payload_rows():
+                    row = dict(item)
+                    row.setdefault('id', next(self.db.ids))
+                    table.add(row)
+                    inserted.append(dict(row))
+                self.db.run_trigger(self.table, inserted, self._payload_rows()[0] if inserted else {})
+                return _Result(inserted)
+
+            if self.op == 'upsert':
+                keys = [key.strip() for key in (self.on_conflict or 'id').split(',')]
+                out = []
+                for item in self._payload_rows():
+                    lookup = _Query(self.db, self.table)
+                    lookup.filters = [('eq', key, item.get(key)) for key in keys]
+                    matched = lookup._matched(table)
+                    if matched:
+                        matched[0].update(item)
+                        table.rows_updated(item)
+                        out.append(dict(matched[0]))
+                    else:
+                        row = dict(item)
+                        table.add(row)
+                        out.append(dict(row))
+                self.db.run_trigger(self.table, out, self._payload_rows()[0] if out else {})
+                return _Result(out)
+
+            if self.op in ('update', 'delete'):
+                matched = self._matched(table)
+                if self.op == 'update':
+                    for row in matched:
+                        row.update(self.payload)
+                    if matched:
+                        table.rows_updated(self.payload)
+                else:
+                    removed = {id(row) for row in matched}
+                    if removed:
+                        table.rows = [row for row in table.rows if id(row) not in removed]
+                        table.reindex()
+                self.db.run_trigger(self.table, matched, self.payload or {})
+                return _Result([dict(row) for row in matched])
+
+            signature = (tuple(self.filters), tuple(self.orders), table.version)
+            if table.page_cache and table.page_cache[0] == signature:
+                matched = table.page_cache[1]
+            else:
+                matched = self._matched(table)
+                for column, desc in reversed(self.orders):
+                    present = [row for row in matched if row.get(column) is not None]
+                    missing = [row for row in matched if row.get(column) is None]
+                    present.sort(key=lambda row: _cmp_value(row[column]), reverse=desc)
+                    # Как в PostgreSQL: NULL в конце при ASC и в начале при DESC
+                    matched = missing + present if desc else present + missing
+                table.page_cache = (signature, matched)
+
+            total = len(matched)
+            if self.limit_n is not None:
+                matched = matched[self.offset:self.offset + self.limit_n]
+            data = [] if self.head else [self._project(row) for row in matched]
+            return _Result(data, total if self.count else None)
+
+
+class _Rpc:
+    def __init__(self, db: 'FakeSupabase', name: str, params: Optional[Dict[str, Any]]):
+        self.db, self.name, self.params = db, name, params or {}
+        self.orders: List[tuple] = []
+        self.offset = 0
+        self.limit_n: Optional[int] = None
+
+    # Сортировка и страницы для функций, возвращающих таблицу
+    def order(self, column, desc: bool = False):
+        self.orders.append((column, desc))
+        return self
+
+    def range(self, start: int, end: int):
+        self.offset, self.limit_n = start, end - start + 1
+        return self
+
+    def execute(self) -> _Result:
+        self.db.record_call('rpc:' + self.name, 'rpc')
+        function = self.db.functions.get(self.name)
+        if function is None:
+            raise FakeAPIError(f"Could not find the function public.{self.name}", 'PGRST202')
+        with self.db.lock:
+            data = function(self.db, **self.params)
+        if isinstance(data, list):
+            for column, desc in reversed(self.orders):
+                data.sort(key=lambda row: row[column], reverse=desc)
+            if self.limit_n is not None:
+                data = data[self.offset:self.offset + self.limit_n]
+        return _Result(data)
+
+
+# ---- SQL-функции из supabase_schema.sql ----
+
+def rpc_get_family_stats(db: 'FakeSupabase', p_family_id: int, p_since: str,
+                         p_timezone: str = 'Asia/Bangkok') -> Dict[str, Any]:
+    """Аналог функции get_family_stats (дни считаются в часовом поясе p_timezone)"""
+    since = _cmp_value(p_since)
+    tables = {'feeding': 'feedings', 'diaper': 'diapers', 'bath': 'baths', 'activity': 'activities'}
+    stats = {}
+    for event_type, table_name in tables.items():
+        times = [_cmp_value(row['timestamp']) for row in db.get_table(table_name).indexes['family_id'].get(p_family_id, [])]
+        window = sorted(t for t in times if t >= since)
+        zone = timeutils.get_zone(p_timezone)
+        per_day = Counter(t.astimezone(zone).date().isoformat() for t in window)
+        mean = (window[-1] - window[0]).total_seconds() / 60 / (len(window) - 1) if len(window) > 1 else None
+        stats[event_type] = {
+            'count': len(window),
+            'last_time': max(times).isoformat() if times else None,
+            'mean_interval_minutes': mean,
+            'per_day': dict(per_day),
+        }
+    return stats
+
+
+def rpc_get_latest_events(db: 'FakeSupabase', p_family_ids: Optional[List[int]] = None,
+                          p_tables: Optional[List[str]] = None, p_since: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Аналог функции get_latest_events"""
+    family_ids = p_family_ids if p_family_ids is not None else [row['id'] for row in db.get_table('families').rows]
+    since = _cmp_value(p_since) if p_since is not None else None
+    rows = []
+    for table_name in p_tables or ('feedings', 'diapers', 'baths', 'activities'):
+        index = db.get_table(table_name).indexes['family_id']
+        for family_id in family_ids:
+            times = [_cmp_value(row['timestamp']) for row in index.get(family_id, [])]
+            times = [moment for moment in times if since is None or moment >= since]
+            if times:
+                rows.append({'family_id': family_id, 'event_table': table_name, 'last_time': max(times).isoformat()})
+    return rows
+
+
+def rpc_get_event_counts(db: 'FakeSupabase', p_family_ids: List[int], p_since: str) -> List[Dict[str, Any]]:
+    """Аналог функции get_event_counts"""
+    since = _cmp_value(p_since)
+    rows = []
+    for table_name in ('feedings', 'diapers', 'baths', 'activities'):
+        index = db.get_table(table_name).indexes['family_id']
+        for family_id in p_family_ids:
+            count = sum(1 for row in index.get(family_id, []) if _cmp_value(row['timestamp']) >= since)
+            if count:
+                rows.append({'family_id': family_id, 'event_table': table_name, 'event_count': count})
+    return rows
+
+
+def _next_local_time(hour: int, minute: int, zone_name: Optional[str], after: datetime) -> str:
+    """Аналог функции next_local_time"""
+    zone = timeutils.get_zone(zone_name)
+    local_day = after.astimezone(zone).date()
+    moment = datetime(local_day.year, local_day.month, local_day.day, hour, minute, tzinfo=zone)
+    if moment <= after:
+        moment = (moment.replace(tzinfo=None) + timedelta(days=1)).replace(tzinfo=zone)
+    return moment.astimezone(timeutils.UTC).isoformat()
+
+
+# Вид ежедневного уведомления -> (колонка момента, включение, час, минута, значения по умолчанию)
+DIGEST_COLUMNS = {
+    'tips': ('next_tips_at', 'tips_enabled', 'tips_time_hour', 'tips_time_minute', 9, 0),
+    'bath': ('next_bath_at', 'bath_reminder_enabled', 'bath_reminder_hour', 'bath_reminder_minute', 19, 0),
+}
+
+
+def _coalesce(row: Dict[str, Any], column: str, default):
+    value = row.get(column)
+    return default if value is None else value
+
+
+def rpc_advance_digests(db: 'FakeSupabase', p_kind: str, p_family_ids: List[int]):
+    """Аналог функции advance_digests"""
+    column, _, hour_column, minute_column, default_hour, default_minute = DIGEST_COLUMNS[p_kind]
+    now = timeutils.utc_now()
+    settings = db.get_table('settings')
+    for family_id in p_family_ids:
+        for row in settings.indexes['family_id'].get(family_id, []):
+            if row.get(column) is None or _cmp_value(row[column]) > now:
+                continue
+            after = now
+            if p_kind == 'bath':
+                period = max(row.get('bath_reminder_period') or 1, 1)
+                after = max(now, _cmp_value(row[column]) + timedelta(days=period - 1))
+            row[column] = _next_local_time(_coalesce(row, hour_column, default_hour),
+                                           _coalesce(row, minute_column, default_minute), row.get('timezone'), after)
+    settings.changed()
+
+
+def rpc_acquire_lease(db: 'FakeSupabase', p_name: str, p_holder: str, p_ttl_seconds: int,
+                      p_preempt: bool = False) -> bool:
+    """Аналог функции acquire_lease"""
+    now = time.time()
+    table = db.get_table('worker_leases')
+    lease = next((row for row in table.rows if row['name'] == p_name), None)
+    if lease is None:
+        table.add({'name': p_name, 'holder': p_holder, 'expires_at': now + p_ttl_seconds})
+        return True
+    if lease['holder'] == p_holder or lease['expires_at'] < now or p_preempt:
+        lease.update(holder=p_holder, expires_at=now + p_ttl_seconds)
+        table.changed()
+        return True
+    return False
+
+
+def rpc_release_lease(db: 'FakeSupabase', p_name: str, p_holder: str):
+    """Аналог функции release_lease"""
+    table = db.get_table('worker_leases')
+    table.rows = [row for row in table.rows if not (row['name'] == p_name and row['holder'] == p_holder)]
+    table.reindex()
+
+
+DEFAULT_FUNCTIONS = {
+    'get_family_stats': rpc_get_family_stats,
+    'get_latest_events': rpc_get_latest_events,
+    'get_event_counts': rpc_get_event_counts,
+    'advance_digests': rpc_advance_digests,
+    'acquire_lease': rpc_acquire_lease,
+    'release_lease': rpc_release_lease,
+}
+
+
+# ---- Триггеры из supabase_schema.sql ----
+
+# Таблица событий -> (колонка срока в settings, колонка интервала)
+NEXT_DUE_COLUMNS = {
+    'feedings': ('next_feeding_due_at', 'feed_interval'),
+    'diapers': ('next_diaper_due_at', 'diaper_interval'),
+}
+
+
+def _next_due_at(db: 'FakeSupabase', event_table: str, family_id: int, interval) -> Optional[str]:
+    times = [_cmp_value(row['timestamp']) for row in db.get_table(event_table).indexes['family_id'].get(family_id, [])]
+    if not times or interval is None:
+        return None
+    return (max(times) + timedelta(hours=interval)).isoformat()
+
+
+def trigger_event_next_due(db: 'FakeSupabase', table_name: str, rows: List[Dict[str, Any]],
+                           payload: Dict[str, Any]):
+    """Аналог триггеров refresh_next_due_at на feedings и diapers"""
+    column, interval_column = NEXT_DUE_COLUMNS[table_name]
+    settings = db.get_table('settings')
+    for family_id in {row.get('family_id') for row in rows}:
+        for row in settings.indexes['family_id'].get(family_id, []):
+            row[column] = _next_due_at(db, table_name, family_id, row.get(interval_column))
+    settings.changed()
+
+
+def trigger_settings_next_due(db: 'FakeSupabase', table_name: str, rows: List[Dict[str, Any]],
+                              payload: Dict[str, Any]):
+    """Аналог триггера settings_next_due_at (при вставке и смене интервалов)"""
+    if 'feed_interval' not in payload and 'diaper_interval' not in payload:
+        return
+    settings = db.get_table(table_name)
+    for family_id in {row.get('family_id') for row in rows}:
+        for row in settings.indexes['family_id'].get(family_id, []):
+            for event_table, (column, interval_column) in NEXT_DUE_COLUMNS.items():
+                row[column] = _next_due_at(db, event_table, family_id, row.get(interval_column))
+    settings.changed()
+
+
+def trigger_settings_digest_at(db: 'FakeSupabase', table_name: str, rows: List[Dict[str, Any]],
+                               payload: Dict[str, Any]):
+    """Аналог триггера settings_digest_at (при вставке и смене времени, включения или часового пояса)"""
+    now = timeutils.utc_now()
+    for row in rows:
+        stored = db.get_table(table_name).indexes['family_id'].get(row.get('family_id'), [])
+        for target in stored:
+            for column, enabled, hour_column, minute_column, default_hour, default_minute in DIGEST_COLUMNS.values():
+                if target.get(column) is not None and not {enabled, hour_column, minute_column, 'timezone'} & payload.keys():
+                    continue
+                target[column] = _next_local_time(
+                    _coalesce(target, hour_column, default_hour), _coalesce(target, minute_column, default_minute),
+                    target.get('timezone'), now
+                ) if _coalesce(target, enabled, True) else None
+    db.get_table(table_name).changed()
+
+
+def trigger_settings(db: 'FakeSupabase', table_name: str, rows: List[Dict[str, Any]], payload: Dict[str, Any]):
+    """Триггеры таблицы settings"""
+    trigger_settings_next_due(db, table_name, rows, payload)
+    trigger_settings_digest_at(db, table_name, rows, payload)
+
+
+DEFAULT_TRIGGERS = {
+    'feedings': trigger_event_next_due,
+    'diapers': trigger_event_next_due,
+    'settings': trigger_settings,
+}
+
+
+class FakeSupabase:
+    """Замена клиента supabase для бенчмарков: supabase_client.set_client(FakeSupabase())"""
+
+    def __init__(self, latency: float = 0.0):
+        self.tables: Dict[str, _Table] = {}
+        self.functions: Dict[str, Callable[..., Any]] = dict(DEFAULT_FUNCTIONS)
+        self.triggers: Dict[str, Callable[..., None]] = dict(DEFAULT_TRIGGERS)
+        self.ids = itertools.count(1)
+        self.latency = latency
+        self.lock = threading.RLock()
+        self.calls: Counter = Counter()
+        self._calls_lock = threading.Lock()
+
+    def table(self, name: str) -> _Query:
+        return _Query(self, name)
+
+    def rpc(self, name: str, params: Optional[Dict[str, Any]] = None) -> _Rpc:
+        return _Rpc(self, name, params)
+
+    def get_table(self, name: str) -> _Table:
+        table = self.tables.get(name)
+        if table is None:
+            table = self.tables[name] = _Table()
+        return table
+
+    def rows(self, name: str) -> List[Dict[str, Any]]:
+        return self.get_table(name).rows
+
+    def bulk_insert(self, name: str, rows: List[Dict[str, Any]]):
+        """Заполнить таблицу без учета запросов и задержки"""
+        table = self.get_table(name)
+        for row in rows:
+            row.setdefault('id', next(self.ids))
+            table.rows.append(row)
+        table.reindex()
+        self.run_trigger(name, rows, rows[0] if rows else {})
+
+    def run_trigger(self, name: str, rows: List[Dict[str, Any]], payload: Dict[str, Any]):
+        """Выполнить триггер таблицы после изменения строк rows"""
+        trigger = self.triggers.get(name)
+        if trigger is not None and rows:
+            trigger(self, name, rows, payload)
+
+    def record_call(self, table: str, op: str):
+        with self._calls_lock:
+            self.calls[(table, op)] += 1
+        if self.latency:
+            # Задержка сети вне блокировки: параллельные запросы ждут одновременно
+            time.sleep(self.latency)
+
+    def total_calls(self) -> int:
+        with self._calls_lock:
+            return sum(self.calls.values())
+
+    def reset_calls(self):
+        with self._calls_lock:
+            self.calls.clear()
@@ -0,0 +1,123 @@
+"""
+Замена TelegramClient для бенчмарков
+Собирает обработчики, которые start_bot регистрирует через client.on, и вызывает
+их для синтетических сообщений и нажатий кнопок так же, как Telethon:
+все подходящие обработчики по порядку регистрации до StopPropagation.
+Отправленные сообщения только подсчитываются
+"""
+
+import asyncio
+import time
+from types import SimpleNamespace
+from typing import Any, Callable, List, Optional, Tuple
+
+from telethon import events
+
+
+class FakeEvent:
+    """Событие NewMessage или CallbackQuery с методами ответа"""
+
+    def __init__(self, client: 'FakeTelegramClient', sender_id: int,
+                 text: Optional[str] = None, data: Optional[bytes] = None):
+        self.client = client
+        self.sender_id = sender_id
+        self.chat_id = sender_id
+        self.text = text
+        self.raw_text = text
+        self.data = data
+        self.pattern_match = None
+
+    async def respond(self, message, buttons=None, **kwargs):
+        return await self.client.send_message(self.sender_id, message, buttons=buttons)
+
+    async def reply(self, message, buttons=None, **kwargs):
+        return await self.client.send_message(self.sender_id, message, buttons=buttons)
+
+    async def edit(self, message, buttons=None, **kwargs):
+        return await self.client.send_message(self.sender_id, message, buttons=buttons)
+
+    async def answer(self, message=None, **kwargs):
+        await self.client.api_call()
+
+
+class FakeTelegramClient:
+    """Клиент с задержкой на каждый вызов API; сообщения не отправляются"""
+
+    def __init__(self, *args, latency: float = 0.0, **kwargs):
+        self.latency = latency
+        self.handlers: List[Tuple[Any, Callable]] = []
+        self.sent_messages = 0
+        self.api_calls = 0
+        self.first_send_at: Optional[float] = None
+        self.last_send_at: Optional[float] = None
+        self._disconnected = asyncio.Event()
+        self.ready = asyncio.Event()
+
+    async def api_call(self):
+        self.api_calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def start(self, *args, **kwargs):
+        await self.api_call()
+        return self
+
+    async def get_me(self):
+        await self.api_call()
+        return SimpleNamespace(username='benchmark_bot', first_name='Benchmark')
+
+    async def send_message(self, entity, message, buttons=None, **kwargs):
+        await self.api_call()
+        now = time.perf_counter()
+        if self.first_send_at is None:
+            self.first_send_at = now
+        self.last_send_at = now
+        self.sent_messages += 1
+        return SimpleNamespace(id=self.sent_messages)
+
+    def on(self, builder):
+        # Как в Telethon: client.on(events.CallbackQuery) - класс без параметров
+        if isinstance(builder, type):
+            builder = builder()
+
+        def decorator(func):
+            self.handlers.append((builder, func))
+            return func
+        return decorator
+
+    async def run_until_disconnected(self):
+        # Обработчики зарегистрированы, бот "запущен"
+        self.ready.set()
+        await self._disconnected.wait()
+
+    def disconnect(self):
+        self._disconnected.set()
+
+    @staticmethod
+    def _builder_matches(builder, event: FakeEvent) -> bool:
+        if isinstance(builder, events.NewMessage):
+            if event.text is None:
+                return False
+            if builder.pattern is None:
+                return True
+            event.pattern_match = builder.pattern(event.text)
+            return bool(event.pattern_match)
+        if isinstance(builder, events.CallbackQuery):
+            return event.data is not None
+        return False
+
+    async def dispatch(self, event: FakeEvent):
+        """Вызвать обработчики события, как это делает Telethon"""
+        for builder, handler in self.handlers:
+            if not self._builder_matches(builder, event):
+                continue
+            try:
+                await handler(event)
+            except events.StopPropagation:
+                break
+
+    async def message(self, sender_id: int, text: str):
+        await self.dispatch(FakeEvent(self, sender_id, text=text))
+
+    async def callback(self, sender_id: int, data: bytes):
+        await self.dispatch(FakeEvent(self, sender_id, data=data))
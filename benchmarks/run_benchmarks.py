@@ -0,0 +1,365 @@
+"""
+Бенчмарк проверки напоминаний, доставки и обработчиков бота
+
+    python -m benchmarks.run_benchmarks --families 10 1000 50000
+
+Клиент Supabase в supabase_client.py заменяется хранилищем в памяти
+(benchmarks/fake_supabase.py) с задержкой на каждый запрос, а TelegramClient -
+фейковым клиентом. Для каждого числа семей запускается отдельный процесс,
+который заполняет базу историей кормлений и смен подгузников и измеряет:
+    • время полной проверки напоминаний и число запросов к БД на семью;
+    • что семьи без событий получают напоминание при полной проверке (должно быть 0 пропущенных);
+    • число запросов при проверке одной семьи по таймеру;
+    • скорость доставки напоминаний (сообщений в секунду);
+    • задержку обработчиков start_bot (p50/p99) и число запросов на действие,
+      а также самые дорогие запросы по данным query_tracing (в --json)
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import timedelta
+from typing import Any, Dict, List
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULT_MARKER = 'BENCHMARK_RESULT '
+
+# Действия пользователей для замера обработчиков: (вид, данные)
+HANDLER_ACTIONS = [
+    ('message', '/start'),
+    ('message', '🍼 Кормление'),
+    ('callback', b'feed_now'),
+    ('callback', b'diaper_now'),
+    ('message', '⚙️ Настройки'),
+    ('callback', b'back_to_settings'),
+    ('message', '💡 Советы'),
+]
+
+
+def _prepare_environment(workdir: str):
+    """Переменные окружения, без которых модули бота завершают работу при импорте"""
+    os.environ.setdefault('API_ID', '1')
+    os.environ.setdefault('API_HASH', 'benchmark')
+    os.environ.setdefault('BOT_TOKEN', 'benchmark')
+    os.environ['REMINDER_OUTBOX_PATH'] = os.path.join(workdir, 'reminder_outbox.db')
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+
+
+@contextlib.contextmanager
+def _quiet(enabled: bool = True):
+    """Скрыть журнал бота во время замеров"""
+    if not enabled:
+        yield
+        return
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def _event_series(now, interval_hours: float, history_hours: int, rng: random.Random):
+    """Моменты событий за history_hours с интервалом около interval_hours"""
+    # Последнее событие - в пределах полутора интервалов, чтобы часть семей была просрочена
+    moment = now - timedelta(hours=rng.uniform(0, interval_hours * 1.5))
+    start = now - timedelta(hours=history_hours)
+    while moment > start:
+        yield moment
+        moment -= timedelta(hours=interval_hours * rng.uniform(0.8, 1.2))
+
+
+def is_new_family(family_id: int) -> bool:
+    return family_id % 50 == 25
+
+
+def seed(fake, families: int, history_hours: int, rng: random.Random, now):
+    """Заполнить базу семьями с реалистичной историей событий"""
+    family_rows, member_rows, settings_rows, sleep_rows = [], [], [], []
+    events: Dict[str, List[Dict[str, Any]]] = {'feedings': [], 'diapers': [], 'baths': [], 'activities': []}
+    for family_id in range(1, families + 1):
+        feed_interval = rng.choice([2, 3, 3, 4])
+        diaper_interval = rng.choice([2, 2, 3])
+        family_rows.append({'id': family_id, 'name': f'Семья {family_id}'})
+        for offset, role in ((1, 'Мама'), (2, 'Папа')):
+            member_rows.append({'family_id': family_id, 'user_id': family_id * 10 + offset, 'role': role, 'name': role})
+        settings_rows.append({
+            'family_id': family_id, 'feed_interval': feed_interval, 'diaper_interval': diaper_interval,
+            'tips_enabled': True, 'tips_time_hour': 9, 'tips_time_minute': 0,
+            'bath_reminder_enabled': True, 'bath_reminder_hour': 19, 'bath_reminder_minute': 0,
+            'bath_reminder_period': 1, 'activity_reminder_enabled': True, 'activity_reminder_interval': 2,
+            'sleep_monitoring_enabled': True, 'baby_age_months': rng.randint(0, 12), 'baby_birth_date': None,
+        })
+        series = (('feedings', feed_interval), ('diapers', diaper_interval), ('baths', 24), ('activities', 8))
+        # Новые семьи еще ничего не записали: полная проверка должна напомнить им сразу
+        if is_new_family(family_id):
+            series = ()
+        for table, interval in series:
+            for moment in _event_series(now, interval, history_hours, rng):
+                row = {'family_id': family_id, 'author_id': family_id * 10 + 1, 'timestamp': moment.isoformat(),
+                       'author_role': 'Мама', 'author_name': 'Мама'}
+                if table == 'activities':
+                    row['activity_type'] = 'Игра'
+                events[table].append(row)
+        # Каждый десятый малыш спит: его напоминания откладываются до пробуждения
+        if family_id % 10 == 0:
+            sleep_rows.append({'family_id': family_id, 'author_id': family_id * 10 + 1, 'end_time': None,
+                               'start_time': (now - timedelta(minutes=family_id % 90)).isoformat()})
+
+    fake.bulk_insert('families', family_rows)
+    fake.bulk_insert('family_members', member_rows)
+    fake.bulk_insert('settings', settings_rows)
+    for table, rows in events.items():
+        fake.bulk_insert(table, rows)
+    fake.bulk_insert('sleep_sessions', sleep_rows)
+    fake.bulk_insert('notification_tracking', [])
+    fake.bulk_insert('tips', [
+        {'age_months': age, 'content': f'Совет {category} для {age} мес.', 'category': category}
+        for age in range(13) for category in ('Сон', 'Питание', 'Развитие')
+    ])
+    return sum(len(rows) for rows in events.values())
+
+
+class _NullScheduler:
+    """Планировщик, который не запускает фоновые задачи во время замера обработчиков"""
+
+    def start(self):
+        pass
+
+    def shutdown(self, *args, **kwargs):
+        pass
+
+
+def _split_calls(fake) -> Dict[str, int]:
+    reads = sum(count for (table, op), count in fake.calls.items() if op == 'select')
+    total = fake.total_calls()
+    return {'reads': reads, 'writes': total - reads, 'total': total}
+
+
+def run_single(args) -> Dict[str, Any]:
+    """Все замеры для одного числа семей (выполняется в отдельном процессе)"""
+    workdir = tempfile.mkdtemp(prefix='babybot-bench-')
+    _prepare_environment(workdir)
+    rng = random.Random(args.seed)
+
+    with _quiet(not args.verbose):
+        import query_tracing
+        import supabase_client
+        import timeutils
+        from benchmarks.fake_supabase import FakeSupabase
+        from benchmarks.fake_telegram import FakeTelegramClient
+
+        fake = FakeSupabase(latency=args.db_latency_ms / 1000)
+        # Через прокси трассировки, как в рабочем клиенте
+        supabase_client.set_client(fake)
+        seed_started = time.perf_counter()
+        event_rows = seed(fake, args.single, args.history_hours, rng, timeutils.utc_now())
+        seed_seconds = time.perf_counter() - seed_started
+
+        import main
+        import daily_digest
+        import reminder_delivery
+        import reminder_outbox
+        import reminder_scheduler
+
+    result: Dict[str, Any] = {
+        'families': args.single,
+        'event_rows': event_rows,
+        'seed_seconds': seed_seconds,
+        'db_latency_ms': args.db_latency_ms,
+    }
+
+    # ---- Полная проверка напоминаний ----
+    telegram = FakeTelegramClient(latency=args.tg_latency_ms / 1000)
+    main.telegram_client = telegram
+    fake.reset_calls()
+    with _quiet(not args.verbose):
+        started = time.perf_counter()
+        main.send_smart_reminders()
+        result['sweep_seconds'] = time.perf_counter() - started
+    calls = _split_calls(fake)
+    result['sweep_round_trips'] = calls['total']
+    result['sweep_reads'] = calls['reads']
+    result['sweep_writes'] = calls['writes']
+    result['round_trips_per_family'] = calls['total'] / args.single
+    result['reminders_enqueued'] = reminder_outbox.get_outbox_stats()['pending']
+    # Проверка корректности: каждая семья без событий получила напоминание
+    reminded = {row[0] for row in reminder_outbox._get_connection().execute("SELECT DISTINCT family_id FROM outbox")}
+    result['new_families_missed'] = sum(
+        1 for family_id in range(1, args.single + 1) if is_new_family(family_id) and family_id not in reminded
+    )
+
+    # ---- Проверка одной семьи по таймеру ----
+    fake.reset_calls()
+    with _quiet(not args.verbose):
+        started = time.perf_counter()
+        main.send_smart_reminders([rng.randint(1, args.single)])
+        result['targeted_sweep_ms'] = (time.perf_counter() - started) * 1000
+    result['targeted_sweep_round_trips'] = fake.total_calls()
+
+    # ---- Доставка напоминаний ----
+    target = min(result['reminders_enqueued'], args.delivery_limit)
+    reminder_delivery.GLOBAL_RATE_PER_SECOND = args.delivery_rate
+    reminder_delivery._tokens = args.delivery_rate
+
+    async def deliver():
+        task = asyncio.create_task(reminder_delivery.run_delivery_workers(telegram))
+        deadline = time.perf_counter() + args.delivery_timeout
+        while telegram.sent_messages < target and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+
+    with _quiet(not args.verbose):
+        started = time.perf_counter()
+        asyncio.run(deliver())
+        delivery_seconds = time.perf_counter() - started
+    result['messages_delivered'] = telegram.sent_messages
+    result['delivery_seconds'] = delivery_seconds
+    result['messages_per_second'] = telegram.sent_messages / delivery_seconds if delivery_seconds else 0.0
+    result['delivery_rate_limit'] = args.delivery_rate
+
+    # ---- Обработчики start_bot ----
+    # Отдельный outbox и пустое расписание, чтобы фоновая доставка и проверки
+    # по таймеру после полной проверки не попадали в замер обработчиков
+    reminder_scheduler.clear_schedule()
+    reminder_outbox.OUTBOX_PATH = os.path.join(workdir, 'handlers_outbox.db')
+    reminder_outbox._connection = None
+    bot_client = FakeTelegramClient(latency=args.tg_latency_ms / 1000)
+    main.TelegramClient = lambda *a, **kw: bot_client
+    main.scheduler = _NullScheduler()
+    latencies: List[float] = []
+
+    async def handlers():
+        bot = asyncio.create_task(main.start_bot())
+        await bot_client.ready.wait()
+        # Замер начинается с холодных кэшей
+        supabase_client.invalidate_family_state()
+        supabase_client.clear_family_cache()
+        fake.reset_calls()
+        query_tracing.reset_metrics()
+        semaphore = asyncio.Semaphore(args.handler_concurrency)
+
+        async def one_action():
+            family_id = rng.randint(1, args.single)
+            user_id = family_id * 10 + rng.choice((1, 2))
+            kind, payload = rng.choice(HANDLER_ACTIONS)
+            async with semaphore:
+                started = time.perf_counter()
+                if kind == 'message':
+                    await bot_client.message(user_id, payload)
+                else:
+                    await bot_client.callback(user_id, payload)
+                latencies.append((time.perf_counter() - started) * 1000)
+
+        await asyncio.gather(*(one_action() for _ in range(args.handler_events)))
+        bot_client.disconnect()
+        await bot
+
+    with _quiet(not args.verbose):
+        asyncio.run(handlers())
+    result['handler_events'] = len(latencies)
+    result['handler_p50_ms'] = _percentile(latencies, 50)
+    result['handler_p99_ms'] = _percentile(latencies, 99)
+    result['handler_round_trips_per_event'] = fake.total_calls() / max(1, len(latencies))
+    # Самые дорогие запросы обработчиков (видны в --json)
+    result['handler_top_queries'] = query_tracing.get_query_summary(5)
+
+    # ---- Совет дня всем семьям в одну минуту (время советов по умолчанию) ----
+    reminder_outbox.OUTBOX_PATH = os.path.join(workdir, 'digest_outbox.db')
+    reminder_outbox._connection = None
+    due_at = (timeutils.utc_now() - timedelta(minutes=1)).isoformat()
+    for row in fake.get_table('settings').rows:
+        row['next_tips_at'] = due_at
+    fake.get_table('settings').changed()
+    fake.reset_calls()
+    with _quiet(not args.verbose):
+        started = time.perf_counter()
+        result['digests_enqueued'] = daily_digest.send_due_digests()
+        result['digest_seconds'] = time.perf_counter() - started
+    result['digest_round_trips'] = fake.total_calls()
+    return result
+
+
+def _print_table(results: List[Dict[str, Any]]):
+    columns = [
+        ('families', 'Семей', '{:d}'),
+        ('sweep_seconds', 'Проверка, с', '{:.2f}'),
+        ('sweep_round_trips', 'Запросов', '{:d}'),
+        ('new_families_missed', 'Новых без напом.', '{:d}'),
+        ('round_trips_per_family', 'Запросов/семью', '{:.3f}'),
+        ('targeted_sweep_round_trips', 'Запросов/таймер', '{:d}'),
+        ('reminders_enqueued', 'Напоминаний', '{:d}'),
+        ('messages_per_second', 'Сообщ./с', '{:.1f}'),
+        ('handler_p50_ms', 'p50, мс', '{:.1f}'),
+        ('handler_p99_ms', 'p99, мс', '{:.1f}'),
+        ('handler_round_trips_per_event', 'Запросов/действие', '{:.2f}'),
+        ('digest_round_trips', 'Запросов/советы', '{:d}'),
+    ]
+    rows = [[title for _, title, _ in columns]]
+    for result in results:
+        rows.append([fmt.format(result[key]) for key, _, fmt in columns])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    for row in rows:
+        print('  '.join(cell.rjust(width) for cell, width in zip(row, widths)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Бенчмарк напоминаний и обработчиков BabyCareBot')
+    parser.add_argument('--families', type=int, nargs='+', default=[10, 1000, 50000],
+                        help='число семей для каждого прогона')
+    parser.add_argument('--history-hours', type=int, default=24, help='глубина истории событий')
+    parser.add_argument('--db-latency-ms', type=float, default=5.0, help='задержка каждого запроса к БД')
+    parser.add_argument('--tg-latency-ms', type=float, default=20.0, help='задержка каждого вызова Telegram API')
+    parser.add_argument('--delivery-rate', type=float, default=1000.0,
+                        help='общий лимит доставки, сообщений в секунду (в Telegram - около 30)')
+    parser.add_argument('--delivery-limit', type=int, default=2000, help='сколько напоминаний доставить')
+    parser.add_argument('--delivery-timeout', type=float, default=120.0, help='предельное время доставки, с')
+    parser.add_argument('--handler-events', type=int, default=500, help='число действий пользователей')
+    parser.add_argument('--handler-concurrency', type=int, default=50, help='одновременных действий')
+    parser.add_argument('--seed', type=int, default=42, help='зерно генератора данных')
+    parser.add_argument('--json', action='store_true', help='вывести результаты в JSON')
+    parser.add_argument('--verbose', action='store_true', help='показывать журнал бота')
+    parser.add_argument('--single', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.single:
+        print(RESULT_MARKER + json.dumps(run_single(args)))
+        return
+
+    results = []
+    passthrough = [arg for arg in sys.argv[1:] if arg != '--json']
+    for families in args.families:
+        print(f"⏱  {families} семей...", file=sys.stderr)
+        completed = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.run_benchmarks', *passthrough, '--single', str(families)],
+            cwd=REPO_ROOT, capture_output=True, text=True
+        )
+        lines = [line for line in completed.stdout.splitlines() if line.startswith(RESULT_MARKER)]
+        if completed.returncode != 0 or not lines:
+            print(completed.stdout[-2000:], completed.stderr[-2000:], file=sys.stderr)
+            raise SystemExit(f"Прогон для {families} семей завершился с ошибкой")
+        results.append(json.loads(lines[-1][len(RESULT_MARKER):]))
+
+    if args.json:
+        print(json.dumps(results, indent=2, ensure_ascii=False))
+    else:
+        _print_table(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""
+Состояния диалогов с пользователями
+Многошаговые сценарии (ввод названия семьи, кода, времени, даты рождения,
+часового пояса, подтверждение дубликата) хранят одно состояние на пользователя: имя, данные
+и момент истечения. Поиск - один словарь, размер ограничен (LRU), брошенные
+сценарии истекают. Если задан CONVERSATION_STATE_PATH, состояния дублируются
+в SQLite и переживают перезапуск бота
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+CONVERSATION_STATE_PATH = os.getenv('CONVERSATION_STATE_PATH', '')
+CONVERSATION_MAX_USERS = 10000
+DEFAULT_STATE_TTL = 900  # 15 минут
+
+# Состояния сценариев и время их жизни в секундах
+FAMILY_NAME = 'family_name'
+FAMILY_CODE = 'family_code'
+CUSTOM_TIME = 'custom_time'
+BIRTH_DATE = 'birth_date'
+DUPLICATE_CONFIRMATION = 'duplicate_confirmation'
+TIMEZONE = 'timezone'
+
+STATE_TTLS = {
+    FAMILY_NAME: 900,
+    FAMILY_CODE: 900,
+    CUSTOM_TIME: 600,
+    BIRTH_DATE: 900,
+    DUPLICATE_CONFIRMATION: 300,
+    TIMEZONE: 600,
+}
+
+# user_id -> (состояние, данные, момент истечения)
+_states: 'OrderedDict[int, Tuple[str, Any, float]]' = OrderedDict()
+_lock = threading.Lock()
+_stats = {'expired': 0, 'evicted': 0}
+_connection: Optional[sqlite3.Connection] = None
+_loaded = False
+
+
+def _get_connection() -> Optional[sqlite3.Connection]:
+    """База SQLite для состояний (None, если хранение на диске не настроено)"""
+    global _connection
+    if not CONVERSATION_STATE_PATH:
+        return None
+    if _connection is None:
+        connection = sqlite3.connect(CONVERSATION_STATE_PATH, check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS conversation_state (
+                user_id INTEGER PRIMARY KEY,
+                state TEXT NOT NULL,
+                data TEXT,
+                expires_at REAL NOT NULL
+            )
+        """)
+        _connection = connection
+    return _connection
+
+
+def _ensure_loaded():
+    """Загрузить неистекшие состояния с диска при первом обращении (под _lock)"""
+    global _loaded
+    if _loaded:
+        return
+    _loaded = True
+    connection = _get_connection()
+    if connection is None:
+        return
+    try:
+        now = time.time()
+        connection.execute("DELETE FROM conversation_state WHERE expires_at <= ?", (now,))
+        rows = connection.execute(
+            "SELECT user_id, state, data, expires_at FROM conversation_state ORDER BY expires_at DESC LIMIT ?",
+            (CONVERSATION_MAX_USERS,)
+        ).fetchall()
+    except sqlite3.Error as e:
+        print(f"❌ Ошибка загрузки состояний диалогов: {e}")
+        return
+    for user_id, state, data, expires_at in reversed(rows):
+        _states[user_id] = (state, json.loads(data) if data else None, expires_at)
+    if rows:
+        print(f"💬 Восстановлено состояний диалогов: {len(rows)}")
+
+
+def _persist(user_id: int, entry: Optional[Tuple[str, Any, float]]):
+    connection = _get_connection()
+    if connection is None:
+        return
+    try:
+        if entry is None:
+            connection.execute("DELETE FROM conversation_state WHERE user_id = ?", (user_id,))
+        else:
+            state, data, expires_at = entry
+            connection.execute(
+                "INSERT OR REPLACE INTO conversation_state (user_id, state, data, expires_at) VALUES (?, ?, ?, ?)",
+                (user_id, state, json.dumps(data) if data is not None else None, expires_at)
+            )
+    except sqlite3.Error as e:
+        print(f"❌ Ошибка сохранения состояния диалога {user_id}: {e}")
+
+
+def set_state(user_id: int, state: str, data: Any = None, ttl: Optional[float] = None):
+    """Перевести пользователя в состояние (предыдущее состояние заменяется)"""
+    entry = (state, data, time.time() + (ttl or STATE_TTLS.get(state, DEFAULT_STATE_TTL)))
+    evicted = []
+    with _lock:
+        _ensure_loaded()
+        _states[user_id] = entry
+        _states.move_to_end(user_id)
+        while len(_states) > CONVERSATION_MAX_USERS:
+            evicted.append(_states.popitem(last=False)[0])
+            _stats['evicted'] += 1
+        _persist(user_id, entry)
+        for evicted_user in evicted:
+            _persist(evicted_user, None)
+
+
+def get_state(user_id: int) -> Optional[Tuple[str, Any]]:
+    """Текущее состояние пользователя и его данные или None"""
+    with _lock:
+        _ensure_loaded()
+        entry = _states.get(user_id)
+        if entry is None:
+            return None
+        if entry[2] <= time.time():
+            del _states[user_id]
+            _stats['expired'] += 1
+            _persist(user_id, None)
+            return None
+        return entry[0], entry[1]
+
+
+def pop_state(user_id: int, state: Optional[str] = None) -> Optional[Tuple[str, Any]]:
+    """Завершить сценарий; если указан state, снимается только это состояние"""
+    current = get_state(user_id)
+    if current is None or (state is not None and current[0] != state):
+        return None
+    with _lock:
+        _states.pop(user_id, None)
+        _persist(user_id, None)
+    return current
+
+
+def clear_state(user_id: int):
+    """Сбросить состояние пользователя"""
+    with _lock:
+        _ensure_loaded()
+        if _states.pop(user_id, None) is not None:
+            _persist(user_id, None)
+
+
+def purge_expired() -> int:
+    """Удалить истекшие состояния (периодическая задача)"""
+    now = time.time()
+    with _lock:
+        _ensure_loaded()
+        expired = [user_id for user_id, entry in _states.items() if entry[2] <= now]
+        for user_id in expired:
+            del _states[user_id]
+        _stats['expired'] += len(expired)
+        connection = _get_connection()
+        if connection is not None:
+            try:
+                connection.execute("DELETE FROM conversation_state WHERE expires_at <= ?", (now,))
+            except sqlite3.Error as e:
+                print(f"❌ Ошибка очистки состояний диалогов: {e}")
+    return len(expired)
+
+
+def get_state_stats() -> Dict[str, Any]:
+    """Число активных состояний по сценариям"""
+    with _lock:
+        by_state: Dict[str, int] = {}
+        for state, _, _ in _states.values():
+            by_state[state] = by_state.get(state, 0) + 1
+        return {'size': len(_states), 'max_size': CONVERSATION_MAX_USERS, 'persistent': bool(CONVERSATION_STATE_PATH),
+                'by_state': by_state, **_stats}
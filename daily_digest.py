@@ -0,0 +1,127 @@
+"""
+Ежедневные уведомления: совет дня и напоминание о купании
+В начале каждой минуты выбираются семьи, у которых по местному времени наступил
+момент совета или купания (колонки next_tips_at/next_bath_at в settings ведет
+триггер, выборка идет по индексам на них). Семьи обрабатываются пачками: члены
+семей и сводка за сутки загружаются одним запросом на пачку, совет берется из
+каталога в памяти, сообщения пишутся в outbox и отправляются общей доставкой
+с ограничением скорости, после чего моменты сдвигаются на следующий раз
+"""
+
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional
+
+import query_tracing
+import reminder_outbox
+import sharding
+import supabase_client
+import timeutils
+
+DIGEST_BATCH_SIZE = 500
+# Уведомление, опоздавшее сильнее (бот был остановлен), не отправляется, а переносится
+DIGEST_MAX_DELAY_MINUTES = 60
+DIGEST_SUMMARY_HOURS = 24
+
+# Строки сводки за сутки: таблица событий -> подпись
+SUMMARY_LINES = (
+    ('feedings', "🍼 Кормления"),
+    ('diapers', "💩 Смены подгузников"),
+    ('baths', "🛁 Купания"),
+    ('activities', "🎮 Активность"),
+)
+
+
+def _age_months(settings: Dict[str, Any], today) -> int:
+    birth_date = settings.get('baby_birth_date')
+    if birth_date:
+        try:
+            return supabase_client.baby_age_months(birth_date, today)
+        except ValueError:
+            pass
+    return settings.get('baby_age_months') or 0
+
+
+def build_tip_message(settings: Dict[str, Any], counts: Optional[Dict[str, int]]) -> str:
+    """Совет дня для возраста малыша и сводка событий за сутки"""
+    today = timeutils.local_date(settings.get('timezone'))
+    message = f"💡 **Совет дня:**\n\n{supabase_client.get_random_tip(_age_months(settings, today))}"
+    if counts is not None:
+        message += "\n\n📊 **За сутки:**\n"
+        message += "\n".join(f"{label}: {counts.get(table, 0)} раз" for table, label in SUMMARY_LINES)
+    return message
+
+
+def build_bath_message(settings: Dict[str, Any], counts: Optional[Dict[str, int]]) -> str:
+    """Напоминание о вечернем купании"""
+    return "🛁 **Время купания!**\n\nТеплая ванна перед сном помогает малышу успокоиться и лучше спать."
+
+
+MESSAGE_BUILDERS = {
+    'tips': build_tip_message,
+    'bath': build_bath_message,
+}
+
+
+def _process_batch(kind: str, rows: List[Dict[str, Any]], now: datetime) -> int:
+    """Поставить в очередь уведомления пачки семей и сдвинуть их моменты; возвращает число сообщений"""
+    column = supabase_client.DIGEST_COLUMNS[kind]
+    max_delay = timedelta(minutes=DIGEST_MAX_DELAY_MINUTES)
+    # Опоздавшие уведомления только переносятся на следующий раз
+    fresh = [row for row in rows if now - timeutils.parse_timestamp(row[column]) <= max_delay]
+
+    queued = 0
+    if fresh:
+        family_ids = [row['family_id'] for row in fresh]
+        members = supabase_client.get_family_members_bulk(family_ids)
+        if members is None:
+            # Моменты не сдвигаются: пачка повторится в следующую минуту
+            return 0
+        counts = None
+        if kind == 'tips':
+            counts = supabase_client.get_event_counts_bulk(family_ids, now - timedelta(hours=DIGEST_SUMMARY_HOURS))
+
+        def reminders() -> Iterable[Dict[str, Any]]:
+            for row in fresh:
+                family_id = row['family_id']
+                user_ids = members.get(family_id)
+                if not user_ids:
+                    continue
+                family_counts = counts.get(family_id, {}) if counts is not None else None
+                message = MESSAGE_BUILDERS[kind](row, family_counts)
+                for user_id in user_ids:
+                    # Ключ с моментом уведомления: повтор пачки после сбоя не создает дубликатов
+                    yield {
+                        'delivery_key': f"{family_id}:{user_id}:{kind}:{row[column]}",
+                        'user_id': user_id,
+                        'family_id': family_id,
+                        'message': message,
+                    }
+
+        queued = reminder_outbox.enqueue(reminders())
+
+    supabase_client.advance_digests(kind, [row['family_id'] for row in rows])
+    return queued
+
+
+@query_tracing.traced_job('daily_digests')
+def send_due_digests(now: Optional[datetime] = None) -> int:
+    """Поставить в очередь советы дня и напоминания о купании, момент которых наступил"""
+    now = now or timeutils.utc_now()
+    due = supabase_client.load_due_digests(now)
+    if not due:
+        return 0
+
+    queued = 0
+    sharding.verify_leases()
+    for kind, rows in due.items():
+        # При нескольких воркерах каждый отправляет уведомления семей своих шардов
+        rows = [row for row in rows if sharding.owns_family(row['family_id'])]
+        for start in range(0, len(rows), DIGEST_BATCH_SIZE):
+            batch = rows[start:start + DIGEST_BATCH_SIZE]
+            try:
+                queued += _process_batch(kind, batch, now)
+            except Exception as e:
+                print(f"[Digests] Failed to process {kind} batch: {e}")
+    if queued:
+        print(f"[Digests] Daily notifications queued: {queued}")
+    return queued
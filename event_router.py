@@ -0,0 +1,116 @@
+"""
+Маршрутизация обновлений Telegram
+Маршрут выбирается по ключу обновления (данные кнопки или текст сообщения)
+поиском в словаре: сначала точный ключ, затем префикс до последнего разделителя
+(set_feed_3 -> set_feed_). Часть ключа после префикса разбирается в типизированный
+аргумент, а для маршрутов с family=True семья пользователя определяется один раз
+на обновление и передается обработчику
+"""
+
+import functools
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from telethon import events
+
+
+class Update:
+    """Разобранное обновление, которое получает обработчик маршрута"""
+    __slots__ = ('uid', 'key', 'payload', 'fid')
+
+    def __init__(self, uid: int, key: str, payload: Any = None, fid: Optional[int] = None):
+        self.uid = uid
+        self.key = key
+        self.payload = payload
+        self.fid = fid
+
+
+class Route:
+    __slots__ = ('handler', 'parse', 'value', 'family')
+
+    def __init__(self, handler: Callable[..., Awaitable[Any]], parse: Optional[Callable[[str], Any]],
+                 value: Any, family: bool):
+        self.handler = handler
+        self.parse = parse
+        self.value = value
+        self.family = family
+
+
+class Router:
+    """Таблица маршрутов: точные ключи и префиксы, оканчивающиеся разделителем"""
+
+    def __init__(self, key: Callable[[Any], Optional[str]],
+                 resolve_family: Optional[Callable[[int], Awaitable[Optional[int]]]] = None,
+                 separator: str = '_'):
+        self._key = key
+        self._resolve_family = resolve_family
+        self._separator = separator
+        self._exact: Dict[str, Route] = {}
+        self._prefixes: Dict[str, Route] = {}
+
+    def route(self, key: str, prefix: bool = False, parse: Optional[Callable[[str], Any]] = None,
+              value: Any = None, family: bool = False):
+        """Декоратор обработчика async def handler(event, update).
+        prefix=True - key оканчивается разделителем, остаток ключа разбирается функцией parse;
+        value - аргумент точного маршрута; family=True - в update.fid передается семья пользователя"""
+        if prefix and not key.endswith(self._separator):
+            raise ValueError(f"Префикс маршрута должен оканчиваться на '{self._separator}': {key}")
+
+        def decorator(handler):
+            table = self._prefixes if prefix else self._exact
+            if key in table:
+                raise ValueError(f"Маршрут уже зарегистрирован: {key}")
+            table[key] = Route(handler, parse, value, family)
+            return handler
+        return decorator
+
+    def resolve(self, key: str) -> Tuple[Optional[Route], Any]:
+        """Маршрут и аргумент для ключа; (None, None), если маршрута нет или аргумент не разобран"""
+        route = self._exact.get(key)
+        if route is not None:
+            return route, route.value
+        cut = key.rfind(self._separator)
+        if cut < 0:
+            return None, None
+        route = self._prefixes.get(key[:cut + 1])
+        if route is None:
+            return None, None
+        raw = key[cut + 1:]
+        try:
+            return route, route.parse(raw) if route.parse else raw
+        except (TypeError, ValueError, LookupError):
+            return None, None
+
+    async def dispatch(self, event) -> bool:
+        """Вызвать обработчик маршрута; False, если подходящего маршрута нет"""
+        key = self._key(event)
+        if key is None:
+            return False
+        route, payload = self.resolve(key)
+        if route is None:
+            return False
+        update = Update(event.sender_id, key, payload)
+        if route.family and self._resolve_family is not None:
+            update.fid = await self._resolve_family(update.uid)
+        await route.handler(event, update)
+        return True
+
+
+def callback_key(event) -> Optional[str]:
+    data = getattr(event, 'data', None)
+    if data is None:
+        return None
+    return data.decode('utf-8', 'replace') if isinstance(data, bytes) else str(data)
+
+
+def text_key(event) -> Optional[str]:
+    text = getattr(event, 'text', None)
+    return text.strip() if text else None
+
+
+def exclusive(handler):
+    """Обработчик команды, после которого общий обработчик текста не вызывается"""
+    @functools.wraps(handler)
+    async def wrapper(event):
+        await handler(event)
+        raise events.StopPropagation
+    return wrapper
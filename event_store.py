@@ -0,0 +1,195 @@
+"""
+Хранилище событий ухода за малышом
+Общий код для таблиц feedings, diapers, baths и activities: пакетная запись,
+последние события для многих семей и видов сразу и история.
+Все времена из БД приводятся к моментам в UTC в одном месте (timeutils)
+"""
+
+from datetime import datetime
+from enum import Enum
+from typing import Any, Dict, Iterable, List, Optional
+
+from timeutils import parse_timestamp
+
+PAGE_SIZE = 1000
+
+# Сбрасывается, если функции get_latest_events нет в БД (см. supabase_schema.sql)
+_latest_rpc_available = True
+
+
+class EventKind(str, Enum):
+    """Вид события; значение совпадает с ключами кэша состояния семьи"""
+    FEEDING = 'feeding'
+    DIAPER = 'diaper'
+    BATH = 'bath'
+    ACTIVITY = 'activity'
+
+    @property
+    def table(self) -> str:
+        return EVENT_TABLES[self]
+
+
+EVENT_TABLES = {
+    EventKind.FEEDING: 'feedings',
+    EventKind.DIAPER: 'diapers',
+    EventKind.BATH: 'baths',
+    EventKind.ACTIVITY: 'activities',
+}
+
+# Дополнительные колонки, которые есть только у отдельных таблиц
+EVENT_EXTRA_COLUMNS = {
+    EventKind.ACTIVITY: ('activity_type',),
+}
+
+
+def _client():
+    # Клиент берется при вызове, чтобы подмена через supabase_client.set_client действовала и здесь
+    import supabase_client
+    return supabase_client.supabase
+
+
+def _mirror():
+    # local_mirror сам импортирует event_store, поэтому импорт отложен
+    import local_mirror
+    return local_mirror
+
+
+def new_event(kind: EventKind, family_id: int, author_id: int, timestamp: datetime,
+              author_role: str = 'Родитель', author_name: str = 'Неизвестно', **extra) -> Dict[str, Any]:
+    """Описание события для record_events"""
+    event = {
+        'kind': EventKind(kind),
+        'family_id': family_id,
+        'author_id': author_id,
+        'timestamp': timestamp,
+        'author_role': author_role,
+        'author_name': author_name,
+    }
+    event.update(extra)
+    return event
+
+
+def _event_row(event: Dict[str, Any]) -> Dict[str, Any]:
+    kind = EventKind(event['kind'])
+    row = {
+        'family_id': event['family_id'],
+        'author_id': event['author_id'],
+        'timestamp': event['timestamp'].isoformat(),
+        'author_role': event.get('author_role', 'Родитель'),
+        'author_name': event.get('author_name', 'Неизвестно'),
+    }
+    for column in EVENT_EXTRA_COLUMNS.get(kind, ()):
+        if column in event:
+            row[column] = event[column]
+    return row
+
+
+def record_events(events: Iterable[Dict[str, Any]]) -> Dict[EventKind, int]:
+    """Записать события: по одному запросу на таблицу для всех событий этого вида"""
+    rows_by_kind: Dict[EventKind, List[Dict[str, Any]]] = {}
+    for event in events:
+        rows_by_kind.setdefault(EventKind(event['kind']), []).append(_event_row(event))
+
+    client = _client()
+    recorded = {}
+    for kind, rows in rows_by_kind.items():
+        result = client.table(kind.table).insert(rows).execute()
+        _mirror().upsert_rows(kind.table, result.data)
+        recorded[kind] = len(rows)
+    return recorded
+
+
+def _latest_events_rpc(family_ids: Optional[List[int]], kinds: List[EventKind], since: Optional[datetime],
+                       latest: Dict[int, Dict[EventKind, Optional[datetime]]]):
+    """Последние события всех видов одним вызовом get_latest_events (постранично)"""
+    params = {
+        'p_family_ids': family_ids,
+        'p_tables': [kind.table for kind in kinds],
+        'p_since': since.isoformat() if since is not None else None,
+    }
+    kinds_by_table = {kind.table: kind for kind in kinds}
+    for row in fetch_all_rows(lambda: _client().rpc('get_latest_events', params).order('family_id').order('event_table')):
+        times = latest.setdefault(row['family_id'], dict.fromkeys(kinds))
+        times[kinds_by_table[row['event_table']]] = parse_timestamp(row['last_time'])
+
+
+def latest_events(family_ids: Optional[List[int]], kinds: Iterable[EventKind] = tuple(EventKind),
+                  since: Optional[datetime] = None) -> Dict[int, Dict[EventKind, Optional[datetime]]]:
+    """Время последнего события каждого вида для каждой семьи (None - для всех семей с событиями)
+    одним вызовом функции get_latest_events; без нее - по запросу на вид"""
+    global _latest_rpc_available
+    kinds = [EventKind(kind) for kind in kinds]
+    latest = {family_id: dict.fromkeys(kinds) for family_id in family_ids or ()}
+    if family_ids is not None and not family_ids:
+        return latest
+
+    if _latest_rpc_available:
+        import supabase_client
+        try:
+            _latest_events_rpc(family_ids, kinds, since, latest)
+            return latest
+        except Exception as e:
+            if not supabase_client._is_missing_function_error(e):
+                raise
+            print("⚠️ Функция get_latest_events не найдена в базе (supabase_schema.sql), "
+                  "последние события читаются по таблицам")
+            _latest_rpc_available = False
+
+    for kind in kinds:
+        if family_ids is not None and len(family_ids) == 1:
+            query = _client().table(kind.table).select('timestamp').eq('family_id', family_ids[0])
+            if since is not None:
+                query = query.gte('timestamp', since.isoformat())
+            rows = query.order('timestamp', desc=True).limit(1).execute().data
+            times = {family_ids[0]: parse_timestamp(rows[0]['timestamp'])} if rows else {}
+        else:
+            times = latest_event_times(kind, since, family_ids)
+        for family_id, timestamp in times.items():
+            latest.setdefault(family_id, dict.fromkeys(kinds))[kind] = timestamp
+    return latest
+
+
+def latest_event_times(kind: EventKind, since: Optional[datetime],
+                       family_ids: Optional[List[int]] = None) -> Dict[int, datetime]:
+    """Время последнего события вида kind для всех семей (или указанных).
+    Без since читаются все события этих семей, поэтому массовые проверки
+    ограничивают окно"""
+    kind = EventKind(kind)
+    client = _client()
+
+    def build_query():
+        query = client.table(kind.table).select('family_id, timestamp')
+        if since is not None:
+            query = query.gte('timestamp', since.isoformat())
+        if family_ids is not None:
+            query = query.in_('family_id', family_ids)
+        return query.order('timestamp', desc=True).order('id', desc=True)
+
+    latest = {}
+    for row in fetch_all_rows(build_query):
+        # Строки отсортированы по убыванию, поэтому первая строка семьи - последняя по времени
+        if row['family_id'] not in latest:
+            latest[row['family_id']] = parse_timestamp(row['timestamp'])
+    return latest
+
+
+def event_history(family_id: int, kind: EventKind, limit: int = 10) -> List[Dict[str, Any]]:
+    """Последние события семьи; timestamp приводится к UTC"""
+    kind = EventKind(kind)
+    mirrored = _mirror().event_history(family_id, kind, limit)
+    if mirrored is not None:
+        return mirrored
+    result = _client().table(kind.table).select('*').eq('family_id', family_id).order('timestamp', desc=True).limit(limit).execute()
+    return [{**row, 'timestamp': parse_timestamp(row['timestamp'])} for row in result.data]
+
+
+def fetch_all_rows(build_query, page_size: int = PAGE_SIZE) -> List[Dict[str, Any]]:
+    """Прочитать все строки запроса постранично (PostgREST ограничивает размер ответа)"""
+    rows = []
+    offset = 0
+    while True:
+        page = build_query().range(offset, offset + page_size - 1).execute().data or []
+        rows.extend(page)
+        if len(page) < page_size:
+            return rows
+        offset += page_size
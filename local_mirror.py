@@ -0,0 +1,321 @@
+"""
+Локальная копия часто читаемых таблиц Supabase в SQLite (WAL)
+Если LOCAL_MIRROR=1, при запуске в файл загружаются families, family_members,
+settings, tips и события за последние LOCAL_MIRROR_EVENT_DAYS дней. Копию
+обновляют записи самого бота и периодическая догрузка строк, созданных или
+измененных после предыдущей синхронизации (created_at/updated_at). Чтения
+членства, настроек, последних событий и истории идут в копию, поэтому они
+не ждут сеть и работают, пока Supabase недоступен. Строки, удаленные в обход
+бота, исчезают из копии при полной синхронизации (раз в MIRROR_FULL_SYNC_HOURS)
+"""
+
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional
+
+import event_store
+import sharding
+import timeutils
+from event_store import EventKind
+
+LOCAL_MIRROR_ENABLED = os.getenv('LOCAL_MIRROR', '0') == '1'
+LOCAL_MIRROR_PATH = os.getenv('LOCAL_MIRROR_PATH') or (
+    f'local_mirror.{sharding.WORKER_INDEX}.db' if sharding.is_sharded() else 'local_mirror.db'
+)
+LOCAL_MIRROR_EVENT_DAYS = int(os.getenv('LOCAL_MIRROR_EVENT_DAYS', '7'))
+MIRROR_SYNC_SECONDS = 60
+MIRROR_FULL_SYNC_HOURS = 6
+# Догрузка начинается чуть раньше последней синхронизации: строки транзакций,
+# которые завершились позже, но с более ранним created_at, не теряются
+MIRROR_SYNC_OVERLAP_SECONDS = 120
+
+# Таблица -> (первичный ключ, индексируемые колонки, колонка догрузки изменений)
+MIRROR_TABLES = {
+    'families': (('id',), (), 'created_at'),
+    'family_members': (('family_id', 'user_id'), ('user_id',), 'created_at'),
+    'settings': (('family_id',), (), 'updated_at'),
+    'tips': (('id',), (), 'created_at'),
+}
+for _kind in EventKind:
+    MIRROR_TABLES[_kind.table] = (('id',), ('family_id',), 'created_at')
+EVENT_TABLES = {kind.table: kind for kind in EventKind}
+
+_connection: Optional[sqlite3.Connection] = None
+_lock = threading.Lock()
+_sync_lock = threading.Lock()
+_ready = False
+_stats = {'reads': 0, 'misses': 0, 'synced_rows': 0, 'sync_errors': 0}
+
+
+def is_enabled() -> bool:
+    return LOCAL_MIRROR_ENABLED
+
+
+def is_ready() -> bool:
+    """Копия загружена и может отвечать на чтения"""
+    return _ready
+
+
+def _client():
+    import supabase_client
+    return supabase_client.supabase
+
+
+def _get_connection() -> sqlite3.Connection:
+    global _connection
+    if _connection is None:
+        connection = sqlite3.connect(LOCAL_MIRROR_PATH, check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        for table, (keys, indexed, _) in MIRROR_TABLES.items():
+            columns = [f"{column} INTEGER" for column in dict.fromkeys(keys + indexed)]
+            if table in EVENT_TABLES:
+                columns.append("ts REAL NOT NULL")
+            connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} ({', '.join(columns)}, data TEXT NOT NULL, "
+                f"PRIMARY KEY ({', '.join(keys)}))"
+            )
+            for column in indexed:
+                order = ', ts DESC' if table in EVENT_TABLES else ''
+                connection.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_{column} ON {table}({column}{order})")
+        connection.execute("CREATE TABLE IF NOT EXISTS sync_state (name TEXT PRIMARY KEY, value TEXT)")
+        _connection = connection
+    return _connection
+
+
+def _get_sync_state(connection: sqlite3.Connection, name: str) -> Optional[str]:
+    row = connection.execute("SELECT value FROM sync_state WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else None
+
+
+def _set_sync_state(connection: sqlite3.Connection, name: str, value: str):
+    connection.execute("INSERT OR REPLACE INTO sync_state (name, value) VALUES (?, ?)", (name, value))
+
+
+def _event_ts(row: Dict[str, Any]) -> float:
+    return timeutils.parse_timestamp(row['timestamp']).timestamp()
+
+
+def _store_rows(connection: sqlite3.Connection, table: str, rows: Iterable[Dict[str, Any]]) -> int:
+    keys, indexed, _ = MIRROR_TABLES[table]
+    columns = list(dict.fromkeys(keys + indexed))
+    is_event = table in EVENT_TABLES
+    placeholders = ', '.join('?' for _ in range(len(columns) + (2 if is_event else 1)))
+    statement = (f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}{', ts' if is_event else ''}, data) "
+                 f"VALUES ({placeholders})")
+    values = []
+    for row in rows:
+        item = [row.get(column) for column in columns]
+        if is_event:
+            item.append(_event_ts(row))
+        item.append(json.dumps(row, default=str))
+        values.append(item)
+    connection.executemany(statement, values)
+    return len(values)
+
+
+def _events_since() -> datetime:
+    return timeutils.utc_now() - timedelta(days=LOCAL_MIRROR_EVENT_DAYS)
+
+
+def _pull(table: str, since: Optional[str]) -> List[Dict[str, Any]]:
+    """Строки таблицы Supabase: все (с окном для событий) или измененные после since"""
+    client = _client()
+    change_column = MIRROR_TABLES[table][2]
+
+    def build_query():
+        query = client.table(table).select('*')
+        if since is not None:
+            query = query.gte(change_column, since)
+        elif table in EVENT_TABLES:
+            query = query.gte('timestamp', _events_since().isoformat())
+        return query.order(change_column).order(MIRROR_TABLES[table][0][0])
+
+    return event_store.fetch_all_rows(build_query)
+
+
+def full_sync() -> bool:
+    """Загрузить таблицы целиком (при запуске и раз в MIRROR_FULL_SYNC_HOURS)"""
+    global _ready
+    if not LOCAL_MIRROR_ENABLED:
+        return False
+    with _sync_lock:
+        started_at = timeutils.utc_now()
+        try:
+            pulled = {table: _pull(table, None) for table in MIRROR_TABLES}
+        except Exception as e:
+            _stats['sync_errors'] += 1
+            with _lock:
+                connection = _get_connection()
+                previous = _get_sync_state(connection, 'full_sync')
+            if previous:
+                # Копия с прошлого запуска лучше, чем ничего: бот продолжит работать без Supabase
+                print(f"⚠️ Локальная копия не обновлена ({e}); используются данные от {previous}")
+                _ready = True
+            else:
+                print(f"❌ Ошибка загрузки локальной копии: {e}")
+            return False
+        with _lock:
+            connection = _get_connection()
+            connection.execute("BEGIN")
+            try:
+                for table, rows in pulled.items():
+                    connection.execute(f"DELETE FROM {table}")
+                    _store_rows(connection, table, rows)
+                    _set_sync_state(connection, table, started_at.isoformat())
+                _set_sync_state(connection, 'full_sync', started_at.isoformat())
+                connection.execute("COMMIT")
+            except sqlite3.Error as e:
+                connection.execute("ROLLBACK")
+                print(f"❌ Ошибка записи локальной копии: {e}")
+                return False
+        _ready = True
+        total = sum(len(rows) for rows in pulled.values())
+        _stats['synced_rows'] += total
+        print(f"🗄️ Локальная копия загружена: {total} строк")
+        return True
+
+
+def sync() -> int:
+    """Догрузить изменения (периодическая задача); возвращает число полученных строк"""
+    if not LOCAL_MIRROR_ENABLED:
+        return 0
+    with _lock:
+        last_full = _get_sync_state(_get_connection(), 'full_sync')
+    if not last_full or datetime.fromisoformat(last_full) < timeutils.utc_now() - timedelta(hours=MIRROR_FULL_SYNC_HOURS):
+        full_sync()
+        return 0
+    total = 0
+    with _sync_lock:
+        for table in MIRROR_TABLES:
+            started_at = timeutils.utc_now()
+            with _lock:
+                last_sync = _get_sync_state(_get_connection(), table)
+            since = datetime.fromisoformat(last_sync) - timedelta(seconds=MIRROR_SYNC_OVERLAP_SECONDS)
+            try:
+                rows = _pull(table, since.isoformat())
+            except Exception as e:
+                _stats['sync_errors'] += 1
+                print(f"❌ Ошибка синхронизации локальной копии ({table}): {e}")
+                return total
+            with _lock:
+                connection = _get_connection()
+                total += _store_rows(connection, table, rows)
+                _set_sync_state(connection, table, started_at.isoformat())
+        with _lock:
+            connection = _get_connection()
+            cutoff = _events_since().timestamp()
+            for table in EVENT_TABLES:
+                connection.execute(f"DELETE FROM {table} WHERE ts < ?", (cutoff,))
+    _stats['synced_rows'] += total
+    return total
+
+
+# ==================== ЗАПИСИ БОТА ====================
+
+def upsert_rows(table: str, rows: Optional[List[Dict[str, Any]]]):
+    """Добавить в копию строки, которые бот только что записал в Supabase"""
+    if not _ready or not rows:
+        return
+    with _lock:
+        try:
+            _store_rows(_get_connection(), table, rows)
+        except sqlite3.Error as e:
+            print(f"❌ Ошибка записи в локальную копию ({table}): {e}")
+
+
+def update_rows(table: str, values: Dict[str, Any], **match):
+    """Изменить в копии строки, которые бот только что обновил в Supabase"""
+    if not _ready or not values:
+        return
+    where = ' AND '.join(f"{column} = ?" for column in match)
+    with _lock:
+        connection = _get_connection()
+        try:
+            rows = connection.execute(f"SELECT data FROM {table} WHERE {where}", tuple(match.values())).fetchall()
+            _store_rows(connection, table, [{**json.loads(data), **values} for (data,) in rows])
+        except sqlite3.Error as e:
+            print(f"❌ Ошибка записи в локальную копию ({table}): {e}")
+
+
+# ==================== ЧТЕНИЯ ====================
+
+def _query(statement: str, params: tuple = ()) -> Optional[List[Dict[str, Any]]]:
+    """Строки копии (data) или None, если копия не готова"""
+    if not _ready:
+        return None
+    with _lock:
+        try:
+            rows = _get_connection().execute(statement, params).fetchall()
+        except sqlite3.Error as e:
+            print(f"❌ Ошибка чтения локальной копии: {e}")
+            return None
+    _stats['reads'] += 1
+    return [json.loads(data) for (data,) in rows]
+
+
+def get_membership(user_id: int) -> Optional[Dict[str, Any]]:
+    """Членство пользователя; None - нет в копии (возможно, еще не синхронизировано)"""
+    rows = _query("SELECT data FROM family_members WHERE user_id = ? LIMIT 1", (user_id,))
+    if not rows:
+        _stats['misses'] += 1
+        return None
+    return rows[0]
+
+
+def get_family(family_id: int) -> Optional[Dict[str, Any]]:
+    rows = _query("SELECT data FROM families WHERE id = ?", (family_id,))
+    return rows[0] if rows else None
+
+
+def get_family_members(family_id: int) -> Optional[List[Dict[str, Any]]]:
+    rows = _query("SELECT data FROM family_members WHERE family_id = ? ORDER BY user_id", (family_id,))
+    return rows or None
+
+
+def get_settings(family_id: int) -> Optional[Dict[str, Any]]:
+    rows = _query("SELECT data FROM settings WHERE family_id = ?", (family_id,))
+    return rows[0] if rows else None
+
+
+def get_family_state(family_id: int) -> Optional[Dict[str, Any]]:
+    """Настройки и последние события семьи в формате кэша состояния семьи.
+    События старше окна копии считаются отсутствующими"""
+    settings = get_settings(family_id)
+    if settings is None:
+        _stats['misses'] += 1
+        return None
+    last_events = {}
+    for kind in EventKind:
+        rows = _query(f"SELECT data FROM {kind.table} WHERE family_id = ? ORDER BY ts DESC LIMIT 1", (family_id,))
+        last_events[kind.value] = timeutils.parse_timestamp(rows[0]['timestamp']) if rows else None
+    return {'settings': settings, 'last_events': last_events}
+
+
+def event_history(family_id: int, kind: EventKind, limit: int) -> Optional[List[Dict[str, Any]]]:
+    """Последние события семьи; None, если в окне копии их меньше limit (остальные есть только в БД)"""
+    kind = EventKind(kind)
+    rows = _query(f"SELECT data FROM {kind.table} WHERE family_id = ? ORDER BY ts DESC, id DESC LIMIT ?",
+                  (family_id, limit))
+    if rows is None or len(rows) < limit:
+        return None
+    return [{**row, 'timestamp': timeutils.parse_timestamp(row['timestamp'])} for row in rows]
+
+
+def get_tips() -> Optional[List[Dict[str, Any]]]:
+    rows = _query("SELECT data FROM tips ORDER BY id")
+    return rows or None
+
+
+def get_mirror_stats() -> Dict[str, Any]:
+    stats = {'enabled': LOCAL_MIRROR_ENABLED, 'ready': _ready, **_stats}
+    if _ready:
+        with _lock:
+            connection = _get_connection()
+            stats['rows'] = {table: connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                             for table in MIRROR_TABLES}
+            stats['full_sync'] = _get_sync_state(connection, 'full_sync')
+    return stats
@@ -1,79 +1,61 @@
 ﻿from telethon import TelegramClient, events, Button
-from datetime import datetime
+from datetime import datetime, timedelta
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 import asyncio
+import threading
 import time
-import pytz
-from collections import deque
-from typing import Optional, Dict, List, Tuple, Deque, Set
+from typing import Optional, Dict, List, Tuple, Set
 
 import os
 from dotenv import load_dotenv
 
-try:
-    from supabase_client import (
-        init_supabase, get_family_id, create_family, join_family_by_code, get_family_name, 
-        get_member_info, set_member_role, get_family_members_with_roles,
-        add_feeding, get_last_feeding_time, get_last_feeding_time_for_family,
-        add_diaper_change, get_last_diaper_change_time_for_family, get_last_diaper_change_for_family,
-        check_recent_feeding, check_recent_diaper_change,
-        get_user_intervals, set_user_interval, get_birth_date, set_birth_date,
-        get_baby_age_months, set_baby_age_months,
-        add_bath, get_last_bath_time_for_family,
-        add_activity, get_last_activity_time_for_family,
-        get_feeding_stats, get_diaper_stats, get_bath_stats, get_activity_stats,
-        get_notification_settings, update_notification_settings,
-        get_random_tip, get_feeding_history, get_diaper_history, get_bath_history,
-        get_activity_history, test_connection,
-        # Функции для напоминаний
-        check_smart_reminder_conditions, get_smart_reminder_message, 
-        get_family_members_for_notification, get_all_families, get_thai_time,
-        # Новые функции для системы уведомлений
-        check_pre_reminder_conditions, check_overdue_reminder_conditions,
-        get_pre_reminder_message, get_overdue_reminder_message,
-        get_time_until_next_feeding, get_time_until_next_diaper_change,
-        # Функции для отслеживания уведомлений
-        log_notification_sent, check_recent_notification, acknowledge_notification,
-        cleanup_old_notifications
-    )
-    print("✅ Основной Supabase клиент загружен успешно")
-except Exception as e:
-    print(f"❌ Ошибка загрузки основного Supabase клиента: {e}")
-    print("🔄 Попытка загрузить альтернативную версию...")
-    try:
-        from supabase_client_fallback import (
-            init_supabase, get_family_id, create_family, join_family_by_code, get_family_name, 
-            get_member_info, set_member_role, get_family_members_with_roles,
-            add_feeding, get_last_feeding_time, get_last_feeding_time_for_family,
-            add_diaper_change, get_last_diaper_change_time_for_family, get_last_diaper_change_for_family,
-            check_recent_feeding, check_recent_diaper_change,
-            get_user_intervals, set_user_interval, get_birth_date, set_birth_date,
-            get_baby_age_months, set_baby_age_months,
-            add_bath, get_last_bath_time_for_family,
-            add_activity, get_last_activity_time_for_family,
-            get_feeding_stats, get_diaper_stats, get_bath_stats, get_activity_stats,
-            get_notification_settings, update_notification_settings,
-            get_random_tip, get_feeding_history, get_diaper_history, get_bath_history,
-            get_activity_history, test_connection,
-            # Функции для напоминаний
-            check_smart_reminder_conditions, get_smart_reminder_message, 
-            get_family_members_for_notification, get_all_families, get_thai_time,
-            # Новые функции для системы уведомлений
-            check_pre_reminder_conditions, check_overdue_reminder_conditions,
-            get_pre_reminder_message, get_overdue_reminder_message,
-            get_time_until_next_feeding, get_time_until_next_diaper_change,
-            # Функции для отслеживания уведомлений
-            log_notification_sent, check_recent_notification, acknowledge_notification,
-            cleanup_old_notifications
-        )
-        print("✅ Альтернативный Supabase клиент загружен успешно")
-    except Exception as e2:
-        print(f"❌ Критическая ошибка загрузки Supabase клиента: {e2}")
-        print("🛑 Бот не может работать без Supabase")
-        exit(1)
-
+# Переменные из .env нужны модулям бота уже при импорте (воркеры, пути SQLite)
 load_dotenv()
 
+from supabase_client import (
+    init_supabase, check_supabase_config, get_family_id, create_family, join_family_by_code, get_family_name, 
+    get_member_info, set_member_role, get_family_members_with_roles,
+    add_feeding, get_last_feeding_time, get_last_feeding_time_for_family,
+    add_diaper_change, get_last_diaper_change_time_for_family, get_last_diaper_change_for_family,
+    check_recent_feeding, check_recent_diaper_change,
+    get_user_intervals, set_user_interval, get_birth_date, set_birth_date,
+    get_baby_age_months, set_baby_age_months,
+    add_bath, get_last_bath_time_for_family,
+    add_activity, get_last_activity_time_for_family,
+    get_feeding_stats, get_diaper_stats, get_bath_stats, get_activity_stats,
+    get_notification_settings, update_notification_settings,
+    get_random_tip, get_feeding_history, get_diaper_history, get_bath_history,
+    get_activity_history, test_connection,
+    # Функции для напоминаний
+    check_smart_reminder_conditions, get_smart_reminder_message, 
+    get_family_members_for_notification, get_all_families,
+    # Новые функции для системы уведомлений
+    check_pre_reminder_conditions, check_overdue_reminder_conditions,
+    get_pre_reminder_message, get_overdue_reminder_message,
+    get_time_until_next_feeding, get_time_until_next_diaper_change,
+    # Функции для отслеживания уведомлений
+    log_notification_sent, flush_notification_log, check_recent_notification, acknowledge_notification,
+    cleanup_old_notifications,
+    # Массовая проверка напоминаний
+    load_reminder_snapshot, has_recent_notification, remember_notification_sent, is_sleep_paused,
+    get_woken_families,
+    evaluate_smart_reminder_conditions, evaluate_overdue_reminder_conditions,
+    build_smart_reminder_message, build_overdue_reminder_message
+)
+
+import supabase_async as db
+import reminder_scheduler
+import reminder_delivery
+import reminder_outbox
+import tips_catalog
+import query_tracing
+import event_router
+import conversation_state
+import sharding
+import local_mirror
+import timeutils
+import daily_digest
+
 API_ID = os.getenv('API_ID')
 API_HASH = os.getenv('API_HASH')
 BOT_TOKEN = os.getenv('BOT_TOKEN')
@@ -181,54 +163,52 @@ def parse_birth_date(date_str: str) -> Optional[str]:
     except:
         return None
 
-def acknowledge_feeding_notifications(fid):
+async def acknowledge_feeding_notifications(fid):
     """Подтверждает уведомления о кормлении"""
-    acknowledge_notification(fid, 'pre_feeding')
-    acknowledge_notification(fid, 'due_feeding')
-    acknowledge_notification(fid, 'overdue_feeding')
+    await db.acknowledge_notification_group(fid, 'feeding')
     reset_notification_state(fid, 'feeding')
 
-def acknowledge_diaper_notifications(fid):
+async def acknowledge_diaper_notifications(fid):
     """Подтверждает уведомления о смене подгузника"""
-    acknowledge_notification(fid, 'pre_diaper')
-    acknowledge_notification(fid, 'due_diaper')
-    acknowledge_notification(fid, 'overdue_diaper')
+    await db.acknowledge_notification_group(fid, 'diaper')
     reset_notification_state(fid, 'diaper')
 
-def handle_feeding_callback(event, minutes_ago):
+async def handle_feeding_callback(event, minutes_ago):
     """Обрабатывает callback кормления"""
     uid = event.sender_id
-    result = add_feeding(uid, minutes_ago)
+    result = await db.add_feeding(uid, minutes_ago)
     
     if result is True:
-        fid = get_family_id(uid)
+        fid = await db.get_family_id(uid)
         if fid:
-            acknowledge_feeding_notifications(fid)
+            await acknowledge_feeding_notifications(fid)
+            await reschedule_family_reminders(fid)
         return True, "✅ Кормление записано!"
     elif result is False:
-        fid = get_family_id(uid)
-        if fid and check_recent_feeding(fid, 30):
-            duplicate_confirmation_pending[uid] = {"action": "feeding", "minutes_ago": minutes_ago}
+        fid = await db.get_family_id(uid)
+        if fid and await db.check_recent_feeding(fid, 30):
+            conversation_state.set_state(uid, conversation_state.DUPLICATE_CONFIRMATION, {"action": "feeding", "minutes_ago": minutes_ago})
             return False, "⚠️ **Внимание!**\n\nКормление уже было записано в последние 30 минут.\n\nВы уверены, что хотите добавить еще одно кормление?", [[Button.inline("✅ Да, добавить", b"confirm_duplicate"), Button.inline("❌ Отмена", b"cancel_duplicate")]]
         else:
             return False, "❌ Ошибка записи кормления"
     else:
         return False, "❌ Ошибка записи кормления"
 
-def handle_diaper_callback(event, minutes_ago):
+async def handle_diaper_callback(event, minutes_ago):
     """Обрабатывает callback смены подгузника"""
     uid = event.sender_id
-    result = add_diaper_change(uid, minutes_ago)
+    result = await db.add_diaper_change(uid, minutes_ago)
     
     if result is True:
-        fid = get_family_id(uid)
+        fid = await db.get_family_id(uid)
         if fid:
-            acknowledge_diaper_notifications(fid)
+            await acknowledge_diaper_notifications(fid)
+            await reschedule_family_reminders(fid)
         return True, "✅ Смена подгузника записана!"
     elif result is False:
-        fid = get_family_id(uid)
-        if fid and check_recent_diaper_change(fid, 30):
-            duplicate_confirmation_pending[uid] = {"action": "diaper", "minutes_ago": minutes_ago}
+        fid = await db.get_family_id(uid)
+        if fid and await db.check_recent_diaper_change(fid, 30):
+            conversation_state.set_state(uid, conversation_state.DUPLICATE_CONFIRMATION, {"action": "diaper", "minutes_ago": minutes_ago})
             return False, "⚠️ **Внимание!**\n\nСмена подгузника уже была записана в последние 30 минут.\n\nВы уверены, что хотите добавить еще одну смену?", [[Button.inline("✅ Да, добавить", b"confirm_duplicate"), Button.inline("❌ Отмена", b"cancel_duplicate")]]
         else:
             return False, "❌ Ошибка записи смены подгузника"
@@ -261,6 +241,11 @@ def format_time_message(hours, minutes, event_type):
         else:
             return f"🧷 **Последняя смена была:**\n**{time_str} назад**\n\n"
 
+def format_duration(total_minutes):
+    """Длительность в виде '1ч 20м' или '20м'"""
+    hours, minutes = divmod(int(total_minutes), 60)
+    return f"{hours}ч {minutes}м" if hours > 0 else f"{minutes}м"
+
 def calculate_next_time_message(hours, minutes, interval, event_type):
     """Вычисляет сообщение о времени до следующего события"""
     total_minutes_passed = hours * 60 + minutes
@@ -281,27 +266,29 @@ def calculate_next_time_message(hours, minutes, interval, event_type):
         return f"⏰ **До следующей смены:**\n**{next_time_str}**\n\n"
 
 
-init_supabase()
 scheduler = AsyncIOScheduler()
 
+@query_tracing.traced_job('keep_alive_ping')
 def keep_alive_ping():
-    """Функция для поддержания активности бота"""
+    """Проверка связи с Supabase (соединения держит пул supabase_transport)"""
+    import supabase_transport
     try:
-        print(f"💓 Keep-alive ping: {time.strftime('%H:%M:%S')}")
-        
-        # Проверяем подключение к Supabase
-        if test_connection():
-            print("✅ Supabase connection OK")
-        else:
-            print("❌ Supabase connection failed")
-            
+        if not test_connection():
+            print(f"❌ Supabase connection failed: {supabase_transport.get_transport_stats()['breaker']}")
     except Exception as e:
         print(f"❌ Keep-alive ping critical error: {e}")
 
 telegram_client = None
-reminder_queue: Deque[Dict[str, object]] = deque()
 
 notification_send_tracker: Dict[Tuple[int, str], Dict[str, object]] = {}
+# Проверки напоминаний запускаются из нескольких потоков (таймер, полная проверка, аренды,
+# пробуждение); они идут по очереди, чтобы две проверки не поставили семье одно напоминание дважды
+_sweep_lock = threading.Lock()
+REMINDER_RECONCILE_MINUTES = 30
+# Полная проверка берет только семьи со сроком события не позже чем через это время;
+# запас в два периода проверки, чтобы опоздавший запуск не оставил семью без расписания
+REMINDER_DUE_HORIZON_MINUTES = 2 * REMINDER_RECONCILE_MINUTES
+REMINDER_TIMER_RESOLUTION_SECONDS = 1
 MAX_NOTIFICATIONS_PER_EVENT = 2
 NOTIFICATION_SUPPRESSION_MINUTES = 1440  # ����� 24 ����, ����㢥�������� �������� ����� ������������
 
@@ -315,13 +302,15 @@ def get_event_group(notification_type: str) -> Optional[str]:
     return None
 
 
-def has_reached_local_limit(family_id: int, notification_type: str) -> bool:
+def has_reached_local_limit(family_id: int, notification_type: str, last_event: Optional[datetime]) -> bool:
     group = get_event_group(notification_type)
     if not group:
         return False
 
+    # Счетчик относится к последнему событию группы: новое кормление или смена
+    # подгузника сбрасывает его в любом воркере, даже если кнопку нажали в другом процессе
     state = notification_send_tracker.get((family_id, group))
-    if not state:
+    if not state or state['last_event'] != last_event:
         return False
 
     sent_types: Set[str] = state.get('sent_types', set())
@@ -331,13 +320,16 @@ def has_reached_local_limit(family_id: int, notification_type: str) -> bool:
     return len(sent_types) >= MAX_NOTIFICATIONS_PER_EVENT
 
 
-def mark_notification_sent_local(family_id: int, notification_type: str, timestamp: datetime):
+def mark_notification_sent_local(family_id: int, notification_type: str, timestamp: datetime,
+                                 last_event: Optional[datetime]):
     group = get_event_group(notification_type)
     if not group:
         return
 
     key = (family_id, group)
-    state = notification_send_tracker.setdefault(key, {'sent_types': set(), 'last_sent_at': None})
+    state = notification_send_tracker.get(key)
+    if not state or state['last_event'] != last_event:
+        state = notification_send_tracker[key] = {'sent_types': set(), 'last_sent_at': None, 'last_event': last_event}
     state['sent_types'].add(notification_type)
     state['last_sent_at'] = timestamp
 
@@ -352,8 +344,9 @@ REMINDER_BUTTONS = {
 
 REMINDER_SCENARIOS = {
     'due': {
-        'check': check_smart_reminder_conditions,  # Сразу по наступлению срока
-        'message': get_smart_reminder_message,
+        'check': evaluate_smart_reminder_conditions,  # Сразу по наступлению срока
+        'message': build_smart_reminder_message,
+        'offset_minutes': 0,
         'conditions': {
             'feeding': {
                 'flag': 'needs_feeding',
@@ -369,8 +362,9 @@ REMINDER_SCENARIOS = {
         },
     },
     'overdue': {
-        'check': check_overdue_reminder_conditions,
-        'message': get_overdue_reminder_message,
+        'check': evaluate_overdue_reminder_conditions,
+        'message': build_overdue_reminder_message,
+        'offset_minutes': 20,  # Через 20 минут после срока
         'conditions': {
             'feeding': {
                 'flag': 'needs_overdue_feeding',
@@ -388,89 +382,179 @@ REMINDER_SCENARIOS = {
 }
 
 
+# Моменты проверки относительно срока события (last_event + interval)
+REMINDER_FIRE_OFFSETS = [scenario['offset_minutes'] for scenario in REMINDER_SCENARIOS.values()]
+
+# Самый длинный период подавления: столько истории notification_tracking грузим за проход
+REMINDER_NOTIFICATION_WINDOW_MINUTES = max(
+    minutes
+    for scenario in REMINDER_SCENARIOS.values()
+    for rule in scenario['conditions'].values()
+    for _, minutes in rule['cooldowns']
+)
+
 
-def should_queue_notification(family_id: int, flag: bool, notification_type: str, cooldowns):
+def should_queue_notification(snapshot, family_id: int, flag: bool, notification_type: str, cooldowns,
+                              last_event: Optional[datetime]):
     if not flag:
         return False
 
-    if has_reached_local_limit(family_id, notification_type):
+    if has_reached_local_limit(family_id, notification_type, last_event):
         return False
 
     for cooldown_type, minutes in cooldowns:
-        if check_recent_notification(family_id, cooldown_type, minutes):
+        if has_recent_notification(snapshot, family_id, cooldown_type, minutes):
             return False
     return True
 
 
 def build_reminder_buttons(event_types):
-    return [
-        [Button.inline(REMINDER_BUTTONS[event][0], REMINDER_BUTTONS[event][1])]
-        for event in event_types
+    """Кнопки напоминания в виде [[(текст, данные)]] для сохранения в outbox"""
+    return [[REMINDER_BUTTONS[event]] for event in event_types]
+
+
+def build_delivery_key(family_id: int, user_id: int, scenario_name: str,
+                       triggered: List[Tuple[str, str]], last_events: Dict[str, Optional[datetime]]) -> str:
+    """Ключ доставки: одно напоминание сценария на пользователя для каждого последнего события"""
+    parts = []
+    for event_type, notification_type in triggered:
+        last_event = last_events.get(event_type)
+        parts.append(f"{notification_type}@{last_event.isoformat() if last_event else '-'}")
+    return f"{family_id}:{user_id}:{scenario_name}:{','.join(parts)}"
+
+
+def build_settings_screen(overview: Dict[str, object]) -> Tuple[str, list]:
+    """Текст и кнопки экрана настроек"""
+    settings = overview['settings']
+    today = overview['today']
+    
+    message = "⚙️ **Настройки и статистика:**\n\n"
+    
+    # Статистика за сегодня
+    message += "📊 **Статистика за сегодня:**\n"
+    message += f"🍼 Кормления: {today['feeding']} раз\n"
+    message += f"💩 Смены подгузников: {today['diaper']} раз\n"
+    message += f"🛁 Купания: {today['bath']} раз\n"
+    message += f"🎮 Активность: {today['activity']} раз\n"
+    
+    message += "\n⚙️ **Текущие настройки:**\n"
+    message += f"🍼 Интервал кормления: {overview['feed_interval']}ч\n"
+    message += f"💩 Интервал смены подгузника: {overview['diaper_interval']}ч\n\n"
+    
+    if settings:
+        message += f"💡 Советы: {'Включены' if settings.get('tips_enabled') else 'Выключены'}\n"
+        message += f"🛁 Напоминания о купании: {'Включены' if settings.get('bath_reminder_enabled') else 'Выключены'}\n"
+        message += f"🎮 Напоминания об активности: {'Включены' if settings.get('activity_reminder_enabled') else 'Выключены'}\n"
+        message += f"😴 Паузы напоминаний во время сна: {'Включены' if settings.get('sleep_monitoring_enabled', True) else 'Выключены'}\n"
+    
+    if overview['birth_date']:
+        message += f"📅 Дата рождения малыша: {overview['birth_date']}\n"
+    else:
+        message += f"📅 Дата рождения малыша: Не установлена\n"
+    
+    message += "\n🎯 **Что настроим?**"
+    
+    buttons = [
+        [Button.inline("🍼 Интервал кормления", b"settings_feeding"), Button.inline("💩 Интервал подгузников", b"settings_diaper")],
+        [Button.inline("💡 Советы", b"settings_tips"), Button.inline("🛁 Купание", b"settings_bath")],
+        [Button.inline("🎮 Активность", b"settings_activity"), Button.inline("⏰ Время уведомлений", b"settings_time")],
+        [Button.inline("📅 Дата рождения", b"settings_birth_date"), Button.inline("😴 Сон", b"settings_sleep")],
+        [Button.inline("🔙 Назад", b"back_to_main")]
     ]
+    return message, buttons
 
 
-def send_smart_reminders():
-    """Автоматические проверки расписаний для напоминаний"""
-    global telegram_client, reminder_queue
+@query_tracing.traced_job('reminder_sweep')
+def send_smart_reminders(family_ids: Optional[List[int]] = None):
+    """Проверка напоминаний для указанных семей (по умолчанию - для всех)"""
+    global telegram_client
 
     if not telegram_client:
         print("[Reminders] Telegram client not available; skipping run")
         return
 
+    with _sweep_lock:
+        _check_reminders(family_ids)
+
+
+def _check_reminders(family_ids: Optional[List[int]]):
+    sharding.verify_leases()
+    if family_ids is not None and sharding.is_sharded():
+        family_ids = sharding.filter_owned(family_ids)
+        if not family_ids:
+            return
+
     try:
-        families = get_all_families()
-        if not families:
+        # Семьи со сроком события рядом (по колонкам сроков в settings), члены семей
+        # и отправленные уведомления загружаются за постоянное число запросов, дальше проверка идет в памяти.
+        # При нескольких воркерах проверяются только семьи шардов этого воркера
+        snapshot = load_reminder_snapshot(family_ids, notification_window_minutes=REMINDER_NOTIFICATION_WINDOW_MINUTES,
+                                          family_filter=sharding.owns_family if sharding.is_sharded() else None,
+                                          due_within_minutes=REMINDER_DUE_HORIZON_MINUTES)
+        if not snapshot or not snapshot['settings']:
             return
 
         queued_entries = 0
-        dedup_keys = set()
+        now = snapshot['now']
 
-        for family_id in families:
+        for family_id, settings in snapshot['settings'].items():
             try:
+                # Пока малыш спит, напоминания о кормлении и подгузнике откладываются:
+                # после пробуждения семья сразу проверяется заново (wake_up, check_woken_families)
+                if is_sleep_paused(snapshot, family_id):
+                    reminder_scheduler.unschedule_family(family_id)
+                    continue
+
+                last_feeding = snapshot['last_feeding'].get(family_id)
+                last_diaper = snapshot['last_diaper'].get(family_id)
+                last_events = {'feeding': last_feeding, 'diaper': last_diaper}
+                reminder_scheduler.schedule_family(family_id, reminder_scheduler.compute_fire_times(
+                    settings, last_feeding, last_diaper, REMINDER_FIRE_OFFSETS, now
+                ))
+
                 for scenario_name, scenario in REMINDER_SCENARIOS.items():
-                    conditions = scenario['check'](family_id) or {}
+                    conditions = scenario['check'](settings, last_feeding, last_diaper, now) or {}
                     triggered = []
 
                     for event_type, rule in scenario['conditions'].items():
                         flag = conditions.get(rule['flag'])
-                        if should_queue_notification(family_id, flag, rule['notification_type'], rule['cooldowns']):
+                        if should_queue_notification(snapshot, family_id, flag, rule['notification_type'], rule['cooldowns'],
+                                                     last_events[event_type]):
                             triggered.append((event_type, rule['notification_type']))
 
                     if not triggered:
                         continue
 
-                    message = scenario['message'](family_id)
+                    message = scenario['message'](conditions)
                     if not message:
                         continue
 
-                    members = get_family_members_for_notification(family_id)
+                    members = snapshot['members'].get(family_id)
                     if not members:
                         continue
 
                     event_types = [event for event, _ in triggered]
                     buttons = build_reminder_buttons(event_types)
-                    notification_types = [notification_type for _, notification_type in triggered]
-                    timestamp = get_thai_time()
-
-                    for user_id in members:
-                        dedup_key = (family_id, user_id, scenario_name, tuple(notification_types))
-                        if dedup_key in dedup_keys:
-                            continue
+                    timestamp = timeutils.utc_now()
 
-                        reminder_queue.append({
+                    # Напоминание сохраняется в outbox до отметки об отправке,
+                    # поэтому перезапуск бота между этими шагами его не теряет
+                    queued_entries += reminder_outbox.enqueue(
+                        {
+                            'delivery_key': build_delivery_key(family_id, user_id, scenario_name, triggered, last_events),
                             'user_id': user_id,
                             'message': message,
                             'buttons': buttons,
                             'family_id': family_id,
-                        })
-                        dedup_keys.add(dedup_key)
-                        queued_entries += 1
-
-                    for notification_type in notification_types:
-                        success = log_notification_sent(family_id, notification_type, timestamp)
-                        if not success:
-                            print(f"[Notifications] Failed to log notification {notification_type} for family {family_id}")
-                        mark_notification_sent_local(family_id, notification_type, timestamp)
+                        }
+                        for user_id in dict.fromkeys(members)
+                    )
+
+                    # Отметки копятся в буфере и записываются одной вставкой в конце прохода
+                    for event_type, notification_type in triggered:
+                        log_notification_sent(family_id, notification_type, timestamp, buffered=True)
+                        mark_notification_sent_local(family_id, notification_type, timestamp, last_events[event_type])
+                        remember_notification_sent(snapshot, family_id, notification_type, timestamp)
             except Exception as family_error:
                 print(f"[Reminders] Failed to process family {family_id}: {family_error}")
                 continue
@@ -479,55 +563,55 @@ def send_smart_reminders():
             print(f"[Reminders] Reminders queued: {queued_entries}")
     except Exception as error:
         print(f"[Reminders] Critical error: {error}")
+    finally:
+        flush_notification_log()
 
 
-async def send_reminder_message(user_id: int, message: str, buttons: list):
-    """Асинхронная отправка сообщения напоминания"""
-    global telegram_client
-
-    if not telegram_client:
+async def reschedule_family_reminders(family_id: int):
+    """Пересчитать моменты напоминаний семьи после записи события или смены интервала"""
+    # Семьи чужого шарда перепроверит их воркер: по старому расписанию или при полной проверке
+    if not sharding.owns_family(family_id):
         return
-
-    try:
-        await telegram_client.send_message(user_id, message, buttons=buttons)
-    except Exception as e:
-        print(f"[Reminders] Failed to send reminder to user {user_id}: {e}")
-
-
-async def process_reminder_queue():
-    """Обработка очереди напоминаний"""
-    global reminder_queue, telegram_client
-
-    if not telegram_client or not reminder_queue:
+    state = await db.get_family_state(family_id)
+    if not state or not state['settings']:
         return
+    reminder_scheduler.schedule_family(family_id, reminder_scheduler.compute_fire_times(
+        state['settings'],
+        state['last_events']['feeding'],
+        state['last_events']['diaper'],
+        REMINDER_FIRE_OFFSETS,
+        timeutils.utc_now()
+    ))
 
-    queue_size = len(reminder_queue)
-    print(f"[Reminders] Delivering {queue_size} queued message(s)")
 
-    while reminder_queue:
-        reminder = reminder_queue.popleft()
-        try:
-            await send_reminder_message(
-                reminder['user_id'],
-                reminder['message'],
-                reminder['buttons']
-            )
-            print(f"[Reminders] Delivered reminder to user {reminder['user_id']}")
-        except Exception as e:
-            print(f"[Reminders] Failed to deliver reminder to user {reminder['user_id']}: {e}")
+async def run_reminder_timer():
+    """Проверяет семьи точно в момент наступления их напоминаний"""
+    loop = asyncio.get_running_loop()
+    while True:
+        due_families = reminder_scheduler.pop_due_families()
+        if due_families:
+            await loop.run_in_executor(None, send_smart_reminders, due_families)
+        await asyncio.sleep(REMINDER_TIMER_RESOLUTION_SECONDS)
 
 
 scheduler.add_job(keep_alive_ping, 'interval', minutes=5, id='keep_alive_ping')
 print("⏰ Keep-alive ping scheduled every 5 minutes")
 
-scheduler.add_job(send_smart_reminders, 'interval', minutes=5, id='smart_reminders')
-print("⏰ Smart reminders scheduled every 5 minutes")
+# Напоминания срабатывают по таймеру семьи (run_reminder_timer); полная проверка
+# при запуске заполняет расписание и затем подхватывает изменения в обход бота
+scheduler.add_job(send_smart_reminders, 'interval', minutes=REMINDER_RECONCILE_MINUTES, id='smart_reminders',
+                  next_run_time=datetime.now())
+print(f"⏰ Smart reminders reconciled every {REMINDER_RECONCILE_MINUTES} minutes")
 
+@query_tracing.traced_job('cleanup_notifications')
 def cleanup_notifications():
     """Очистка старых уведомлений"""
     try:
         print(f"[Notifications] Cleaning up old notifications at {time.strftime('%H:%M:%S')}")
-        cleanup_old_notifications(7)
+        # notification_tracking общая для всех воркеров - ее чистит держатель аренды
+        if sharding.is_leader(sharding.CLEANUP_LEASE):
+            cleanup_old_notifications(7)
+        reminder_outbox.purge_finished()
         print("[Notifications] Old notifications cleaned up")
     except Exception as e:
         print(f"[Notifications] Cleanup failed: {e}")
@@ -535,26 +619,627 @@ def cleanup_notifications():
 scheduler.add_job(cleanup_notifications, 'interval', hours=24, id='cleanup_notifications')
 print("⏰ Notification cleanup scheduled every 24 hours")
 
-family_creation_pending = {}
-manual_feeding_pending = {}
-join_pending = {}
-edit_pending = {}
-edit_role_pending = {}
-bath_pending = {}
-activity_pending = {}
-baby_birth_pending = {}
-custom_time_pending = {}
-duplicate_confirmation_pending = {}  # Для подтверждения дубликатов
+# Совет дня и напоминание о купании: в начале каждой минуты - семьи, у которых по местному времени наступил их момент
+scheduler.add_job(daily_digest.send_due_digests, 'cron', second=0, id='daily_digests')
+print("⏰ Daily tips and bath reminders checked every minute")
+
+def renew_shard_leases():
+    """Продлить аренды шардов; по взятым шардам остановившегося воркера сразу запускается проверка"""
+    if sharding.renew_leases():
+        send_smart_reminders()
+
+# Пробуждение отмечает воркер, принимающий сообщения, а таймеры спящей семьи сняты у
+# владельца ее шарда: владелец узнает о пробуждении по sleep_sessions.end_time
+WAKE_POLL_SECONDS = 15
+_last_wake_poll: Optional[datetime] = None
+
+@query_tracing.traced_job('wake_poll')
+def check_woken_families():
+    """Сразу проверить напоминания семей своих шардов, малыш которых недавно проснулся"""
+    global _last_wake_poll
+    now = timeutils.utc_now()
+    # Окно с запасом на расхождение часов воркеров; повторная проверка семьи не дублирует напоминания
+    since = (_last_wake_poll or now) - timedelta(seconds=WAKE_POLL_SECONDS)
+    family_ids = get_woken_families(since)
+    if family_ids is None:
+        return
+    _last_wake_poll = now
+    owned = sharding.filter_owned(family_ids)
+    if owned:
+        send_smart_reminders(owned)
+
+if sharding.is_sharded():
+    scheduler.add_job(renew_shard_leases, 'interval', seconds=sharding.LEASE_RENEW_SECONDS, id='renew_shard_leases')
+    print(f"⏰ Worker {sharding.WORKER_INDEX}/{sharding.WORKER_COUNT}: shard leases renewed every "
+          f"{sharding.LEASE_RENEW_SECONDS} seconds")
+    scheduler.add_job(check_woken_families, 'interval', seconds=WAKE_POLL_SECONDS, id='wake_poll')
+    print(f"⏰ Woken babies checked every {WAKE_POLL_SECONDS} seconds")
+
+# Каталог советов загружается при запуске и периодически обновляется
+scheduler.add_job(tips_catalog.refresh, 'interval', hours=tips_catalog.TIPS_REFRESH_HOURS, id='refresh_tips',
+                  next_run_time=datetime.now())
+print(f"⏰ Tips catalog refreshed every {tips_catalog.TIPS_REFRESH_HOURS} hours")
+
+# Сводка по самым дорогим запросам к БД
+scheduler.add_job(query_tracing.log_summary, 'interval', minutes=query_tracing.METRICS_LOG_MINUTES, id='query_metrics')
+print(f"⏰ Query metrics logged every {query_tracing.METRICS_LOG_MINUTES} minutes")
+
+# Каждые 10 минут удаляются брошенные сценарии (ввод семьи, времени, даты)
+scheduler.add_job(conversation_state.purge_expired, 'interval', minutes=10, id='purge_conversation_state')
+print("⏰ Conversation state cleanup scheduled every 10 minutes")
+
+# Локальная копия таблиц догружает изменения из Supabase
+if local_mirror.is_enabled():
+    scheduler.add_job(local_mirror.sync, 'interval', seconds=local_mirror.MIRROR_SYNC_SECONDS, id='local_mirror_sync')
+    print(f"⏰ Local mirror synced every {local_mirror.MIRROR_SYNC_SECONDS} seconds")
+
+# Кнопки (callback) и текстовые кнопки разбираются таблицами маршрутов: поиск по словарю
+# вместо цепочки сравнений, а семья для маршрутов с family=True определяется один раз
+callback_routes = event_router.Router(event_router.callback_key, resolve_family=db.get_family_id)
+text_routes = event_router.Router(event_router.text_key, resolve_family=db.get_family_id)
+
+MAIN_MENU_BUTTONS = [
+    [Button.text("🍼 Кормление"), Button.text("💩 Смена подгузника")],
+    [Button.text("😴 Сон"), Button.text("💡 Советы"), Button.text("⚙️ Настройки")]
+]
+
+CUSTOM_TIME_PROMPTS = {
+    "feeding": "🕐 **Укажите время кормления**\n\nВведите время в формате:\n• **15** (15 минут назад)\n• **1:30** (1 час 30 минут назад)\n• **2ч** (2 часа назад)",
+    "diaper": "🕐 **Укажите время смены подгузника**\n\nВведите время в формате:\n• **15** (15 минут назад)\n• **1:30** (1 час 30 минут назад)\n• **2ч** (2 часа назад)",
+    "tips_time": "💡 **Настройка времени советов**\n\nВведите время в формате:\n• **9:00** (9 часов 0 минут)\n• **14:30** (14 часов 30 минут)\n• **21** (21 час 0 минут)",
+    "bath_time": "🛁 **Настройка времени купания**\n\nВведите время в формате:\n• **19:00** (19 часов 0 минут)\n• **20:30** (20 часов 30 минут)\n• **21** (21 час 0 минут)",
+}
+
+# Переключатели уведомлений: вид -> (колонка настроек, заголовок экрана, сообщения вкл/выкл)
+NOTIFICATION_TOGGLES = {
+    "tips": ("tips_enabled", "💡 **Советы:**", "✅ Советы включены!", "✅ Советы выключены!"),
+    "bath": ("bath_reminder_enabled", "🛁 **Напоминания о купании:**",
+             "✅ Напоминания о купании включены!", "✅ Напоминания о купании выключены!"),
+    "activity": ("activity_reminder_enabled", "🎮 **Напоминания об активности:**",
+                 "✅ Напоминания об активности включены!", "✅ Напоминания об активности выключены!"),
+    "sleep": ("sleep_monitoring_enabled", "😴 **Паузы напоминаний во время сна:**",
+              "✅ Во время сна напоминания о кормлении и подгузнике будут ждать пробуждения!",
+              "✅ Напоминания о кормлении и подгузнике будут приходить и во время сна!"),
+}
+
+SLEEP_PAUSE_NOTE = "🔕 Напоминания о кормлении и подгузнике придут, когда малыш проснется"
+
+TOGGLE_STATES = {"on": True, "off": False}
+
+
+async def show_record_result(send, result):
+    """Показать результат записи кормления или смены подгузника (с кнопками подтверждения дубликата)"""
+    success, message, *buttons = result
+    await send(message, buttons=buttons[0] if buttons else None)
+
+
+@callback_routes.route("feed_now", value=0)
+@callback_routes.route("feed_15min", value=15)
+@callback_routes.route("feed_30min", value=30)
+async def feed_callback(event, update):
+    await show_record_result(event.edit, await handle_feeding_callback(event, update.payload))
+
+
+@callback_routes.route("diaper_now", value=0)
+@callback_routes.route("diaper_15min", value=15)
+@callback_routes.route("diaper_30min", value=30)
+async def diaper_callback(event, update):
+    await show_record_result(event.edit, await handle_diaper_callback(event, update.payload))
+
+
+@callback_routes.route("sleep_now", value=0, family=True)
+@callback_routes.route("sleep_15min", value=15, family=True)
+@callback_routes.route("sleep_30min", value=30, family=True)
+async def sleep_callback(event, update):
+    if not update.fid:
+        await event.edit("❌ Вы не состоите в семье")
+        return
+    if await db.start_sleep(update.uid, update.payload):
+        settings = await db.get_notification_settings(update.fid)
+        message = "😴 **Малыш уснул!** Сладких снов 🌙"
+        if settings.get('sleep_monitoring_enabled', True):
+            message += f"\n\n{SLEEP_PAUSE_NOTE}"
+        await event.edit(message, buttons=[[Button.inline("☀️ Проснулся", b"wake_up")]])
+    elif await db.get_sleep_start_time(update.fid):
+        await event.edit("⚠️ Малыш уже спит", buttons=[[Button.inline("☀️ Проснулся", b"wake_up")]])
+    else:
+        await event.edit("❌ Ошибка записи сна")
+
+
+@callback_routes.route("wake_up", family=True)
+async def wake_up(event, update):
+    duration = await db.stop_sleep(update.fid) if update.fid else None
+    if duration is None:
+        await event.edit("❌ Открытый сон не найден")
+        return
+    await event.edit(f"☀️ **Малыш проснулся!**\n😴 Спал {format_duration(duration)}")
+    # Отложенные на время сна напоминания отправляются сразу после пробуждения
+    await reschedule_family_reminders(update.fid)
+    await asyncio.get_running_loop().run_in_executor(None, send_smart_reminders, [update.fid])
+
+
+@callback_routes.route("confirm_duplicate")
+async def confirm_duplicate(event, update):
+    uid = update.uid
+    pending = conversation_state.pop_state(uid, conversation_state.DUPLICATE_CONFIRMATION)
+    if pending is None:
+        await event.edit("❌ Ошибка: данные подтверждения не найдены")
+        return
+    pending_data = pending[1]
+    action = pending_data["action"]
+    minutes_ago = pending_data["minutes_ago"]
+
+    if action == "feeding":
+        if await db.add_feeding(uid, minutes_ago, force=True):
+            fid = await db.get_family_id(uid)
+            if fid:
+                await acknowledge_feeding_notifications(fid)
+                await reschedule_family_reminders(fid)
+            await event.edit("✅ Кормление записано!")
+        else:
+            await event.edit("❌ Ошибка записи кормления")
+    elif action == "diaper":
+        if await db.add_diaper_change(uid, minutes_ago, force=True):
+            fid = await db.get_family_id(uid)
+            if fid:
+                await acknowledge_diaper_notifications(fid)
+                await reschedule_family_reminders(fid)
+            await event.edit("✅ Смена подгузника записана!")
+        else:
+            await event.edit("❌ Ошибка записи смены подгузника")
+
+
+@callback_routes.route("cancel_duplicate")
+async def cancel_duplicate(event, update):
+    if conversation_state.pop_state(update.uid, conversation_state.DUPLICATE_CONFIRMATION) is not None:
+        await event.edit("❌ Операция отменена")
+    else:
+        await event.edit("❌ Ошибка: данные подтверждения не найдены")
+
+
+@callback_routes.route("back_to_main", family=True)
+async def back_to_main(event, update):
+    if update.fid:
+        family_name = await db.get_family_name(update.fid)
+        role, name = await db.get_member_info(update.uid)
+        message = (
+            f"👶 **BabyCareBot**\n\n"
+            f"🏠 **Семья:** {family_name}\n"
+            f"👤 **Роль:** {role} {name}\n\n"
+            f"🎯 **Что делаем?**"
+        )
+    else:
+        message = (
+            f"👶 **BabyCareBot**\n\n"
+            f"🎯 **Что делаем?**"
+        )
+    await event.edit(message, buttons=MAIN_MENU_BUTTONS)
+
+
+# Кнопки "Указать время" и настройки времени уведомлений ждут ввода текста
+@callback_routes.route("feed_custom_time", value="feeding")
+@callback_routes.route("diaper_custom_time", value="diaper")
+@callback_routes.route("set_tips_time", value="tips_time")
+@callback_routes.route("set_bath_time", value="bath_time")
+async def ask_custom_time(event, update):
+    conversation_state.set_state(update.uid, conversation_state.CUSTOM_TIME, update.payload)
+    await event.edit(CUSTOM_TIME_PROMPTS[update.payload])
+
+
+@callback_routes.route("settings_feeding", family=True)
+async def settings_feeding(event, update):
+    if not update.fid:
+        await event.edit("❌ Ошибка получения настроек")
+        return
+    intervals = await db.get_user_intervals(update.fid)
+    current_interval = intervals[0] if intervals else 3
+
+    message = f"🍼 **Интервал кормления:** {current_interval} часов\n\nВыберите новый интервал:"
+    buttons = [
+        [Button.inline("3 часа", b"set_feed_3"), Button.inline("4 часа", b"set_feed_4")],
+        [Button.inline("5 часов", b"set_feed_5"), Button.inline("6 часов", b"set_feed_6")],
+        [Button.inline("🔙 Назад к настройкам", b"back_to_settings")]
+    ]
+    await event.edit(message, buttons=buttons)
+
+
+@callback_routes.route("settings_diaper", family=True)
+async def settings_diaper(event, update):
+    if not update.fid:
+        await event.edit("❌ Ошибка получения настроек")
+        return
+    intervals = await db.get_user_intervals(update.fid)
+    current_interval = intervals[1] if intervals else 2
+
+    message = f"💩 **Интервал смены подгузника:** {current_interval} часов\n\nВыберите новый интервал:"
+    buttons = [
+        [Button.inline("2 часа", b"set_diaper_2"), Button.inline("3 часа", b"set_diaper_3")],
+        [Button.inline("4 часа", b"set_diaper_4"), Button.inline("5 часов", b"set_diaper_5")],
+        [Button.inline("🔙 Назад к настройкам", b"back_to_settings")]
+    ]
+    await event.edit(message, buttons=buttons)
+
+
+@callback_routes.route("settings_tips", value="tips", family=True)
+@callback_routes.route("settings_bath", value="bath", family=True)
+@callback_routes.route("settings_activity", value="activity", family=True)
+@callback_routes.route("settings_sleep", value="sleep", family=True)
+async def settings_toggle_screen(event, update):
+    if not update.fid:
+        await event.edit("❌ Ошибка получения настроек")
+        return
+    column, title, _, _ = NOTIFICATION_TOGGLES[update.payload]
+    settings = await db.get_notification_settings(update.fid)
+    enabled = settings.get(column, True) if settings else True
+
+    message = f"{title} {'Включены' if enabled else 'Выключены'}\n\n🎯 **Что делаем?**"
+    buttons = [
+        [Button.inline("✅ Включить", f"toggle_{update.payload}_on".encode()),
+         Button.inline("❌ Выключить", f"toggle_{update.payload}_off".encode())],
+        [Button.inline("🔙 Назад к настройкам", b"back_to_settings")]
+    ]
+    await event.edit(message, buttons=buttons)
+
+
+@callback_routes.route("settings_time", family=True)
+async def settings_time(event, update):
+    if not update.fid:
+        await event.edit("❌ Ошибка получения настроек")
+        return
+    settings = await db.get_notification_settings(update.fid)
+    tips_hour = settings.get('tips_time_hour', 9)
+    tips_minute = settings.get('tips_time_minute', 0)
+    bath_hour = settings.get('bath_reminder_hour', 19)
+    bath_minute = settings.get('bath_reminder_minute', 0)
+    activity_interval = settings.get('activity_reminder_interval', 2)
+    timezone_name = settings.get('timezone') or timeutils.DEFAULT_TIMEZONE
+
+    message = f"⏰ **Настройки времени уведомлений:**\n\n"
+    message += f"💡 **Советы:** {tips_hour:02d}:{tips_minute:02d}\n"
+    message += f"🛁 **Купание:** {bath_hour:02d}:{bath_minute:02d}\n"
+    message += f"🎮 **Активность:** каждые {activity_interval}ч\n"
+    message += f"🌍 **Часовой пояс:** {timezone_name}\n\n"
+    message += f"🎯 **Что настроим?**"
+
+    buttons = [
+        [Button.inline("💡 Время советов", b"set_tips_time"), Button.inline("🛁 Время купания", b"set_bath_time")],
+        [Button.inline("🎮 Интервал активности", b"set_activity_interval"), Button.inline("🌍 Часовой пояс", b"set_timezone")],
+        [Button.inline("🔙 Назад к настройкам", b"back_to_settings")]
+    ]
+    await event.edit(message, buttons=buttons)
+
+
+@callback_routes.route("settings_birth_date", family=True)
+async def settings_birth_date(event, update):
+    if not update.fid:
+        await event.edit("❌ Ошибка получения настроек")
+        return
+    birth_date = await db.get_birth_date(update.fid)
+
+    message = f"📅 **Настройка даты рождения малыша:**\n\n"
+    if birth_date:
+        message += f"📅 **Текущая дата:** {birth_date}\n\n"
+    else:
+        message += f"📅 **Дата не установлена**\n\n"
+    message += f"🎯 **Что делаем?**"
+
+    buttons = [
+        [Button.inline("📅 Установить дату", b"set_birth_date")],
+        [Button.inline("🔙 Назад к настройкам", b"back_to_settings")]
+    ]
+    await event.edit(message, buttons=buttons)
+
+
+@callback_routes.route("set_feed_", prefix=True, parse=int, family=True)
+async def set_feed_interval(event, update):
+    if update.fid and await db.set_user_interval(update.fid, update.payload, None):
+        await reschedule_family_reminders(update.fid)
+        await event.edit(f"✅ Интервал кормления изменен на {update.payload} часов!")
+    else:
+        await event.edit("❌ Ошибка изменения интервала")
+
+
+@callback_routes.route("set_diaper_", prefix=True, parse=int, family=True)
+async def set_diaper_interval(event, update):
+    if update.fid and await db.set_user_interval(update.fid, None, update.payload):
+        await reschedule_family_reminders(update.fid)
+        await event.edit(f"✅ Интервал смены подгузника изменен на {update.payload} часов!")
+    else:
+        await event.edit("❌ Ошибка изменения интервала")
+
+
+@callback_routes.route("set_activity_", prefix=True, parse=int, family=True)
+async def set_activity_interval(event, update):
+    if update.fid and await db.update_notification_settings(update.fid, {"activity_reminder_interval": update.payload}):
+        await event.edit(f"✅ Интервал активности изменен на {update.payload} часов!")
+    else:
+        await event.edit("❌ Ошибка изменения интервала")
+
+
+@callback_routes.route("set_activity_interval", family=True)
+async def activity_interval_screen(event, update):
+    if not update.fid:
+        await event.edit("❌ Ошибка получения настроек")
+        return
+    settings = await db.get_notification_settings(update.fid)
+    current_interval = settings.get('activity_reminder_interval', 2)
+
+    message = f"🎮 **Интервал напоминаний об активности:** {current_interval} часов\n\nВыберите новый интервал:"
+    buttons = [
+        [Button.inline("1 час", b"set_activity_1"), Button.inline("2 часа", b"set_activity_2")],
+        [Button.inline("3 часа", b"set_activity_3"), Button.inline("4 часа", b"set_activity_4")],
+        [Button.inline("🔙 Назад к времени", b"settings_time")]
+    ]
+    await event.edit(message, buttons=buttons)
+
+
+@callback_routes.route("set_timezone")
+async def ask_timezone(event, update):
+    conversation_state.set_state(update.uid, conversation_state.TIMEZONE)
+    await event.edit("🌍 **Часовой пояс семьи**\n\nВведите название часового пояса, например:\n• **Asia/Bangkok**\n• **Europe/Moscow**\n• **America/New_York**")
+
+
+@callback_routes.route("set_birth_date")
+async def ask_birth_date(event, update):
+    conversation_state.set_state(update.uid, conversation_state.BIRTH_DATE)
+    await event.edit("📅 **Установка даты рождения малыша**\n\nВведите дату в формате:\n• **2024-01-15** (15 января 2024)\n• **15.01.2024** (15 января 2024)\n• **15/01/2024** (15 января 2024)")
+
+
+@callback_routes.route("toggle_tips_", prefix=True, parse=TOGGLE_STATES.__getitem__, family=True)
+@callback_routes.route("toggle_bath_", prefix=True, parse=TOGGLE_STATES.__getitem__, family=True)
+@callback_routes.route("toggle_activity_", prefix=True, parse=TOGGLE_STATES.__getitem__, family=True)
+@callback_routes.route("toggle_sleep_", prefix=True, parse=TOGGLE_STATES.__getitem__, family=True)
+async def toggle_notifications(event, update):
+    kind = update.key.split("_")[1]
+    column, _, enabled_message, disabled_message = NOTIFICATION_TOGGLES[kind]
+    if update.fid and await db.update_notification_settings(update.fid, {column: update.payload}):
+        await event.edit(enabled_message if update.payload else disabled_message)
+    else:
+        await event.edit("❌ Ошибка изменения настроек")
+
+
+@callback_routes.route("check_reminders", family=True)
+async def check_reminders(event, update):
+    fid = update.fid
+    if not fid:
+        await event.edit("❌ Ошибка получения напоминаний")
+        return
+    conditions = await db.check_smart_reminder_conditions(fid)
+
+    if not conditions['needs_feeding'] and not conditions['needs_diaper']:
+        message = "✅ **Все в порядке!**\n\n"
+        message += "🍼 Кормление и смена подгузника по расписанию\n"
+        message += "💡 Напоминания работают в фоновом режиме"
+        buttons = [
+            [Button.inline("🔄 Проверить снова", b"check_reminders")]
+        ]
+    else:
+        message = await db.get_smart_reminder_message(fid)
+        if not message:
+            message = "❌ Ошибка получения напоминаний"
+            buttons = []
+        else:
+            # Кнопки быстрых действий
+            buttons = []
+            if conditions['needs_feeding']:
+                buttons.append([Button.inline("🍼 Отметить кормление", b"feed_now")])
+            if conditions['needs_diaper']:
+                buttons.append([Button.inline("💩 Смена подгузника", b"diaper_now")])
+            buttons.append([Button.inline("🔄 Проверить снова", b"check_reminders")])
+
+    await event.edit(message, buttons=buttons)
+
+
+@callback_routes.route("back_to_settings", family=True)
+async def back_to_settings(event, update):
+    overview = await db.get_settings_overview(update.fid) if update.fid else None
+    if not overview:
+        await event.edit("❌ Ошибка получения настроек")
+        return
+    message, buttons = build_settings_screen(overview)
+    await event.edit(message, buttons=buttons)
+
+
+@text_routes.route("😴 Сон", family=True)
+async def sleep_menu(event, update):
+    if not update.fid:
+        await event.respond("❌ Вы не состоите в семье. Сначала создайте семью или присоединитесь к существующей.")
+        return
+    sleep_start = await db.get_sleep_start_time(update.fid)
+    if sleep_start:
+        slept_minutes = (timeutils.utc_now() - sleep_start).total_seconds() // 60
+        message = f"😴 **Малыш спит**\n**{format_duration(slept_minutes)}**\n\n"
+        settings = await db.get_notification_settings(update.fid)
+        if settings.get('sleep_monitoring_enabled', True):
+            message += f"{SLEEP_PAUSE_NOTE}\n\n"
+        message += "☀️ **Отметить пробуждение:**"
+        buttons = [[Button.inline("☀️ Проснулся", b"wake_up")]]
+    else:
+        message = "😴 **Малыш не спит**\n\n😴 **Отметить, когда уснул:**"
+        buttons = [
+            [Button.inline("✅ Сейчас", b"sleep_now"), Button.inline("⏰ 15 мин назад", b"sleep_15min")],
+            [Button.inline("⏰ 30 мин назад", b"sleep_30min")]
+        ]
+    await event.respond(message, buttons=buttons)
+
+
+@text_routes.route("👨‍👩‍👧 Создать семью")
+async def ask_family_name(event, update):
+    conversation_state.set_state(update.uid, conversation_state.FAMILY_NAME)
+    await event.respond("👨‍👩‍👧 Введите название новой семьи:")
+
+
+@text_routes.route("🔗 Присоединиться")
+async def ask_family_code(event, update):
+    conversation_state.set_state(update.uid, conversation_state.FAMILY_CODE)
+    await event.respond("🔗 Введите код семьи (ID семьи):")
+
+
+@text_routes.route("💡 Совет", family=True)
+async def random_tip(event, update):
+    if not update.fid:
+        await event.respond("❌ Вы не состоите в семье")
+        return
+    age_months = await db.get_baby_age_months(update.fid)
+    tip = await db.get_random_tip(age_months)
+    if tip:
+        await event.respond(f"💡 **Совет для {age_months} месяцев:**\n\n{tip}")
+    else:
+        await event.respond("💡 Советов для вашего возраста пока нет")
+
+
+@text_routes.route("⚙ Настройки", family=True)
+async def text_settings_menu(event, update):
+    if not update.fid:
+        await event.respond("❌ Вы не состоите в семье")
+        return
+    message = "⚙️ **Настройки**\n\n🎯 **Что настроим?**"
+    buttons = [
+        [Button.text("🍼 Интервалы кормления"), Button.text("🧷 Интервалы подгузников")],
+        [Button.text("👤 Моя роль"), Button.text("📅 Дата рождения")],
+        [Button.text("🔙 Назад")]
+    ]
+    await event.respond(message, buttons=buttons)
+
+
+@text_routes.route("👨‍👩‍👧 Семья", family=True)
+async def family_info(event, update):
+    fid = update.fid
+    if not fid:
+        await event.respond("❌ Вы не состоите в семье")
+        return
+    family_name = await db.get_family_name(fid)
+    members = await db.get_family_members_with_roles(fid)
+
+    message = f"👨‍👩‍👧 **Семья: {family_name}**\n\n"
+    message += f"👥 **Члены семьи:**\n"
+    for user_id, role, name in members:
+        if user_id == update.uid:
+            message += f"• {role} {name} (вы)\n"
+        else:
+            message += f"• {role} {name}\n"
+    message += f"\n🔑 **ID семьи:** {fid}\n"
+    message += f"Поделитесь этим ID с другими членами семьи"
+
+    buttons = [[Button.text("🔙 Назад")]]
+    await event.respond(message, buttons=buttons)
+
+
+async def enter_family_name(event, uid, text, data):
+    family_id = await db.create_family(text, uid)
+    if family_id:
+        conversation_state.clear_state(uid)
+        await event.respond(f"✅ Семья '{text}' создана! ID семьи: {family_id}")
+    else:
+        await event.respond("❌ Ошибка создания семьи")
+
+
+async def enter_family_code(event, uid, text, data):
+    family_id, family_name = await db.join_family_by_code(text, uid)
+    if family_id:
+        conversation_state.clear_state(uid)
+        await event.respond(f"✅ Вы присоединились к семье '{family_name}'!")
+    else:
+        await event.respond(f"❌ {family_name}")
+
+
+async def enter_custom_time(event, uid, text, action):
+    conversation_state.clear_state(uid)
+
+    if action in ["feeding", "diaper"]:
+        minutes_ago = parse_time_input(text)
+        if minutes_ago is None:
+            await event.respond("❌ Неверный формат времени. Попробуйте снова.")
+            return
+        if action == "feeding":
+            await show_record_result(event.respond, await handle_feeding_callback(event, minutes_ago))
+        else:
+            await show_record_result(event.respond, await handle_diaper_callback(event, minutes_ago))
+
+    elif action in ["tips_time", "bath_time"]:
+        time_tuple = parse_time_setting(text)
+        if time_tuple is None:
+            await event.respond("❌ Неверный формат времени. Попробуйте снова.")
+            return
+
+        hours, minutes = time_tuple
+        fid = await db.get_family_id(uid)
+        if action == "tips_time":
+            if fid and await db.update_notification_settings(fid, {"tips_time_hour": hours, "tips_time_minute": minutes}):
+                await event.respond(f"✅ Время советов изменено на {hours:02d}:{minutes:02d}!")
+            else:
+                await event.respond("❌ Ошибка изменения времени")
+        else:
+            if fid and await db.update_notification_settings(fid, {"bath_reminder_hour": hours, "bath_reminder_minute": minutes}):
+                await event.respond(f"✅ Время купания изменено на {hours:02d}:{minutes:02d}!")
+            else:
+                await event.respond("❌ Ошибка изменения времени")
+
+
+async def enter_birth_date(event, uid, text, data):
+    conversation_state.clear_state(uid)
+
+    birth_date = parse_birth_date(text)
+    if birth_date is None:
+        await event.respond("❌ Неверный формат даты. Попробуйте снова.\n\nИспользуйте формат:\n• **2024-01-15**\n• **15.01.2024**\n• **15/01/2024**")
+        return
+
+    fid = await db.get_family_id(uid)
+    if fid and await db.set_birth_date(fid, birth_date):
+        await event.respond(f"✅ Дата рождения установлена: {birth_date}")
+    else:
+        await event.respond("❌ Ошибка установки даты рождения")
+
+
+async def enter_timezone(event, uid, text, data):
+    conversation_state.clear_state(uid)
+
+    timezone_name = text.strip()
+    if not timeutils.is_valid_timezone(timezone_name):
+        await event.respond("❌ Неизвестный часовой пояс. Попробуйте снова.\n\nИспользуйте формат **Регион/Город**, например **Europe/Moscow**")
+        return
+
+    fid = await db.get_family_id(uid)
+    if fid and await db.set_family_timezone(fid, timezone_name):
+        await event.respond(f"✅ Часовой пояс изменен на {timezone_name}!")
+    else:
+        await event.respond("❌ Ошибка изменения часового пояса")
+
+
+# Обработчики текста для состояний диалога (conversation_state)
+TEXT_STATE_HANDLERS = {
+    conversation_state.FAMILY_NAME: enter_family_name,
+    conversation_state.FAMILY_CODE: enter_family_code,
+    conversation_state.CUSTOM_TIME: enter_custom_time,
+    conversation_state.BIRTH_DATE: enter_birth_date,
+    conversation_state.TIMEZONE: enter_timezone,
+}
+
+
+def prepare_database() -> bool:
+    """Подготовка БД при запуске: подключение к Supabase, аренды шардов, локальная копия"""
+    connected = init_supabase()
+    sharding.renew_leases()
+    if local_mirror.is_enabled():
+        local_mirror.full_sync()
+    return connected
+
 
 async def start_bot():
     """Запуск бота"""
     global telegram_client
     print("🚀 Запуск BabyCareBot...")
     
+    # Проверка Supabase, аренды шардов и локальная копия готовятся в потоке,
+    # пока бот подключается к Telegram
+    database_ready = asyncio.get_running_loop().run_in_executor(None, prepare_database)
+    
     try:
         # Создаем клиент Telegram
         print("📱 Создаем Telegram клиент...")
-        client = TelegramClient('babybot', API_ID, API_HASH)
+        # У каждого воркера своя сессия; сообщения пользователей принимает только один из них
+        client = TelegramClient(sharding.session_name('babybot'), API_ID, API_HASH,
+                                receive_updates=sharding.handles_updates())
         
         print("🔄 Подключаемся к Telegram...")
         await client.start(bot_token=BOT_TOKEN)
@@ -571,22 +1256,26 @@ async def start_bot():
         print(f"❌ Ошибка подключения к Telegram: {e}")
         return
     
-    # Небольшая задержка для стабилизации подключения
-    await asyncio.sleep(1)
-    # Запускаем планировщик
+    # Планировщик запускается, когда аренды взяты и локальная копия загружена:
+    # первая проверка напоминаний уже видит свои шарды
+    if not await database_ready:
+        print("⚠️ Supabase недоступен при запуске; запросы восстановятся вместе со связью")
     scheduler.start()
     print("⏰ Планировщик запущен")
+    query_tracing.start_metrics_server()
     
     # Регистрируем обработчики событий
     @client.on(events.NewMessage(pattern='/start'))
+    @query_tracing.traced_handler
+    @event_router.exclusive
     async def start(event):
         uid = event.sender_id
-        fid = get_family_id(uid)
+        fid = await db.get_family_id(uid)
         
         if fid:
             # Пользователь уже в семье
-            family_name = get_family_name(fid)
-            role, name = get_member_info(uid)
+            family_name = await db.get_family_name(fid)
+            role, name = await db.get_member_info(uid)
             
             welcome_message = (
                 f"👶 **Добро пожаловать в BabyCareBot!**\n\n"
@@ -616,14 +1305,11 @@ async def start_bot():
         
         # Проверяем, есть ли у пользователя семья
         uid = event.sender_id
-        fid = get_family_id(uid)
+        fid = await db.get_family_id(uid)
         
         if fid:
             # Пользователь уже в семье - показываем основные функции
-            buttons = [
-                [Button.text("🍼 Кормление"), Button.text("💩 Смена подгузника")],
-                [Button.text("💡 Советы"), Button.text("⚙️ Настройки")]
-            ]
+            buttons = MAIN_MENU_BUTTONS
         else:
             # Пользователь не в семье - показываем кнопки создания/присоединения
             buttons = [
@@ -633,21 +1319,23 @@ async def start_bot():
         await event.respond(welcome_message, buttons=buttons)
     
     @client.on(events.NewMessage(pattern='🍼 Кормление'))
+    @query_tracing.traced_handler
+    @event_router.exclusive
     async def feeding_menu(event):
         """Показать статус кормления с возможностью отметить кормление"""
         uid = event.sender_id
-        fid = get_family_id(uid)
+        fid = await db.get_family_id(uid)
         
         if not fid:
             await event.respond("❌ Вы не состоите в семье. Сначала создайте семью или присоединитесь к существующей.")
             return
         
         # Получаем время последнего кормления
-        last_feeding = get_last_feeding_time_for_family(fid)
+        last_feeding = await db.get_last_feeding_time_for_family(fid)
         
         if last_feeding:
             # Вычисляем время с последнего кормления
-            now = get_thai_time()
+            now = timeutils.utc_now()
             time_diff = now - last_feeding
             hours = int(time_diff.total_seconds() // 3600)
             minutes = int((time_diff.total_seconds() % 3600) // 60)
@@ -668,7 +1356,7 @@ async def start_bot():
                 message = f"🍼 **Последнее кормление было:**\n**{time_str} назад**\n\n"
             
             # Проверяем, нужно ли напоминание
-            feed_interval, _ = get_user_intervals(fid)
+            feed_interval, _ = await db.get_user_intervals(fid)
             
             if hours >= feed_interval:
 
@@ -701,21 +1389,23 @@ async def start_bot():
         await event.respond(message, buttons=buttons)
     
     @client.on(events.NewMessage(pattern='💩 Смена подгузника'))
+    @query_tracing.traced_handler
+    @event_router.exclusive
     async def diaper_menu(event):
         """Показать статус смены подгузника с возможностью отметить смену"""
         uid = event.sender_id
-        fid = get_family_id(uid)
+        fid = await db.get_family_id(uid)
         
         if not fid:
             await event.respond("❌ Вы не состоите в семье. Сначала создайте семью или присоединитесь к существующей.")
             return
         
         # Получаем время последней смены подгузника
-        last_diaper = get_last_diaper_change_time_for_family(fid)
+        last_diaper = await db.get_last_diaper_change_time_for_family(fid)
         
         if last_diaper:
             # Вычисляем время с последней смены
-            now = get_thai_time()
+            now = timeutils.utc_now()
             time_diff = now - last_diaper
             hours = int(time_diff.total_seconds() // 3600)
             minutes = int((time_diff.total_seconds() % 3600) // 60)
@@ -736,7 +1426,7 @@ async def start_bot():
                 message = f"🧷 **Последняя смена была:**\n**{time_str} назад**\n\n"
             
             # Проверяем, нужно ли напоминание
-            _, diaper_interval = get_user_intervals(fid)
+            _, diaper_interval = await db.get_user_intervals(fid)
             
             if hours >= diaper_interval:
                 message += f"🔄 **Время менять!** Малышу нужен свежий подгузник! (интервал: {diaper_interval}ч) 🧴\n\n"
@@ -767,18 +1457,20 @@ async def start_bot():
         await event.respond(message, buttons=buttons)
     
     @client.on(events.NewMessage(pattern='💡 Советы'))
+    @query_tracing.traced_handler
+    @event_router.exclusive
     async def tips_menu(event):
         """Показать случайный совет"""
         uid = event.sender_id
-        fid = get_family_id(uid)
+        fid = await db.get_family_id(uid)
         
         if not fid:
             await event.respond("❌ Вы не состоите в семье. Сначала создайте семью или присоединитесь к существующей.")
             return
         
         # Получаем возраст малыша и случайный совет
-        age_months = get_baby_age_months(fid)
-        tip = get_random_tip(age_months)
+        age_months = await db.get_baby_age_months(fid)
+        tip = await db.get_random_tip(age_months)
         
         if tip:
             message = f"💡 **Совет для {age_months} месяцев:**\n\n{tip}"
@@ -789,699 +1481,52 @@ async def start_bot():
     
     
     @client.on(events.NewMessage(pattern='⚙️ Настройки'))
+    @query_tracing.traced_handler
+    @event_router.exclusive
     async def settings_menu(event):
         """Показать настройки"""
         uid = event.sender_id
-        fid = get_family_id(uid)
+        fid = await db.get_family_id(uid)
         
         if not fid:
             await event.respond("❌ Вы не состоите в семье. Сначала создайте семью или присоединитесь к существующей.")
             return
         
-        # Получаем настройки и статистику
-        settings = get_notification_settings(fid)
-        intervals = get_user_intervals(fid)
-        feeding_stats = get_feeding_stats(fid)
-        diaper_stats = get_diaper_stats(fid)
-        bath_stats = get_bath_stats(fid)
-        activity_stats = get_activity_stats(fid)
-        birth_date = get_birth_date(fid)
-        
-        message = "⚙️ **Настройки и статистика:**\n\n"
-        
-        # Статистика за сегодня
-        message += "📊 **Статистика за сегодня:**\n"
-        if feeding_stats:
-            message += f"🍼 Кормления: {feeding_stats['count']} раз\n"
-        if diaper_stats:
-            message += f"💩 Смены подгузников: {diaper_stats['count']} раз\n"
-        if bath_stats:
-            message += f"🛁 Купания: {bath_stats['count']} раз\n"
-        if activity_stats:
-            message += f"🎮 Активность: {activity_stats['count']} раз\n"
-        
-        message += "\n⚙️ **Текущие настройки:**\n"
-        
-        if intervals:
-            feed_interval, diaper_interval = intervals
-            message += f"🍼 Интервал кормления: {feed_interval}ч\n"
-            message += f"💩 Интервал смены подгузника: {diaper_interval}ч\n\n"
-        
-        if settings:
-            message += f"💡 Советы: {'Включены' if settings.get('tips_enabled') else 'Выключены'}\n"
-            message += f"🛁 Напоминания о купании: {'Включены' if settings.get('bath_reminder_enabled') else 'Выключены'}\n"
-            message += f"🎮 Напоминания об активности: {'Включены' if settings.get('activity_reminder_enabled') else 'Выключены'}\n"
-        
-        if birth_date:
-            message += f"📅 Дата рождения малыша: {birth_date}\n"
-        else:
-            message += f"📅 Дата рождения малыша: Не установлена\n"
-        
-        message += "\n🎯 **Что настроим?**"
-        
-        buttons = [
-            [Button.inline("🍼 Интервал кормления", b"settings_feeding"), Button.inline("💩 Интервал подгузников", b"settings_diaper")],
-            [Button.inline("💡 Советы", b"settings_tips"), Button.inline("🛁 Купание", b"settings_bath")],
-            [Button.inline("🎮 Активность", b"settings_activity"), Button.inline("⏰ Время уведомлений", b"settings_time")],
-            [Button.inline("📅 Дата рождения", b"settings_birth_date"), Button.inline("🔙 Назад", b"back_to_main")]
-        ]
+        overview = await db.get_settings_overview(fid)
+        if not overview:
+            await event.respond("❌ Ошибка получения настроек")
+            return
         
+        message, buttons = build_settings_screen(overview)
         await event.respond(message, buttons=buttons)
     
     @client.on(events.CallbackQuery)
+    @query_tracing.traced_handler
     async def callback_handler(event):
-        data = event.data.decode()
-        uid = event.sender_id
-        
-        
-        # Обработка кнопок кормления
-        if data == "feed_now":
-            success, message = handle_feeding_callback(event, 0)
-            if success:
-                await event.edit(message)
-            else:
-                if isinstance(message, tuple):
-                    await event.edit(message[0], buttons=message[1])
-                else:
-                    await event.edit(message)
-        
-        elif data == "feed_15min":
-            success, message = handle_feeding_callback(event, 15)
-            if success:
-                await event.edit(message)
-            else:
-                if isinstance(message, tuple):
-                    await event.edit(message[0], buttons=message[1])
-                else:
-                    await event.edit(message)
-        
-        elif data == "feed_30min":
-            success, message = handle_feeding_callback(event, 30)
-            if success:
-                await event.edit(message)
-            else:
-                if isinstance(message, tuple):
-                    await event.edit(message[0], buttons=message[1])
-                else:
-                    await event.edit(message)
-        
-        # Обработка кнопок смены подгузника
-        elif data == "diaper_now":
-            success, message = handle_diaper_callback(event, 0)
-            if success:
-                await event.edit(message)
-            else:
-                if isinstance(message, tuple):
-                    await event.edit(message[0], buttons=message[1])
-                else:
-                    await event.edit(message)
-        
-        elif data == "diaper_15min":
-            success, message = handle_diaper_callback(event, 15)
-            if success:
-                await event.edit(message)
-            else:
-                if isinstance(message, tuple):
-                    await event.edit(message[0], buttons=message[1])
-                else:
-                    await event.edit(message)
-        
-        elif data == "diaper_30min":
-            success, message = handle_diaper_callback(event, 30)
-            if success:
-                await event.edit(message)
-            else:
-                if isinstance(message, tuple):
-                    await event.edit(message[0], buttons=message[1])
-                else:
-                    await event.edit(message)
-        
-        # Обработка подтверждения дубликатов
-        elif data == "confirm_duplicate":
-            if uid in duplicate_confirmation_pending:
-                pending_data = duplicate_confirmation_pending[uid]
-                action = pending_data["action"]
-                minutes_ago = pending_data["minutes_ago"]
-                
-                if action == "feeding":
-                    if add_feeding(uid, minutes_ago, force=True):
-                        fid = get_family_id(uid)
-                        if fid:
-                            acknowledge_feeding_notifications(fid)
-                        await event.edit("✅ Кормление записано!")
-                    else:
-                        await event.edit("❌ Ошибка записи кормления")
-                elif action == "diaper":
-                    if add_diaper_change(uid, minutes_ago, force=True):
-                        fid = get_family_id(uid)
-                        if fid:
-                            acknowledge_diaper_notifications(fid)
-                        await event.edit("✅ Смена подгузника записана!")
-                    else:
-                        await event.edit("❌ Ошибка записи смены подгузника")
-                
-                del duplicate_confirmation_pending[uid]
-            else:
-                await event.edit("❌ Ошибка: данные подтверждения не найдены")
-        
-        elif data == "cancel_duplicate":
-            if uid in duplicate_confirmation_pending:
-                del duplicate_confirmation_pending[uid]
-                await event.edit("❌ Операция отменена")
-            else:
-                await event.edit("❌ Ошибка: данные подтверждения не найдены")
-        
-        # Обработка кнопки "Назад"
-        elif data == "back_to_main":
-            fid = get_family_id(uid)
-            if fid:
-                family_name = get_family_name(fid)
-                role, name = get_member_info(uid)
-                
-                message = (
-                    f"👶 **BabyCareBot**\n\n"
-                    f"🏠 **Семья:** {family_name}\n"
-                    f"👤 **Роль:** {role} {name}\n\n"
-                    f"🎯 **Что делаем?**"
-                )
-            else:
-                message = (
-                    f"👶 **BabyCareBot**\n\n"
-                    f"🎯 **Что делаем?**"
-                )
-            
-            buttons = [
-                [Button.text("🍼 Кормление"), Button.text("💩 Смена подгузника")],
-                [Button.text("💡 Советы"), Button.text("⚙️ Настройки")]
-            ]
-            
-            await event.edit(message, buttons=buttons)
-        
-        
-        # Обработка кнопок "Указать время"
-        elif data == "feed_custom_time":
-            custom_time_pending[uid] = "feeding"
-            await event.edit("🕐 **Укажите время кормления**\n\nВведите время в формате:\n• **15** (15 минут назад)\n• **1:30** (1 час 30 минут назад)\n• **2ч** (2 часа назад)")
-        
-        elif data == "diaper_custom_time":
-            custom_time_pending[uid] = "diaper"
-            await event.edit("🕐 **Укажите время смены подгузника**\n\nВведите время в формате:\n• **15** (15 минут назад)\n• **1:30** (1 час 30 минут назад)\n• **2ч** (2 часа назад)")
-        
-        # Обработка настроек
-        elif data == "settings_feeding":
-            fid = get_family_id(uid)
-            if fid:
-                intervals = get_user_intervals(fid)
-                current_interval = intervals[0] if intervals else 3
-                
-                message = f"🍼 **Интервал кормления:** {current_interval} часов\n\nВыберите новый интервал:"
-                
-                buttons = [
-                    [Button.inline("3 часа", b"set_feed_3"), Button.inline("4 часа", b"set_feed_4")],
-                    [Button.inline("5 часов", b"set_feed_5"), Button.inline("6 часов", b"set_feed_6")],
-                    [Button.inline("🔙 Назад к настройкам", b"back_to_settings")]
-                ]
-                
-                await event.edit(message, buttons=buttons)
-            else:
-                await event.edit("❌ Ошибка получения настроек")
-        
-        elif data == "settings_diaper":
-            fid = get_family_id(uid)
-            if fid:
-                intervals = get_user_intervals(fid)
-                current_interval = intervals[1] if intervals else 2
-                
-                message = f"💩 **Интервал смены подгузника:** {current_interval} часов\n\nВыберите новый интервал:"
-                
-                buttons = [
-                    [Button.inline("2 часа", b"set_diaper_2"), Button.inline("3 часа", b"set_diaper_3")],
-                    [Button.inline("4 часа", b"set_diaper_4"), Button.inline("5 часов", b"set_diaper_5")],
-                    [Button.inline("🔙 Назад к настройкам", b"back_to_settings")]
-                ]
-                
-                await event.edit(message, buttons=buttons)
-            else:
-                await event.edit("❌ Ошибка получения настроек")
-        
-        elif data == "settings_tips":
-            fid = get_family_id(uid)
-            if fid:
-                settings = get_notification_settings(fid)
-                tips_enabled = settings.get('tips_enabled', True) if settings else True
-                
-                message = f"💡 **Советы:** {'Включены' if tips_enabled else 'Выключены'}\n\n🎯 **Что делаем?**"
-                
-                buttons = [
-                    [Button.inline("✅ Включить", b"toggle_tips_on"), Button.inline("❌ Выключить", b"toggle_tips_off")],
-                    [Button.inline("🔙 Назад к настройкам", b"back_to_settings")]
-                ]
-                
-                await event.edit(message, buttons=buttons)
-            else:
-                await event.edit("❌ Ошибка получения настроек")
-        
-        elif data == "settings_bath":
-            fid = get_family_id(uid)
-            if fid:
-                settings = get_notification_settings(fid)
-                bath_enabled = settings.get('bath_reminder_enabled', True) if settings else True
-                
-                message = f"🛁 **Напоминания о купании:** {'Включены' if bath_enabled else 'Выключены'}\n\n🎯 **Что делаем?**"
-                
-                buttons = [
-                    [Button.inline("✅ Включить", b"toggle_bath_on"), Button.inline("❌ Выключить", b"toggle_bath_off")],
-                    [Button.inline("🔙 Назад к настройкам", b"back_to_settings")]
-                ]
-                
-                await event.edit(message, buttons=buttons)
-            else:
-                await event.edit("❌ Ошибка получения настроек")
-        
-        elif data == "settings_activity":
-            fid = get_family_id(uid)
-            if fid:
-                settings = get_notification_settings(fid)
-                activity_enabled = settings.get('activity_reminder_enabled', True) if settings else True
-                
-                message = f"🎮 **Напоминания об активности:** {'Включены' if activity_enabled else 'Выключены'}\n\n🎯 **Что делаем?**"
-                
-                buttons = [
-                    [Button.inline("✅ Включить", b"toggle_activity_on"), Button.inline("❌ Выключить", b"toggle_activity_off")],
-                    [Button.inline("🔙 Назад к настройкам", b"back_to_settings")]
-                ]
-                
-                await event.edit(message, buttons=buttons)
-            else:
-                await event.edit("❌ Ошибка получения настроек")
-        
-        elif data == "settings_time":
-            fid = get_family_id(uid)
-            if fid:
-                settings = get_notification_settings(fid)
-                tips_hour = settings.get('tips_time_hour', 9)
-                tips_minute = settings.get('tips_time_minute', 0)
-                bath_hour = settings.get('bath_reminder_hour', 19)
-                bath_minute = settings.get('bath_reminder_minute', 0)
-                activity_interval = settings.get('activity_reminder_interval', 2)
-                
-                message = f"⏰ **Настройки времени уведомлений:**\n\n"
-                message += f"💡 **Советы:** {tips_hour:02d}:{tips_minute:02d}\n"
-                message += f"🛁 **Купание:** {bath_hour:02d}:{bath_minute:02d}\n"
-                message += f"🎮 **Активность:** каждые {activity_interval}ч\n\n"
-                message += f"🎯 **Что настроим?**"
-                
-                buttons = [
-                    [Button.inline("💡 Время советов", b"set_tips_time"), Button.inline("🛁 Время купания", b"set_bath_time")],
-                    [Button.inline("🎮 Интервал активности", b"set_activity_interval")],
-                    [Button.inline("🔙 Назад к настройкам", b"back_to_settings")]
-                ]
-                
-                await event.edit(message, buttons=buttons)
-            else:
-                await event.edit("❌ Ошибка получения настроек")
-        
-        elif data == "settings_birth_date":
-            fid = get_family_id(uid)
-            if fid:
-                birth_date = get_birth_date(fid)
-                
-                message = f"📅 **Настройка даты рождения малыша:**\n\n"
-                if birth_date:
-                    message += f"📅 **Текущая дата:** {birth_date}\n\n"
-                else:
-                    message += f"📅 **Дата не установлена**\n\n"
-                
-                message += f"🎯 **Что делаем?**"
-                
-                buttons = [
-                    [Button.inline("📅 Установить дату", b"set_birth_date")],
-                    [Button.inline("🔙 Назад к настройкам", b"back_to_settings")]
-                ]
-                
-                await event.edit(message, buttons=buttons)
-            else:
-                await event.edit("❌ Ошибка получения настроек")
-        
-        # Обработка изменения интервалов
-        elif data.startswith("set_feed_"):
-            interval = int(data.split("_")[2])
-            fid = get_family_id(uid)
-            if fid and set_user_interval(fid, interval, None):
-                await event.edit(f"✅ Интервал кормления изменен на {interval} часов!")
-            else:
-                await event.edit("❌ Ошибка изменения интервала")
-        
-        elif data.startswith("set_diaper_"):
-            interval = int(data.split("_")[2])
-            fid = get_family_id(uid)
-            if fid and set_user_interval(fid, None, interval):
-                await event.edit(f"✅ Интервал смены подгузника изменен на {interval} часов!")
-            else:
-                await event.edit("❌ Ошибка изменения интервала")
-        
-        elif data.startswith("set_activity_"):
-            interval = int(data.split("_")[2])
-            fid = get_family_id(uid)
-            if fid and update_notification_settings(fid, {"activity_reminder_interval": interval}):
-                await event.edit(f"✅ Интервал активности изменен на {interval} часов!")
-            else:
-                await event.edit("❌ Ошибка изменения интервала")
-        
-        # Обработка настройки времени
-        elif data == "set_tips_time":
-            custom_time_pending[uid] = "tips_time"
-            await event.edit("💡 **Настройка времени советов**\n\nВведите время в формате:\n• **9:00** (9 часов 0 минут)\n• **14:30** (14 часов 30 минут)\n• **21** (21 час 0 минут)")
-        
-        elif data == "set_bath_time":
-            custom_time_pending[uid] = "bath_time"
-            await event.edit("🛁 **Настройка времени купания**\n\nВведите время в формате:\n• **19:00** (19 часов 0 минут)\n• **20:30** (20 часов 30 минут)\n• **21** (21 час 0 минут)")
-        
-        elif data == "set_activity_interval":
-            fid = get_family_id(uid)
-            if fid:
-                settings = get_notification_settings(fid)
-                current_interval = settings.get('activity_reminder_interval', 2)
-                
-                message = f"🎮 **Интервал напоминаний об активности:** {current_interval} часов\n\nВыберите новый интервал:"
-                
-                buttons = [
-                    [Button.inline("1 час", b"set_activity_1"), Button.inline("2 часа", b"set_activity_2")],
-                    [Button.inline("3 часа", b"set_activity_3"), Button.inline("4 часа", b"set_activity_4")],
-                    [Button.inline("🔙 Назад к времени", b"settings_time")]
-                ]
-                
-                await event.edit(message, buttons=buttons)
-            else:
-                await event.edit("❌ Ошибка получения настроек")
-        
-        elif data == "set_birth_date":
-            baby_birth_pending[uid] = True
-            await event.edit("📅 **Установка даты рождения малыша**\n\nВведите дату в формате:\n• **2024-01-15** (15 января 2024)\n• **15.01.2024** (15 января 2024)\n• **15/01/2024** (15 января 2024)")
-        
-        # Обработка переключения уведомлений
-        elif data == "toggle_tips_on":
-            fid = get_family_id(uid)
-            if fid and update_notification_settings(fid, {"tips_enabled": True}):
-                await event.edit("✅ Советы включены!")
-            else:
-                await event.edit("❌ Ошибка изменения настроек")
-        
-        elif data == "toggle_tips_off":
-            fid = get_family_id(uid)
-            if fid and update_notification_settings(fid, {"tips_enabled": False}):
-                await event.edit("✅ Советы выключены!")
-            else:
-                await event.edit("❌ Ошибка изменения настроек")
-        
-        elif data == "toggle_bath_on":
-            fid = get_family_id(uid)
-            if fid and update_notification_settings(fid, {"bath_reminder_enabled": True}):
-                await event.edit("✅ Напоминания о купании включены!")
-            else:
-                await event.edit("❌ Ошибка изменения настроек")
-        
-        elif data == "toggle_bath_off":
-            fid = get_family_id(uid)
-            if fid and update_notification_settings(fid, {"bath_reminder_enabled": False}):
-                await event.edit("✅ Напоминания о купании выключены!")
-            else:
-                await event.edit("❌ Ошибка изменения настроек")
-        
-        elif data == "toggle_activity_on":
-            fid = get_family_id(uid)
-            if fid and update_notification_settings(fid, {"activity_reminder_enabled": True}):
-                await event.edit("✅ Напоминания об активности включены!")
-            else:
-                await event.edit("❌ Ошибка изменения настроек")
-        
-        elif data == "toggle_activity_off":
-            fid = get_family_id(uid)
-            if fid and update_notification_settings(fid, {"activity_reminder_enabled": False}):
-                await event.edit("✅ Напоминания об активности выключены!")
-            else:
-                await event.edit("❌ Ошибка изменения настроек")
-        
-        # Обработка кнопки "Проверить снова" для напоминаний
-        elif data == "check_reminders":
-            fid = get_family_id(uid)
-            if fid:
-                # Проверяем условия для напоминаний
-                conditions = check_smart_reminder_conditions(fid)
-                
-                if not conditions['needs_feeding'] and not conditions['needs_diaper']:
-                    message = "✅ **Все в порядке!**\n\n"
-                    message += "🍼 Кормление и смена подгузника по расписанию\n"
-                    message += "💡 Напоминания работают в фоновом режиме"
-                    
-                    buttons = [
-                        [Button.inline("🔄 Проверить снова", b"check_reminders")]
-                    ]
-                else:
-                    # Получаем сообщение напоминания
-                    message = get_smart_reminder_message(fid)
-                    if not message:
-                        message = "❌ Ошибка получения напоминаний"
-                        buttons = []
-                    else:
-                        # Создаем кнопки для быстрых действий
-                        buttons = []
-                        if conditions['needs_feeding']:
-                            buttons.append([Button.inline("🍼 Отметить кормление", b"feed_now")])
-                        if conditions['needs_diaper']:
-                            buttons.append([Button.inline("💩 Смена подгузника", b"diaper_now")])
-                        buttons.append([Button.inline("🔄 Проверить снова", b"check_reminders")])
-                
-                await event.edit(message, buttons=buttons)
-            else:
-                await event.edit("❌ Ошибка получения напоминаний")
-        
-        # Обработка кнопки "Назад к настройкам"
-        elif data == "back_to_settings":
-            fid = get_family_id(uid)
-            if fid:
-                # Получаем настройки и статистику
-                settings = get_notification_settings(fid)
-                intervals = get_user_intervals(fid)
-                feeding_stats = get_feeding_stats(fid)
-                diaper_stats = get_diaper_stats(fid)
-                bath_stats = get_bath_stats(fid)
-                activity_stats = get_activity_stats(fid)
-                birth_date = get_birth_date(fid)
-                
-                message = "⚙️ **Настройки и статистика:**\n\n"
-                
-                # Статистика за сегодня
-                message += "📊 **Статистика за сегодня:**\n"
-                if feeding_stats:
-                    message += f"🍼 Кормления: {feeding_stats['count']} раз\n"
-                if diaper_stats:
-                    message += f"💩 Смены подгузников: {diaper_stats['count']} раз\n"
-                if bath_stats:
-                    message += f"🛁 Купания: {bath_stats['count']} раз\n"
-                if activity_stats:
-                    message += f"🎮 Активность: {activity_stats['count']} раз\n"
-                
-                message += "\n⚙️ **Текущие настройки:**\n"
-                
-                if intervals:
-                    feed_interval, diaper_interval = intervals
-                    message += f"🍼 Интервал кормления: {feed_interval}ч\n"
-                    message += f"💩 Интервал смены подгузника: {diaper_interval}ч\n\n"
-                
-                if settings:
-                    message += f"💡 Советы: {'Включены' if settings.get('tips_enabled') else 'Выключены'}\n"
-                    message += f"🛁 Напоминания о купании: {'Включены' if settings.get('bath_reminder_enabled') else 'Выключены'}\n"
-                    message += f"🎮 Напоминания об активности: {'Включены' if settings.get('activity_reminder_enabled') else 'Выключены'}\n"
-                
-                if birth_date:
-                    message += f"📅 Дата рождения малыша: {birth_date}\n"
-                else:
-                    message += f"📅 Дата рождения малыша: Не установлена\n"
-                
-                message += "\n🎯 **Что настроим?**"
-                
-                buttons = [
-                    [Button.inline("🍼 Интервал кормления", b"settings_feeding"), Button.inline("💩 Интервал подгузников", b"settings_diaper")],
-                    [Button.inline("💡 Советы", b"settings_tips"), Button.inline("🛁 Купание", b"settings_bath")],
-                    [Button.inline("🎮 Активность", b"settings_activity"), Button.inline("⏰ Время уведомлений", b"settings_time")],
-                    [Button.inline("📅 Дата рождения", b"settings_birth_date"), Button.inline("🔙 Назад", b"back_to_main")]
-                ]
-                
-                await event.edit(message, buttons=buttons)
-            else:
-                await event.edit("❌ Ошибка получения настроек")
-        
-        else:
+        if not await callback_routes.dispatch(event):
             await event.answer("❌ Неизвестная команда")
     
     @client.on(events.NewMessage)
+    @query_tracing.traced_handler
     async def handle_text(event):
         uid = event.sender_id
         text = event.text.strip()
         
-        # Обработка создания семьи
-        if uid in family_creation_pending:
-            family_name = text
-            family_id = create_family(family_name, uid)
-            
-            if family_id:
-                del family_creation_pending[uid]
-                await event.respond(f"✅ Семья '{family_name}' создана! ID семьи: {family_id}")
-            else:
-                await event.respond("❌ Ошибка создания семьи")
-            return
-        
-        # Обработка присоединения к семье
-        if uid in join_pending:
-            family_id, family_name = join_family_by_code(text, uid)
-            
-            if family_id:
-                del join_pending[uid]
-                await event.respond(f"✅ Вы присоединились к семье '{family_name}'!")
-            else:
-                await event.respond(f"❌ {family_name}")
-            return
-        
-        # Обработка ввода времени
-        if uid in custom_time_pending:
-            action = custom_time_pending[uid]
-            del custom_time_pending[uid]
-            
-            if action in ["feeding", "diaper"]:
-                minutes_ago = parse_time_input(text)
-                if minutes_ago is None:
-                    await event.respond("❌ Неверный формат времени. Попробуйте снова.")
-                    return
-                
-                if action == "feeding":
-                    success, message = handle_feeding_callback(event, minutes_ago)
-                    if success:
-                        await event.respond(message)
-                    else:
-                        if isinstance(message, tuple):
-                            await event.respond(message[0], buttons=message[1])
-                        else:
-                            await event.respond(message)
-                elif action == "diaper":
-                    success, message = handle_diaper_callback(event, minutes_ago)
-                    if success:
-                        await event.respond(message)
-                    else:
-                        if isinstance(message, tuple):
-                            await event.respond(message[0], buttons=message[1])
-                        else:
-                            await event.respond(message)
-            
-            elif action in ["tips_time", "bath_time"]:
-                # Парсим время для настроек
-                time_tuple = parse_time_setting(text)
-                if time_tuple is None:
-                    await event.respond("❌ Неверный формат времени. Попробуйте снова.")
-                    return
-                
-                hours, minutes = time_tuple
-                fid = get_family_id(uid)
-                
-                if action == "tips_time":
-                    if fid and update_notification_settings(fid, {"tips_time_hour": hours, "tips_time_minute": minutes}):
-                        await event.respond(f"✅ Время советов изменено на {hours:02d}:{minutes:02d}!")
-                    else:
-                        await event.respond("❌ Ошибка изменения времени")
-                elif action == "bath_time":
-                    if fid and update_notification_settings(fid, {"bath_reminder_hour": hours, "bath_reminder_minute": minutes}):
-                        await event.respond(f"✅ Время купания изменено на {hours:02d}:{minutes:02d}!")
-                    else:
-                        await event.respond("❌ Ошибка изменения времени")
-            return
-        
-        # Обработка ввода даты рождения
-        if uid in baby_birth_pending:
-            del baby_birth_pending[uid]
-            
-            # Парсим дату рождения
-            birth_date = parse_birth_date(text)
-            if birth_date is None:
-                await event.respond("❌ Неверный формат даты. Попробуйте снова.\n\nИспользуйте формат:\n• **2024-01-15**\n• **15.01.2024**\n• **15/01/2024**")
-                return
-            
-            fid = get_family_id(uid)
-            if fid and set_birth_date(fid, birth_date):
-                await event.respond(f"✅ Дата рождения установлена: {birth_date}")
-            else:
-                await event.respond("❌ Ошибка установки даты рождения")
+        # Пользователь в середине сценария: ввод обрабатывает обработчик его состояния
+        state = conversation_state.get_state(uid)
+        state_handler = TEXT_STATE_HANDLERS.get(state[0]) if state else None
+        if state_handler:
+            await state_handler(event, uid, text, state[1])
             return
         
-        if text == "👨‍👩‍👧 Создать семью":
-            family_creation_pending[uid] = True
-            await event.respond("👨‍👩‍👧 Введите название новой семьи:")
-        
-        elif text == "🔗 Присоединиться":
-            join_pending[uid] = True
-            await event.respond("🔗 Введите код семьи (ID семьи):")
-        
-        elif text == "💡 Совет":
-            fid = get_family_id(uid)
-            if fid:
-                age_months = get_baby_age_months(fid)
-                tip = get_random_tip(age_months)
-                if tip:
-                    await event.respond(f"💡 **Совет для {age_months} месяцев:**\n\n{tip}")
-                else:
-                    await event.respond("💡 Советов для вашего возраста пока нет")
-            else:
-                await event.respond("❌ Вы не состоите в семье")
-        
-        elif text == "⚙ Настройки":
-            fid = get_family_id(uid)
-            if fid:
-                message = "⚙️ **Настройки**\n\n🎯 **Что настроим?**"
-                buttons = [
-                    [Button.text("🍼 Интервалы кормления"), Button.text("🧷 Интервалы подгузников")],
-                    [Button.text("👤 Моя роль"), Button.text("📅 Дата рождения")],
-                    [Button.text("🔙 Назад")]
-                ]
-                await event.respond(message, buttons=buttons)
-            else:
-                await event.respond("❌ Вы не состоите в семье")
-        
-        
-        elif text == "👨‍👩‍👧 Семья":
-            fid = get_family_id(uid)
-            if fid:
-                family_name = get_family_name(fid)
-                members = get_family_members_with_roles(fid)
-                
-                message = f"👨‍👩‍👧 **Семья: {family_name}**\n\n"
-                message += f"👥 **Члены семьи:**\n"
-                
-                for user_id, role, name in members:
-                    if user_id == uid:
-                        message += f"• {role} {name} (вы)\n"
-                    else:
-                        message += f"• {role} {name}\n"
-                
-                message += f"\n🔑 **ID семьи:** {fid}\n"
-                message += f"Поделитесь этим ID с другими членами семьи"
-                
-                buttons = [[Button.text("🔙 Назад")]]
-                await event.respond(message, buttons=buttons)
-            else:
-                await event.respond("❌ Вы не состоите в семье")
-        
-        
+        await text_routes.dispatch(event)
     
     # Запускаем бота с обработкой очереди напоминаний
     try:
         print("🔄 Запускаем обработчик напоминаний...")
-        # Создаем задачу для обработки очереди напоминаний
-        async def reminder_processor():
-            while True:
-                await process_reminder_queue()
-                await asyncio.sleep(10)  # Проверяем каждые 10 секунд
-        
-        # Запускаем обработчик напоминаний в фоне
-        asyncio.create_task(reminder_processor())
+        # Пул доставки отправляет напоминания параллельно с учетом лимитов Telegram
+        asyncio.create_task(reminder_delivery.run_delivery_workers(client))
+        asyncio.create_task(run_reminder_timer())
         print("✅ Обработчик напоминаний запущен")
         
         print("🔄 Запускаем основной цикл бота...")
@@ -1495,9 +1540,13 @@ async def start_bot():
         print("🔄 Остановка планировщика...")
         scheduler.shutdown()
         print("✅ Планировщик остановлен")
+        sharding.release_leases()
+        db.shutdown()
         print("👋 BabyCareBot остановлен")
 
 if __name__ == "__main__":
+    if not check_supabase_config() or not sharding.check_config():
+        exit(1)
     try:
         asyncio.run(start_bot())
     except KeyboardInterrupt:
@@ -0,0 +1,101 @@
+"""
+Индекс отправленных уведомлений в памяти
+Для каждой пары (family_id, тип уведомления) хранятся моменты неподтвержденных
+отправок за последние сутки. Индекс загружается из notification_tracking один раз,
+а дальше его обновляют log_notification_sent и подтверждения, поэтому проверка
+напоминаний не читает notification_tracking при каждом проходе
+"""
+
+import threading
+from bisect import insort
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+NOTIFICATION_INDEX_WINDOW_MINUTES = 1440
+
+# (family_id, тип) -> отсортированные моменты отправки со статусом 'sent'
+_sent: Dict[Tuple[int, str], List[datetime]] = {}
+_lock = threading.Lock()
+_loaded = False
+
+
+def is_loaded() -> bool:
+    return _loaded
+
+
+def load(rows: Iterable[Dict[str, object]], family_ids: Optional[Iterable[int]] = None):
+    """Заменить записи индекса строками notification_tracking (всех семей или указанных).
+    В строках family_id, notification_type и sent_at уже в виде datetime"""
+    global _loaded
+    loaded: Dict[Tuple[int, str], List[datetime]] = {}
+    for row in rows:
+        loaded.setdefault((row['family_id'], row['notification_type']), []).append(row['sent_at'])
+    for times in loaded.values():
+        times.sort()
+    with _lock:
+        if family_ids is None:
+            _sent.clear()
+            _loaded = True
+        else:
+            scope = set(family_ids)
+            for key in [key for key in _sent if key[0] in scope]:
+                del _sent[key]
+        _sent.update(loaded)
+
+
+def record_sent(family_id: int, notification_type: str, sent_at: datetime):
+    """Учесть отправленное уведомление"""
+    with _lock:
+        insort(_sent.setdefault((family_id, notification_type), []), sent_at)
+
+
+def acknowledge(family_id: int, notification_types: Iterable[str]):
+    """Подтвержденные уведомления больше не учитываются в паузах между напоминаниями"""
+    with _lock:
+        for notification_type in notification_types:
+            _sent.pop((family_id, notification_type), None)
+
+
+def sent_times(family_id: int, notification_type: str) -> List[datetime]:
+    with _lock:
+        return list(_sent.get((family_id, notification_type), ()))
+
+
+def has_recent(family_id: int, notification_type: str, minutes_threshold: Optional[int], now: datetime) -> bool:
+    """Было ли неподтвержденное уведомление за minutes_threshold минут (без порога - за все окно)"""
+    with _lock:
+        times = _sent.get((family_id, notification_type))
+        if not times:
+            return False
+        if minutes_threshold is None or minutes_threshold <= 0:
+            return True
+        return times[-1] >= now - timedelta(minutes=minutes_threshold)
+
+
+def snapshot(family_ids: Optional[Iterable[int]] = None) -> Dict[Tuple[int, str], List[datetime]]:
+    """Копия индекса для проверки напоминаний (всех семей или указанных)"""
+    with _lock:
+        if family_ids is None:
+            return {key: list(times) for key, times in _sent.items()}
+        scope = set(family_ids)
+        return {key: list(times) for key, times in _sent.items() if key[0] in scope}
+
+
+def prune(now: datetime, window_minutes: int = NOTIFICATION_INDEX_WINDOW_MINUTES) -> int:
+    """Удалить отправки старше окна индекса"""
+    threshold = now - timedelta(minutes=window_minutes)
+    removed = 0
+    with _lock:
+        for key in list(_sent):
+            times = [moment for moment in _sent[key] if moment >= threshold]
+            removed += len(_sent[key]) - len(times)
+            if times:
+                _sent[key] = times
+            else:
+                del _sent[key]
+    return removed
+
+
+def get_index_stats() -> Dict[str, object]:
+    with _lock:
+        return {'loaded': _loaded, 'keys': len(_sent), 'entries': sum(len(times) for times in _sent.values())}
@@ -0,0 +1,374 @@
+"""
+Трассировка запросов к Supabase
+Клиент supabase оборачивается прокси, который замеряет каждый execute():
+таблицу, операцию, длительность, число строк, ошибки (каждая неудачная попытка -
+повтор) и функцию бота, из которой выполнен запрос. Запросы привязываются к
+действию пользователя (обработчику Telethon) через contextvars, а по окончании
+действия проверяется бюджет "N запросов, X мс". Гистограммы отдаются в текстовом
+формате Prometheus (render_metrics, METRICS_PORT) и периодически пишутся в журнал
+"""
+
+import contextvars
+import functools
+import os
+import re
+import sys
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+QUERY_TRACING_ENABLED = os.getenv('QUERY_TRACING', '1') != '0'
+# Бюджет одного действия пользователя, после которого пишется предупреждение
+QUERY_BUDGET_PER_ACTION = int(os.getenv('QUERY_BUDGET_PER_ACTION', '6'))
+QUERY_BUDGET_MS = float(os.getenv('QUERY_BUDGET_MS', '500'))
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_LOG_MINUTES = 15
+# Границы корзин гистограмм, секунды
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Операции построителя запросов, которые задают тип запроса
+QUERY_OPERATIONS = ('select', 'insert', 'upsert', 'update', 'delete')
+# Вспомогательные функции, которые пропускаются при поиске вызывающей функции
+_HELPER_FUNCTIONS = {'query', '<lambda>', 'safe_execute', 'fetch_all_rows', 'run_with_deferred_retries'}
+
+
+class _Histogram:
+    """Гистограмма длительностей с суммой, числом ошибок и строк"""
+    __slots__ = ('buckets', 'count', 'total', 'errors', 'rows')
+
+    def __init__(self):
+        self.buckets = [0] * (len(DURATION_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.errors = 0
+        self.rows = 0
+
+    def observe(self, seconds: float, rows: int = 0, error: bool = False):
+        self.buckets[bisect_left(DURATION_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.rows += rows
+        self.errors += error
+
+    def quantile(self, q: float) -> float:
+        """Верхняя граница корзины, в которую попадает квантиль"""
+        rank, seen = q * self.count, 0
+        for index, bucket in enumerate(self.buckets):
+            seen += bucket
+            if seen >= rank and seen:
+                return DURATION_BUCKETS[index] if index < len(DURATION_BUCKETS) else float('inf')
+        return 0.0
+
+
+class ActionTrace:
+    """Запросы одного действия пользователя; общий объект для всех копий контекста"""
+    __slots__ = ('name', 'queries', 'db_seconds', 'errors')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.errors = 0
+
+
+_current_action: contextvars.ContextVar = contextvars.ContextVar('babybot_action', default=None)
+_lock = threading.Lock()
+# (функция, таблица, операция) -> гистограмма запросов
+_query_metrics: Dict[Tuple[str, str, str], _Histogram] = {}
+# действие -> гистограмма длительности запросов к БД за действие
+_action_metrics: Dict[str, _Histogram] = {}
+_action_counts: Dict[str, Dict[str, int]] = {}
+_metrics_server: Optional[ThreadingHTTPServer] = None
+
+
+def _caller_name() -> str:
+    """Функция бота, выполнившая запрос (без вложенных query/lambda и повторов)"""
+    frame = sys._getframe(2)
+    while frame is not None:
+        code = frame.f_code
+        if code.co_filename != __file__ and code.co_name not in _HELPER_FUNCTIONS:
+            module = frame.f_globals.get('__name__', '?')
+            return f"{module}.{code.co_name}"
+        frame = frame.f_back
+    return 'unknown'
+
+
+def _result_rows(result) -> int:
+    data = getattr(result, 'data', None)
+    return len(data) if isinstance(data, list) else int(data is not None)
+
+
+def record_query(function: str, table: str, operation: str, seconds: float, rows: int = 0, error: bool = False):
+    """Учесть выполненный запрос в гистограммах и в текущем действии"""
+    trace = _current_action.get()
+    with _lock:
+        histogram = _query_metrics.get((function, table, operation))
+        if histogram is None:
+            histogram = _query_metrics[(function, table, operation)] = _Histogram()
+        histogram.observe(seconds, rows, error)
+        if trace is not None:
+            trace.queries += 1
+            trace.db_seconds += seconds
+            trace.errors += error
+
+
+class _TracedQuery:
+    """Построитель запроса, у которого замеряется execute()"""
+
+    def __init__(self, builder, table: str, operation: str = 'select'):
+        self._builder = builder
+        self._table = table
+        self._operation = operation
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self._builder, name)
+        operation = name if name in QUERY_OPERATIONS else self._operation
+        if not callable(attribute):
+            # Свойства вроде not_ возвращают тот же построитель
+            if hasattr(attribute, 'execute'):
+                return _TracedQuery(attribute, self._table, operation)
+            return attribute
+
+        @functools.wraps(attribute)
+        def method(*args, **kwargs):
+            result = attribute(*args, **kwargs)
+            if hasattr(result, 'execute'):
+                return _TracedQuery(result, self._table, operation)
+            return result
+        return method
+
+    def execute(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            result = self._builder.execute(*args, **kwargs)
+        except Exception:
+            record_query(_caller_name(), self._table, self._operation, time.perf_counter() - started, error=True)
+            raise
+        record_query(_caller_name(), self._table, self._operation, time.perf_counter() - started, _result_rows(result))
+        return result
+
+
+class TracedClient:
+    """Прокси клиента supabase: table() и rpc() возвращают трассируемые запросы"""
+
+    def __init__(self, client):
+        self._client = client
+
+    @property
+    def wrapped(self):
+        return self._client
+
+    def table(self, name: str) -> _TracedQuery:
+        return _TracedQuery(self._client.table(name), name)
+
+    def rpc(self, name: str, params: Optional[Dict[str, Any]] = None, *args, **kwargs) -> _TracedQuery:
+        return _TracedQuery(self._client.rpc(name, params, *args, **kwargs), 'rpc:' + name, 'rpc')
+
+    def __getattr__(self, name: str):
+        return getattr(self._client, name)
+
+
+def instrument(client):
+    """Обернуть клиент supabase, если трассировка включена"""
+    if not QUERY_TRACING_ENABLED or client is None or isinstance(client, TracedClient):
+        return client
+    return TracedClient(client)
+
+
+# ==================== ДЕЙСТВИЯ ПОЛЬЗОВАТЕЛЕЙ ====================
+
+def current_action() -> Optional[ActionTrace]:
+    return _current_action.get()
+
+
+def _finish_action(trace: ActionTrace, seconds: float, check_budget: bool):
+    with _lock:
+        histogram = _action_metrics.get(trace.name)
+        if histogram is None:
+            histogram = _action_metrics[trace.name] = _Histogram()
+            _action_counts[trace.name] = {'queries': 0, 'over_budget': 0}
+        histogram.observe(trace.db_seconds, trace.queries, trace.errors > 0)
+        counts = _action_counts[trace.name]
+        counts['queries'] += trace.queries
+        over_budget = check_budget and (trace.queries > QUERY_BUDGET_PER_ACTION
+                                        or trace.db_seconds * 1000 > QUERY_BUDGET_MS)
+        counts['over_budget'] += over_budget
+    if over_budget:
+        print(f"⚠️ [DB budget] {trace.name}: {trace.queries} запросов, {trace.db_seconds * 1000:.0f} мс в БД "
+              f"(всего {seconds * 1000:.0f} мс, ошибок {trace.errors})")
+
+
+@contextmanager
+def track_action(name: str, check_budget: bool = True):
+    """Привязать запросы внутри блока к действию name и проверить бюджет по окончании"""
+    trace = ActionTrace(name)
+    token = _current_action.set(trace)
+    started = time.perf_counter()
+    try:
+        yield trace
+    finally:
+        _current_action.reset(token)
+        _finish_action(trace, time.perf_counter() - started, check_budget)
+
+
+_NUMBER_RE = re.compile(r'\d+')
+
+
+def _callback_action_name(event) -> str:
+    data = getattr(event, 'data', None)
+    if not data:
+        return 'callback'
+    name = data.decode('utf-8', 'replace') if isinstance(data, bytes) else str(data)
+    # Числовые аргументы в любом месте (set_feed_3, feed_15min) не размножают метрики
+    return 'callback:' + _NUMBER_RE.sub('N', name)
+
+
+def traced_handler(func):
+    """Декоратор обработчика Telethon: запросы обработчика считаются одним действием"""
+    @functools.wraps(func)
+    async def wrapper(event):
+        name = _callback_action_name(event) if func.__name__ == 'callback_handler' else func.__name__
+        with track_action(name):
+            return await func(event)
+    return wrapper
+
+
+def traced_job(name: str):
+    """Декоратор фоновой задачи: запросы учитываются под именем задачи, без бюджета"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with track_action(name, check_budget=False):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# ==================== ОТЧЕТЫ ====================
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels) -> str:
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+def _render_histogram(lines: List[str], metric: str, histogram: _Histogram, labels: Dict[str, str]):
+    cumulative = 0
+    for bound, bucket in zip(DURATION_BUCKETS + (float('inf'),), histogram.buckets):
+        cumulative += bucket
+        le = '+Inf' if bound == float('inf') else repr(bound)
+        lines.append(f"{metric}_bucket{_labels(**labels, le=le)} {cumulative}")
+    lines.append(f"{metric}_sum{_labels(**labels)} {histogram.total:.6f}")
+    lines.append(f"{metric}_count{_labels(**labels)} {histogram.count}")
+
+
+def render_metrics() -> str:
+    """Метрики в текстовом формате Prometheus"""
+    with _lock:
+        queries = sorted(_query_metrics.items())
+        actions = sorted(_action_metrics.items())
+        counts = {name: dict(value) for name, value in _action_counts.items()}
+
+    lines = ['# HELP babybot_db_query_duration_seconds Duration of Supabase requests',
+             '# TYPE babybot_db_query_duration_seconds histogram']
+    for (function, table, operation), histogram in queries:
+        _render_histogram(lines, 'babybot_db_query_duration_seconds', histogram,
+                          {'function': function, 'table': table, 'op': operation})
+    lines += ['# HELP babybot_db_query_errors_total Failed Supabase requests (each one is retried)',
+              '# TYPE babybot_db_query_errors_total counter']
+    for (function, table, operation), histogram in queries:
+        lines.append(f"babybot_db_query_errors_total{_labels(function=function, table=table, op=operation)} "
+                     f"{histogram.errors}")
+    lines += ['# HELP babybot_db_query_rows_total Rows returned by Supabase requests',
+              '# TYPE babybot_db_query_rows_total counter']
+    for (function, table, operation), histogram in queries:
+        lines.append(f"babybot_db_query_rows_total{_labels(function=function, table=table, op=operation)} "
+                     f"{histogram.rows}")
+
+    lines += ['# HELP babybot_action_db_seconds Time spent in Supabase per bot action',
+              '# TYPE babybot_action_db_seconds histogram']
+    for name, histogram in actions:
+        _render_histogram(lines, 'babybot_action_db_seconds', histogram, {'action': name})
+    lines += ['# HELP babybot_action_queries_total Supabase requests made by bot actions',
+              '# TYPE babybot_action_queries_total counter']
+    for name, _ in actions:
+        lines.append(f"babybot_action_queries_total{_labels(action=name)} {counts[name]['queries']}")
+    lines += ['# HELP babybot_action_over_budget_total Bot actions that exceeded the query budget',
+              '# TYPE babybot_action_over_budget_total counter']
+    for name, _ in actions:
+        lines.append(f"babybot_action_over_budget_total{_labels(action=name)} {counts[name]['over_budget']}")
+    return '\n'.join(lines) + '\n'
+
+
+def get_query_summary(limit: int = 10) -> List[Dict[str, Any]]:
+    """Функции с наибольшим суммарным временем запросов"""
+    with _lock:
+        items = [(key, histogram.count, histogram.total, histogram.errors, histogram.rows, histogram.quantile(0.99))
+                 for key, histogram in _query_metrics.items()]
+    items.sort(key=lambda item: item[2], reverse=True)
+    return [
+        {'function': function, 'table': table, 'op': operation, 'count': count, 'total_seconds': total,
+         'avg_ms': total / count * 1000 if count else 0.0, 'p99_ms': p99 * 1000, 'errors': errors, 'rows': rows}
+        for (function, table, operation), count, total, errors, rows, p99 in items[:limit]
+    ]
+
+
+def log_summary(limit: int = 10):
+    """Записать в журнал самые дорогие запросы и действия"""
+    summary = get_query_summary(limit)
+    if not summary:
+        return
+    print(f"📈 [DB] Самые дорогие запросы (топ {len(summary)}):")
+    for item in summary:
+        print(f"   {item['function']} {item['op']} {item['table']}: {item['count']} шт., "
+              f"{item['total_seconds']:.1f} с, в среднем {item['avg_ms']:.0f} мс, p99 ≤ {item['p99_ms']:.0f} мс, "
+              f"ошибок {item['errors']}")
+    with _lock:
+        actions = [(name, histogram.count, _action_counts[name]['queries'], histogram.total,
+                    _action_counts[name]['over_budget']) for name, histogram in _action_metrics.items()]
+    for name, count, queries, total, over_budget in sorted(actions, key=lambda item: item[3], reverse=True)[:limit]:
+        print(f"   [{name}] {count} раз, {queries / count:.1f} запросов и {total / count * 1000:.0f} мс на действие, "
+              f"сверх бюджета {over_budget}")
+
+
+def reset_metrics():
+    """Очистить накопленные метрики"""
+    with _lock:
+        _query_metrics.clear()
+        _action_metrics.clear()
+        _action_counts.clear()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip('/') not in ('', '/metrics'):
+            self.send_error(404)
+            return
+        body = render_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int = METRICS_PORT) -> bool:
+    """Отдавать /metrics по HTTP в фоновом потоке (если задан METRICS_PORT)"""
+    global _metrics_server
+    if not port or _metrics_server is not None:
+        return False
+    try:
+        _metrics_server = ThreadingHTTPServer(('0.0.0.0', port), _MetricsHandler)
+    except OSError as e:
+        print(f"❌ Не удалось запустить сервер метрик на порту {port}: {e}")
+        return False
+    threading.Thread(target=_metrics_server.serve_forever, name='metrics', daemon=True).start()
+    print(f"📈 Метрики запросов доступны на http://0.0.0.0:{port}/metrics")
+    return True
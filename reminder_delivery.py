@@ -0,0 +1,219 @@
+"""
+Доставка напоминаний в Telegram
+Несколько обработчиков разбирают outbox параллельно, соблюдая лимиты Telegram:
+общий (~30 сообщений в секунду на бота) и не чаще одного сообщения в секунду в один чат.
+FloodWait приостанавливает отправку на указанное Telegram время, неудачные сообщения
+повторяются с задержкой, а после исчерпания попыток помечаются в outbox как dead
+"""
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional, Set
+
+from telethon import Button
+from telethon.errors import (
+    FloodWaitError, InputUserDeactivatedError, PeerIdInvalidError, UserIsBlockedError
+)
+
+import reminder_outbox
+import sharding
+
+# Лимит Telegram общий для бота, поэтому он делится между воркерами
+GLOBAL_RATE_PER_SECOND = float(os.getenv('DELIVERY_RATE_PER_SECOND', '30')) / sharding.WORKER_COUNT
+PER_CHAT_INTERVAL_SECONDS = 1.0
+DELIVERY_WORKERS = int(os.getenv('DELIVERY_WORKERS', '8'))
+MAX_DELIVERY_ATTEMPTS = 5
+RETRY_BASE_DELAY_SECONDS = 2
+IDLE_POLL_SECONDS = 0.5
+BUSY_POLL_SECONDS = 0.05
+
+# Ошибки, при которых повтор бессмысленен: пользователь заблокировал бота или удален
+PERMANENT_ERRORS = (UserIsBlockedError, InputUserDeactivatedError, PeerIdInvalidError)
+
+delivery_stats = {'delivered': 0, 'retried': 0, 'flood_waits': 0, 'dead': 0}
+
+_tokens = GLOBAL_RATE_PER_SECOND
+_tokens_updated: Optional[float] = None
+_paused_until = 0.0
+_chat_ready_at: Dict[int, float] = {}
+# Ключи доставки, которые уже переданы обработчикам и еще не завершены
+_inflight: Set[str] = set()
+# Отправленные напоминания, отметку которых в outbox не удалось записать: повторяется
+# только отметка, а ключи остаются в _inflight, поэтому сообщение не уходит второй раз
+_pending_marks: Set[str] = set()
+# Запросы к SQLite outbox ждут его блокировку вместе с проверкой напоминаний, поэтому
+# выполняются в отдельном потоке, а не в цикле событий; один поток сохраняет их порядок
+_outbox_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='outbox')
+
+
+async def _run_outbox(func, *args):
+    """Выполнить функцию reminder_outbox в потоке outbox"""
+    return await asyncio.get_running_loop().run_in_executor(_outbox_executor, func, *args)
+
+
+async def _acquire_global_slot():
+    """Дождаться свободного места в общем лимите отправки (token bucket)"""
+    global _tokens, _tokens_updated
+    loop = asyncio.get_running_loop()
+    while True:
+        now = loop.time()
+        if _tokens_updated is None:
+            _tokens_updated = now
+        _tokens = min(GLOBAL_RATE_PER_SECOND, _tokens + (now - _tokens_updated) * GLOBAL_RATE_PER_SECOND)
+        _tokens_updated = now
+
+        if now < _paused_until:
+            await asyncio.sleep(_paused_until - now)
+            continue
+        if _tokens >= 1:
+            _tokens -= 1
+            return
+        await asyncio.sleep((1 - _tokens) / GLOBAL_RATE_PER_SECOND)
+
+
+def _reserve_chat_slot(user_id: int) -> float:
+    """Занять слот отправки в чат; если писать еще рано - вернуть, сколько секунд ждать"""
+    now = asyncio.get_running_loop().time()
+    ready_at = _chat_ready_at.get(user_id, 0.0)
+    if now < ready_at:
+        return ready_at - now
+    _chat_ready_at[user_id] = now + PER_CHAT_INTERVAL_SECONDS
+    return 0.0
+
+
+def _pause_for_flood_wait(user_id: int, seconds: int):
+    """Остановить отправку на время, указанное Telegram в FloodWait"""
+    global _paused_until
+    loop = asyncio.get_running_loop()
+    resume_at = loop.time() + seconds
+    _paused_until = max(_paused_until, resume_at)
+    _chat_ready_at[user_id] = max(_chat_ready_at.get(user_id, 0.0), resume_at)
+
+
+def _cleanup_chat_slots():
+    """Удалить записи чатов, в которые уже можно писать"""
+    now = asyncio.get_running_loop().time()
+    for user_id in [uid for uid, ready_at in _chat_ready_at.items() if ready_at <= now]:
+        del _chat_ready_at[user_id]
+
+
+async def _send_to_dead_letters(reminder: Dict[str, Any], error: Exception):
+    """Прекратить доставку напоминания, которое не удалось отправить"""
+    await _run_outbox(reminder_outbox.mark_dead, reminder['delivery_key'], repr(error))
+    delivery_stats['dead'] += 1
+    print(f"[Delivery] Reminder for user {reminder['user_id']} moved to dead letters: {error}")
+
+
+def _build_buttons(spec):
+    if not spec:
+        return None
+    return [[Button.inline(text, data) for text, data in row] for row in spec]
+
+
+async def _mark_delivered(delivery_key: str) -> bool:
+    """Отметить отправленное напоминание; при ошибке отметка откладывается в _pending_marks"""
+    try:
+        await _run_outbox(reminder_outbox.mark_delivered, delivery_key)
+        return True
+    except Exception as e:
+        print(f"[Delivery] Reminder {delivery_key} sent but not marked delivered, retrying the mark: {e}")
+        _pending_marks.add(delivery_key)
+        return False
+
+
+async def _retry_pending_marks():
+    """Повторить отложенные отметки о доставке"""
+    for delivery_key in list(_pending_marks):
+        try:
+            await _run_outbox(reminder_outbox.mark_delivered, delivery_key)
+        except Exception:
+            continue
+        _pending_marks.discard(delivery_key)
+        _inflight.discard(delivery_key)
+
+
+async def deliver_reminder(client, reminder: Dict[str, Any]):
+    """Отправить одно напоминание с учетом общего лимита и повторов (слот чата уже занят)"""
+    user_id = reminder['user_id']
+    delivery_key = reminder['delivery_key']
+    await _acquire_global_slot()
+    try:
+        await client.send_message(user_id, reminder['message'], buttons=_build_buttons(reminder.get('buttons')))
+    except FloodWaitError as e:
+        # Ожидание FloodWait не считается неудачной попыткой
+        delivery_stats['flood_waits'] += 1
+        print(f"[Delivery] FloodWait {e.seconds}s while sending to user {user_id}")
+        _pause_for_flood_wait(user_id, e.seconds)
+        await _run_outbox(reminder_outbox.reschedule, delivery_key, reminder.get('attempts', 0), e.seconds, repr(e))
+    except PERMANENT_ERRORS as e:
+        await _send_to_dead_letters(reminder, e)
+    except Exception as e:
+        attempts = reminder.get('attempts', 0) + 1
+        if attempts >= MAX_DELIVERY_ATTEMPTS:
+            await _send_to_dead_letters(reminder, e)
+            return
+        delivery_stats['retried'] += 1
+        delay = RETRY_BASE_DELAY_SECONDS * (2 ** (attempts - 1))
+        print(f"[Delivery] Failed to send reminder to user {user_id} (attempt {attempts}), retry in {delay}s: {e}")
+        await _run_outbox(reminder_outbox.reschedule, delivery_key, attempts, delay, repr(e))
+    else:
+        delivery_stats['delivered'] += 1
+        await _mark_delivered(delivery_key)
+
+
+async def _delivery_worker(client, queue: asyncio.Queue):
+    """Обработчик очереди: забирает напоминания и отправляет их"""
+    loop = asyncio.get_running_loop()
+    while True:
+        reminder = await queue.get()
+        try:
+            wait = _reserve_chat_slot(reminder['user_id'])
+            if wait > 0:
+                # В чат писать рано: напоминание вернется в очередь, обработчик берет следующее
+                loop.call_later(wait, queue.put_nowait, reminder)
+                continue
+            try:
+                await deliver_reminder(client, reminder)
+            except Exception as e:
+                print(f"[Delivery] Unexpected error while delivering to user {reminder.get('user_id')}: {e}")
+            if reminder['delivery_key'] not in _pending_marks:
+                _inflight.discard(reminder['delivery_key'])
+        finally:
+            queue.task_done()
+
+
+async def _pump_outbox(queue: asyncio.Queue, batch_size: int):
+    """Передавать обработчикам напоминания из outbox, срок отправки которых наступил"""
+    loop = asyncio.get_running_loop()
+    last_cleanup = loop.time()
+    while True:
+        free = batch_size - queue.qsize()
+        reminders = await _run_outbox(reminder_outbox.claim_due, free, set(_inflight)) if free > 0 else []
+        for reminder in reminders:
+            _inflight.add(reminder['delivery_key'])
+            queue.put_nowait(reminder)
+        if _pending_marks:
+            await _retry_pending_marks()
+        if loop.time() - last_cleanup >= 60:
+            _cleanup_chat_slots()
+            last_cleanup = loop.time()
+        # Пока outbox не разобран, очередь пополняется часто, иначе - редкий опрос
+        busy = bool(reminders) or free <= 0
+        await asyncio.sleep(BUSY_POLL_SECONDS if busy else IDLE_POLL_SECONDS)
+
+
+async def run_delivery_workers(client, workers: int = DELIVERY_WORKERS):
+    """Запустить пул обработчиков доставки (работает до отмены)"""
+    queue: asyncio.Queue = asyncio.Queue()
+    tasks = [asyncio.create_task(_delivery_worker(client, queue)) for _ in range(workers)]
+    try:
+        await _pump_outbox(queue, batch_size=workers * 4)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def get_delivery_stats() -> Dict[str, Any]:
+    """Статистика доставки"""
+    return {**delivery_stats, 'outbox': reminder_outbox.get_outbox_stats()}
@@ -0,0 +1,183 @@
+"""
+Надежная очередь напоминаний (outbox) в локальной SQLite
+Напоминание записывается в outbox до отметки об отправке в notification_tracking,
+а доставленным помечается только после успешной отправки в Telegram.
+Ключ доставки делает постановку в очередь идемпотентной: повторная проверка
+после перезапуска не создает дубликатов, а недоставленные записи отправляются снова
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+import sharding
+
+# У каждого воркера свой outbox: он доставляет напоминания своих семей
+OUTBOX_PATH = os.getenv('REMINDER_OUTBOX_PATH') or (
+    f'reminder_outbox.{sharding.WORKER_INDEX}.db' if sharding.is_sharded() else 'reminder_outbox.db'
+)
+OUTBOX_RETENTION_DAYS = 7
+
+STATUS_PENDING = 'pending'
+STATUS_DELIVERED = 'delivered'
+STATUS_DEAD = 'dead'
+
+_connection: Optional[sqlite3.Connection] = None
+_lock = threading.Lock()
+
+
+def _get_connection() -> sqlite3.Connection:
+    """Открыть базу outbox и создать таблицу при первом обращении"""
+    global _connection
+    if _connection is None:
+        connection = sqlite3.connect(OUTBOX_PATH, check_same_thread=False, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        # WAL + NORMAL переживает падение процесса без fsync на каждую запись
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                delivery_key TEXT PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                family_id INTEGER,
+                message TEXT NOT NULL,
+                buttons TEXT,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                available_at REAL NOT NULL,
+                created_at REAL NOT NULL,
+                finished_at REAL,
+                error TEXT
+            )
+        """)
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox (status, available_at)"
+        )
+        _connection = connection
+    return _connection
+
+
+def _encode_buttons(buttons: Optional[List[List[tuple]]]) -> Optional[str]:
+    """Кнопки хранятся как [[текст, данные], ...] по строкам клавиатуры"""
+    if not buttons:
+        return None
+    return json.dumps([
+        [[text, data.decode('utf-8') if isinstance(data, bytes) else data] for text, data in row]
+        for row in buttons
+    ], ensure_ascii=False)
+
+
+def _decode_buttons(raw: Optional[str]) -> Optional[List[List[tuple]]]:
+    if not raw:
+        return None
+    return [[(text, data.encode('utf-8')) for text, data in row] for row in json.loads(raw)]
+
+
+def _row_to_reminder(row: sqlite3.Row) -> Dict[str, Any]:
+    return {
+        'delivery_key': row['delivery_key'],
+        'user_id': row['user_id'],
+        'family_id': row['family_id'],
+        'message': row['message'],
+        'buttons': _decode_buttons(row['buttons']),
+        'attempts': row['attempts'],
+    }
+
+
+def enqueue(reminders: Iterable[Dict[str, Any]]) -> int:
+    """Записать напоминания в outbox; уже известные ключи доставки пропускаются"""
+    now = time.time()
+    rows = [
+        (
+            reminder['delivery_key'], reminder['user_id'], reminder.get('family_id'),
+            reminder['message'], _encode_buttons(reminder.get('buttons')), now, now
+        )
+        for reminder in reminders
+    ]
+    if not rows:
+        return 0
+    with _lock:
+        connection = _get_connection()
+        before = connection.total_changes
+        connection.execute("BEGIN")
+        connection.executemany(
+            "INSERT OR IGNORE INTO outbox "
+            "(delivery_key, user_id, family_id, message, buttons, available_at, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            rows
+        )
+        connection.execute("COMMIT")
+        return connection.total_changes - before
+
+
+def claim_due(limit: int, exclude: Set[str]) -> List[Dict[str, Any]]:
+    """Получить ожидающие напоминания, срок отправки которых наступил"""
+    with _lock:
+        rows = _get_connection().execute(
+            "SELECT * FROM outbox WHERE status = ? AND available_at <= ? "
+            "ORDER BY available_at LIMIT ?",
+            (STATUS_PENDING, time.time(), limit + len(exclude))
+        ).fetchall()
+    reminders = [_row_to_reminder(row) for row in rows if row['delivery_key'] not in exclude]
+    return reminders[:limit]
+
+
+def mark_delivered(delivery_key: str):
+    """Отметить напоминание доставленным"""
+    with _lock:
+        _get_connection().execute(
+            "UPDATE outbox SET status = ?, finished_at = ?, error = NULL WHERE delivery_key = ?",
+            (STATUS_DELIVERED, time.time(), delivery_key)
+        )
+
+
+def reschedule(delivery_key: str, attempts: int, delay: float, error: Optional[str] = None):
+    """Отложить повторную отправку напоминания на delay секунд"""
+    with _lock:
+        _get_connection().execute(
+            "UPDATE outbox SET attempts = ?, available_at = ?, error = ? WHERE delivery_key = ?",
+            (attempts, time.time() + delay, error, delivery_key)
+        )
+
+
+def mark_dead(delivery_key: str, error: str):
+    """Перестать доставлять напоминание (dead letter)"""
+    with _lock:
+        _get_connection().execute(
+            "UPDATE outbox SET status = ?, finished_at = ?, error = ? WHERE delivery_key = ?",
+            (STATUS_DEAD, time.time(), error, delivery_key)
+        )
+
+
+def get_dead_letters(limit: int = 100) -> List[Dict[str, Any]]:
+    """Последние напоминания, которые не удалось доставить"""
+    with _lock:
+        rows = _get_connection().execute(
+            "SELECT * FROM outbox WHERE status = ? ORDER BY finished_at DESC LIMIT ?",
+            (STATUS_DEAD, limit)
+        ).fetchall()
+    return [{**_row_to_reminder(row), 'error': row['error']} for row in rows]
+
+
+def purge_finished(days: int = OUTBOX_RETENTION_DAYS) -> int:
+    """Удалить доставленные и отброшенные записи старше days дней"""
+    with _lock:
+        cursor = _get_connection().execute(
+            "DELETE FROM outbox WHERE status != ? AND finished_at < ?",
+            (STATUS_PENDING, time.time() - days * 86400)
+        )
+        return cursor.rowcount
+
+
+def get_outbox_stats() -> Dict[str, int]:
+    """Количество записей outbox по статусам"""
+    with _lock:
+        rows = _get_connection().execute(
+            "SELECT status, COUNT(*) AS count FROM outbox GROUP BY status"
+        ).fetchall()
+    stats = {STATUS_PENDING: 0, STATUS_DELIVERED: 0, STATUS_DEAD: 0}
+    stats.update({row['status']: row['count'] for row in rows})
+    return stats
@@ -0,0 +1,121 @@
+"""
+Планировщик напоминаний по точному времени срабатывания
+Для каждой семьи хранятся моменты, когда нужно проверить напоминания
+(срок кормления/смены подгузника и просрочка), в куче, упорядоченной по времени.
+Запись события или смена интервала пересчитывают моменты только этой семьи
+"""
+
+import heapq
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# Небольшой запас, чтобы проверка гарантированно попала после наступления срока
+FIRE_SLACK_SECONDS = 1
+
+# (время срабатывания, family_id, поколение); записи устаревших поколений пропускаются
+_heap: List[Tuple[float, int, int]] = []
+_generations: Dict[int, int] = {}
+_live_entries: Dict[int, int] = {}
+_live_total = 0
+_lock = threading.Lock()
+
+
+def compute_fire_times(settings: Dict[str, Any], last_feeding: Optional[datetime],
+                       last_diaper: Optional[datetime], offsets_minutes: Iterable[int],
+                       now: datetime) -> List[datetime]:
+    """Вычислить будущие моменты проверки напоминаний для семьи"""
+    events = (
+        (last_feeding, settings.get('feed_interval', 3)),
+        (last_diaper, settings.get('diaper_interval', 2)),
+    )
+    fire_times = []
+    for last_event, interval in events:
+        if not last_event:
+            continue
+        due_at = last_event + timedelta(hours=interval)
+        for offset in offsets_minutes:
+            fire_at = due_at + timedelta(minutes=offset, seconds=FIRE_SLACK_SECONDS)
+            if fire_at > now:
+                fire_times.append(fire_at)
+    return fire_times
+
+
+def schedule_family(family_id: int, fire_times: Iterable[datetime]):
+    """Заменить запланированные проверки семьи новыми моментами"""
+    global _live_total
+    with _lock:
+        generation = _generations.get(family_id, 0) + 1
+        _generations[family_id] = generation
+        count = 0
+        for fire_at in fire_times:
+            heapq.heappush(_heap, (fire_at.timestamp(), family_id, generation))
+            count += 1
+        _live_total += count - _live_entries.pop(family_id, 0)
+        if count:
+            _live_entries[family_id] = count
+        _compact_if_needed()
+
+
+def unschedule_family(family_id: int):
+    """Отменить все запланированные проверки семьи"""
+    schedule_family(family_id, ())
+
+
+def clear_schedule():
+    """Отменить проверки всех семей"""
+    global _live_total
+    with _lock:
+        _heap.clear()
+        _generations.clear()
+        _live_entries.clear()
+        _live_total = 0
+
+
+def pop_due_families(now_ts: Optional[float] = None) -> List[int]:
+    """Извлечь семьи, проверки которых наступили"""
+    global _live_total
+    now_ts = time.time() if now_ts is None else now_ts
+    due = []
+    with _lock:
+        while _heap and _heap[0][0] <= now_ts:
+            _, family_id, generation = heapq.heappop(_heap)
+            if _generations.get(family_id) != generation:
+                continue
+            remaining = _live_entries.get(family_id, 1) - 1
+            _live_total -= 1
+            if remaining > 0:
+                _live_entries[family_id] = remaining
+            else:
+                _live_entries.pop(family_id, None)
+            due.append(family_id)
+    return list(dict.fromkeys(due))
+
+
+def seconds_until_next(now_ts: Optional[float] = None) -> Optional[float]:
+    """Сколько секунд до ближайшей проверки (None, если ничего не запланировано)"""
+    now_ts = time.time() if now_ts is None else now_ts
+    with _lock:
+        while _heap and _generations.get(_heap[0][1]) != _heap[0][2]:
+            heapq.heappop(_heap)
+        if not _heap:
+            return None
+        return max(0.0, _heap[0][0] - now_ts)
+
+
+def _compact_if_needed():
+    """Пересобрать кучу, если в ней накопилось много устаревших записей"""
+    if len(_heap) > 2 * _live_total + 1000:
+        _heap[:] = [entry for entry in _heap if _generations.get(entry[1]) == entry[2]]
+        heapq.heapify(_heap)
+
+
+def get_scheduler_stats() -> Dict[str, Any]:
+    """Статистика планировщика"""
+    with _lock:
+        return {
+            'scheduled_families': len(_live_entries),
+            'live_entries': _live_total,
+            'heap_size': len(_heap),
+        }
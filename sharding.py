@@ -0,0 +1,189 @@
+"""
+Несколько воркеров бота, разделивших семьи между собой
+Воркер WORKER_INDEX из WORKER_COUNT проверяет напоминания и доставляет их только
+для семей с family_id % WORKER_COUNT == WORKER_INDEX. Владение шардом подтверждается
+арендой в таблице worker_leases: если воркер остановился и не продлевает аренду,
+его шард забирает другой воркер, а после перезапуска владелец возвращает шард себе.
+Общие задачи (очистка notification_tracking) выполняет держатель аренды cleanup.
+С WORKER_COUNT=1 (по умолчанию) бот работает как один процесс без аренд
+"""
+
+import os
+import socket
+import threading
+import time
+from typing import Any, Dict, FrozenSet, Iterable, List, Set
+
+WORKER_INDEX = int(os.getenv('WORKER_INDEX', '0'))
+WORKER_COUNT = max(1, int(os.getenv('WORKER_COUNT', '1')))
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{WORKER_INDEX}"
+LEASE_TTL_SECONDS = 90
+LEASE_RENEW_SECONDS = 30
+CLEANUP_LEASE = 'cleanup'
+
+# Шарды и аренды заменяются целиком при продлении, поэтому читатели не берут блокировку
+_owned_shards: FrozenSet[int] = frozenset({WORKER_INDEX})
+_held_leases: FrozenSet[str] = frozenset()
+_renew_lock = threading.Lock()
+_leases_available = True
+# До этого момента (time.monotonic) аренды последнего продления точно действуют
+_leases_valid_until = 0.0
+
+
+def _client():
+    import supabase_client
+    return supabase_client.supabase
+
+
+def check_config() -> bool:
+    """Проверить, что WORKER_INDEX входит в диапазон воркеров (при запуске бота)"""
+    if 0 <= WORKER_INDEX < WORKER_COUNT:
+        return True
+    print(f"❌ ОШИБКА: WORKER_INDEX должен быть от 0 до {WORKER_COUNT - 1}")
+    return False
+
+
+def is_sharded() -> bool:
+    return WORKER_COUNT > 1
+
+
+def shard_of(family_id: int) -> int:
+    return family_id % WORKER_COUNT
+
+
+def owns_family(family_id: int) -> bool:
+    """Проверяет ли этот воркер напоминания семьи"""
+    return WORKER_COUNT == 1 or family_id % WORKER_COUNT in _owned_shards
+
+
+def filter_owned(family_ids: Iterable[int]) -> List[int]:
+    """Семьи из списка, принадлежащие шардам этого воркера"""
+    return [family_id for family_id in family_ids if owns_family(family_id)]
+
+
+def session_name(base: str = 'babybot') -> str:
+    """Файл сессии Telethon: у каждого воркера свой"""
+    return f"{base}-{WORKER_INDEX}" if is_sharded() else base
+
+
+def handles_updates() -> bool:
+    """Принимает ли воркер сообщения пользователей (по умолчанию - только воркер 0)"""
+    default = '1' if WORKER_INDEX == 0 else '0'
+    return os.getenv('BOT_HANDLE_UPDATES', default) != '0'
+
+
+def is_leader(lease: str = CLEANUP_LEASE) -> bool:
+    """Держит ли воркер аренду общей задачи"""
+    if not is_sharded():
+        return True
+    if not _leases_available:
+        return WORKER_INDEX == 0
+    return lease in _held_leases
+
+
+def _shard_lease(shard: int) -> str:
+    return f"shard:{shard}"
+
+
+def _acquire(name: str, preempt: bool = False) -> bool:
+    result = _client().rpc('acquire_lease', {
+        'p_name': name,
+        'p_holder': WORKER_ID,
+        'p_ttl_seconds': LEASE_TTL_SECONDS,
+        'p_preempt': preempt,
+    }).execute()
+    return bool(result.data)
+
+
+def renew_leases() -> Set[int]:
+    """Продлить аренды (каждые LEASE_RENEW_SECONDS); возвращает шарды, полученные заново"""
+    global _owned_shards, _held_leases, _leases_available, _leases_valid_until
+    if not is_sharded() or not _leases_available:
+        return set()
+    import supabase_client
+    with _renew_lock:
+        held: Set[str] = set()
+        owned: Set[int] = set()
+        started = time.monotonic()
+        try:
+            for shard in range(WORKER_COUNT):
+                # Свой шард забирается даже у временного владельца, чужой - только после истечения аренды
+                if _acquire(_shard_lease(shard), preempt=shard == WORKER_INDEX):
+                    held.add(_shard_lease(shard))
+                    owned.add(shard)
+            if _acquire(CLEANUP_LEASE):
+                held.add(CLEANUP_LEASE)
+        except Exception as e:
+            if supabase_client._is_missing_function_error(e):
+                print("⚠️ Функция acquire_lease не найдена (supabase_schema.sql); воркеры работают без аренд")
+                _leases_available = False
+                return set()
+            # Без связи с БД воркер сохраняет свои аренды до их истечения (verify_leases)
+            print(f"❌ Ошибка продления аренд воркера {WORKER_INDEX}: {e}")
+            return set()
+
+        owned.add(WORKER_INDEX)
+        gained = owned - _owned_shards
+        lost = _owned_shards - owned
+        _owned_shards = frozenset(owned)
+        _held_leases = frozenset(held)
+        _leases_valid_until = started + LEASE_TTL_SECONDS
+    if gained - {WORKER_INDEX}:
+        print(f"🔀 Воркер {WORKER_INDEX} взял шарды {sorted(gained - {WORKER_INDEX})}")
+    if lost:
+        print(f"🔀 Воркер {WORKER_INDEX} отдал шарды {sorted(lost)}")
+    return gained
+
+
+def verify_leases():
+    """Перед проверкой напоминаний отдать чужие шарды, аренду которых забрал владелец или она истекла.
+    Владелец забирает свой шард сразу, а не после истечения аренды, поэтому без этой проверки
+    временный держатель отправлял бы напоминания его семей до следующего продления"""
+    global _owned_shards, _held_leases
+    if not is_sharded() or not _leases_available:
+        return
+    with _renew_lock:
+        foreign = _owned_shards - {WORKER_INDEX}
+        if not foreign:
+            return
+        if time.monotonic() >= _leases_valid_until:
+            lost = set(foreign)
+        else:
+            names = {_shard_lease(shard): shard for shard in foreign}
+            try:
+                result = _client().table('worker_leases').select('name, holder').in_('name', list(names)).execute()
+            except Exception as e:
+                # Аренды последнего продления еще действуют, поэтому шарды остаются до следующей проверки
+                print(f"❌ Ошибка проверки аренд воркера {WORKER_INDEX}: {e}")
+                return
+            kept = {names[row['name']] for row in result.data or [] if row['holder'] == WORKER_ID}
+            lost = foreign - kept
+        if not lost:
+            return
+        _owned_shards = _owned_shards - lost
+        _held_leases = _held_leases - {_shard_lease(shard) for shard in lost}
+    print(f"🔀 Воркер {WORKER_INDEX} отдал шарды {sorted(lost)}: аренда истекла или перешла к другому воркеру")
+
+
+def release_leases():
+    """Освободить аренды при остановке, чтобы шард сразу подхватил другой воркер"""
+    global _held_leases
+    if not is_sharded() or not _leases_available:
+        return
+    for name in _held_leases:
+        try:
+            _client().rpc('release_lease', {'p_name': name, 'p_holder': WORKER_ID}).execute()
+        except Exception as e:
+            print(f"❌ Ошибка освобождения аренды {name}: {e}")
+    _held_leases = frozenset()
+
+
+def get_shard_stats() -> Dict[str, Any]:
+    return {
+        'worker_index': WORKER_INDEX,
+        'worker_count': WORKER_COUNT,
+        'worker_id': WORKER_ID,
+        'owned_shards': sorted(_owned_shards),
+        'leases': sorted(_held_leases),
+        'leases_available': _leases_available,
+    }
@@ -0,0 +1,65 @@
+"""
+Индекс открытых сессий сна в памяти
+Для каждой семьи, в которой малыш сейчас спит, хранятся id и начало открытой
+сессии (строка sleep_sessions без end_time). Индекс загружается одним запросом по
+частичному индексу на открытые сессии, а дальше его обновляют начало и конец сна,
+поэтому проверка напоминаний не читает sleep_sessions для каждой семьи
+"""
+
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, Optional, Tuple
+
+# family_id -> (id сессии, начало сна)
+_open: Dict[int, Tuple[int, datetime]] = {}
+_lock = threading.Lock()
+_loaded = False
+
+
+def is_loaded() -> bool:
+    return _loaded
+
+
+def load(rows: Iterable[Dict[str, object]], family_ids: Optional[Iterable[int]] = None):
+    """Заменить записи индекса открытыми сессиями (всех семей или указанных).
+    В строках id, family_id и start_time уже в виде datetime"""
+    global _loaded
+    loaded = {row['family_id']: (row['id'], row['start_time']) for row in rows}
+    with _lock:
+        if family_ids is None:
+            _open.clear()
+            _loaded = True
+        else:
+            for family_id in family_ids:
+                _open.pop(family_id, None)
+        _open.update(loaded)
+
+
+def start(family_id: int, session_id: int, start_time: datetime):
+    """Учесть начатую сессию сна"""
+    with _lock:
+        _open[family_id] = (session_id, start_time)
+
+
+def stop(family_id: int) -> Optional[Tuple[int, datetime]]:
+    """Убрать сессию семьи из индекса; возвращает (id, начало) закрытой сессии"""
+    with _lock:
+        return _open.pop(family_id, None)
+
+
+def get(family_id: int) -> Optional[Tuple[int, datetime]]:
+    with _lock:
+        return _open.get(family_id)
+
+
+def snapshot(family_ids: Optional[Iterable[int]] = None) -> Dict[int, datetime]:
+    """Начало сна спящих малышей для проверки напоминаний (всех семей или указанных)"""
+    with _lock:
+        if family_ids is None:
+            return {family_id: start_time for family_id, (_, start_time) in _open.items()}
+        return {family_id: _open[family_id][1] for family_id in set(family_ids) if family_id in _open}
+
+
+def get_index_stats() -> Dict[str, object]:
+    with _lock:
+        return {'loaded': _loaded, 'sleeping': len(_open)}
@@ -0,0 +1,103 @@
+"""
+Асинхронный доступ к Supabase для обработчиков Telethon
+Блокирующие функции supabase_client выполняются в ограниченном пуле потоков,
+а паузы между повторными попытками ждутся через asyncio.sleep,
+поэтому медленный запрос одной семьи не останавливает обработку остальных
+"""
+
+import asyncio
+import contextvars
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import supabase_client
+from supabase_client import QueryRetryNeeded, run_with_deferred_retries
+
+# Сколько запросов к Supabase может выполняться одновременно
+DB_EXECUTOR_WORKERS = int(os.getenv('DB_EXECUTOR_WORKERS', '16'))
+DB_MAX_RETRIES = 5
+DB_RETRY_DELAY = 1
+
+_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix='supabase')
+
+
+async def run_db(func, *args, **kwargs):
+    """Выполнить блокирующую функцию в пуле потоков для запросов к БД"""
+    loop = asyncio.get_running_loop()
+    # Контекст копируется, чтобы запросы учитывались в действии обработчика (query_tracing)
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(_executor, functools.partial(context.run, func, *args, **kwargs))
+
+
+async def call_db(func, *args, **kwargs):
+    """Выполнить функцию supabase_client с асинхронными повторными попытками"""
+    for attempt in range(DB_MAX_RETRIES):
+        final_attempt = attempt == DB_MAX_RETRIES - 1
+        try:
+            return await run_db(run_with_deferred_retries, final_attempt, func, *args, **kwargs)
+        except QueryRetryNeeded:
+            # Экспоненциальная задержка без блокировки цикла событий
+            await asyncio.sleep(min(DB_RETRY_DELAY * (2 ** attempt), 10))
+    return None
+
+
+def _async_api(func):
+    """Сделать асинхронный вариант функции supabase_client"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await call_db(func, *args, **kwargs)
+    return wrapper
+
+
+def shutdown():
+    """Остановить пул потоков"""
+    _executor.shutdown(wait=False)
+
+
+# ==================== АСИНХРОННЫЙ API ====================
+
+get_family_id = _async_api(supabase_client.get_family_id)
+create_family = _async_api(supabase_client.create_family)
+join_family_by_code = _async_api(supabase_client.join_family_by_code)
+get_family_name = _async_api(supabase_client.get_family_name)
+get_member_info = _async_api(supabase_client.get_member_info)
+set_member_role = _async_api(supabase_client.set_member_role)
+get_family_members_with_roles = _async_api(supabase_client.get_family_members_with_roles)
+
+get_family_state = _async_api(supabase_client.get_family_state)
+
+add_feeding = _async_api(supabase_client.add_feeding)
+get_last_feeding_time_for_family = _async_api(supabase_client.get_last_feeding_time_for_family)
+add_diaper_change = _async_api(supabase_client.add_diaper_change)
+get_last_diaper_change_time_for_family = _async_api(supabase_client.get_last_diaper_change_time_for_family)
+check_recent_feeding = _async_api(supabase_client.check_recent_feeding)
+check_recent_diaper_change = _async_api(supabase_client.check_recent_diaper_change)
+add_bath = _async_api(supabase_client.add_bath)
+add_activity = _async_api(supabase_client.add_activity)
+get_sleep_start_time = _async_api(supabase_client.get_sleep_start_time)
+start_sleep = _async_api(supabase_client.start_sleep)
+stop_sleep = _async_api(supabase_client.stop_sleep)
+
+get_user_intervals = _async_api(supabase_client.get_user_intervals)
+set_user_interval = _async_api(supabase_client.set_user_interval)
+get_birth_date = _async_api(supabase_client.get_birth_date)
+set_birth_date = _async_api(supabase_client.set_birth_date)
+get_baby_age_months = _async_api(supabase_client.get_baby_age_months)
+get_notification_settings = _async_api(supabase_client.get_notification_settings)
+update_notification_settings = _async_api(supabase_client.update_notification_settings)
+set_family_timezone = _async_api(supabase_client.set_family_timezone)
+
+get_feeding_stats = _async_api(supabase_client.get_feeding_stats)
+get_diaper_stats = _async_api(supabase_client.get_diaper_stats)
+get_bath_stats = _async_api(supabase_client.get_bath_stats)
+get_activity_stats = _async_api(supabase_client.get_activity_stats)
+get_family_stats = _async_api(supabase_client.get_family_stats)
+get_settings_overview = _async_api(supabase_client.get_settings_overview)
+
+get_random_tip = _async_api(supabase_client.get_random_tip)
+
+check_smart_reminder_conditions = _async_api(supabase_client.check_smart_reminder_conditions)
+get_smart_reminder_message = _async_api(supabase_client.get_smart_reminder_message)
+acknowledge_notification = _async_api(supabase_client.acknowledge_notification)
+acknowledge_notification_group = _async_api(supabase_client.acknowledge_notification_group)
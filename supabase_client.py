@@ -4,54 +4,109 @@ Supabase клиент для BabyBot
 """
 
 import os
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from supabase import create_client, Client
-from typing import Optional, List, Tuple, Dict, Any
-import pytz
-from dotenv import load_dotenv
+from typing import Optional, List, Tuple, Dict, Any, Iterable
+import threading
 import time
 
-# Загружаем переменные окружения
-load_dotenv()
-
-# Получаем данные из переменных окружения
-SUPABASE_URL = os.getenv('SUPABASE_URL')
-SUPABASE_KEY = os.getenv('SUPABASE_KEY')
-
-if not all([SUPABASE_URL, SUPABASE_KEY]):
+import event_store
+import local_mirror
+import notification_index
+import query_tracing
+import sharding
+import sleep_index
+import timeutils
+import tips_catalog
+from event_store import EventKind
+
+# ==================== КЛИЕНТ SUPABASE ====================
+
+# Клиент создается при первом запросе, а не при импорте: импорт модуля не читает
+# .env, не тянет supabase/httpx и не ходит в сеть (бенчмарки подставляют свой клиент)
+_client_instance = None
+_client_lock = threading.Lock()
+
+def _load_env():
+    from dotenv import load_dotenv
+    load_dotenv()
+
+def check_supabase_config() -> bool:
+    """Проверить, что SUPABASE_URL и SUPABASE_KEY заданы"""
+    _load_env()
+    if os.getenv('SUPABASE_URL') and os.getenv('SUPABASE_KEY'):
+        return True
     print("❌ ОШИБКА: Не все необходимые переменные Supabase установлены!")
     print("📝 Убедитесь, что в .env файле установлены:")
     print("   • SUPABASE_URL")
     print("   • SUPABASE_KEY")
-    exit(1)
-
-# Создаем клиент Supabase с обработкой ошибок
-try:
-    supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+    return False
+
+def _create_client():
+    """Создать клиент: общий пул соединений (supabase_transport) и трассировка запросов (query_tracing)"""
+    if not check_supabase_config():
+        raise RuntimeError("SUPABASE_URL и SUPABASE_KEY не заданы")
+    from supabase import create_client
+    import supabase_transport
+    client = create_client(os.getenv('SUPABASE_URL'), os.getenv('SUPABASE_KEY'))
+    supabase_transport.configure(client)
     print("✅ Supabase клиент создан успешно")
-except Exception as e:
-    print(f"❌ Ошибка создания Supabase клиента: {e}")
-    print("🔄 Попытка создать клиент с альтернативными настройками...")
-    try:
-        # Альтернативный способ создания клиента
-        from supabase import create_client as create_supabase_client
-        supabase = create_supabase_client(SUPABASE_URL, SUPABASE_KEY)
-        print("✅ Supabase клиент создан альтернативным способом")
-    except Exception as e2:
-        print(f"❌ Критическая ошибка Supabase: {e2}")
-        print("🛑 Бот не может работать без Supabase")
-        exit(1)
-
-# Кэш для family_id (время жизни 5 минут)
-family_id_cache = {}
-CACHE_TTL = 300  # 5 минут в секундах
+    return query_tracing.instrument(client)
+
+def get_client():
+    """Клиент Supabase (создается при первом обращении)"""
+    global _client_instance
+    if _client_instance is None:
+        with _client_lock:
+            if _client_instance is None:
+                _client_instance = _create_client()
+    return _client_instance
+
+def set_client(client, instrument: bool = True):
+    """Подставить свой клиент (например, хранилище в памяти для бенчмарков)"""
+    global _client_instance
+    with _client_lock:
+        _client_instance = query_tracing.instrument(client) if instrument else client
+
+class _LazyClient:
+    """Заместитель клиента: обращения передаются клиенту из get_client()"""
+
+    def __getattr__(self, name):
+        return getattr(get_client(), name)
+
+supabase = _LazyClient()
+
+# Кэш членства пользователей: family_id, роль и имя (LRU, время жизни 5 минут).
+# Отсутствие семьи тоже кэшируется, но ненадолго, чтобы после создания семьи
+# или присоединения в другом процессе пользователь быстро ее увидел
+MEMBERSHIP_CACHE_TTL = 300  # 5 минут в секундах
+MEMBERSHIP_NEGATIVE_TTL = 30
+MEMBERSHIP_CACHE_MAX_SIZE = 10000
+membership_cache: OrderedDict = OrderedDict()
+_membership_lock = threading.Lock()
+_membership_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+class QueryRetryNeeded(Exception):
+    """Запрос не удался, повторную попытку выполнит асинхронный вызывающий код"""
+
+# Состояние повторов текущего потока: асинхронная обертка (supabase_async)
+# сама ждет между попытками через asyncio.sleep, а поток пула не блокируется
+_retry_context = threading.local()
 
 def safe_execute(query_func, max_retries=5, delay=1):
     """Безопасное выполнение запроса с повторными попытками"""
+    deferred = getattr(_retry_context, 'deferred', False)
+    if deferred:
+        max_retries = 1
     for attempt in range(max_retries):
         try:
             return query_func()
         except Exception as e:
+            # Пока Supabase недоступен, повторы только держат поток - запрос завершается сразу
+            import supabase_transport
+            if supabase_transport.is_unavailable(e):
+                print(f"🔌 Запрос отклонен: {e}")
+                return None
             error_msg = str(e).lower()
             # Проверяем на специфические ошибки таймаута
             if any(keyword in error_msg for keyword in ['timeout', 'timed out', 'connection', 'network', 'read operation timed out']):
@@ -59,6 +114,10 @@ def safe_execute(query_func, max_retries=5, delay=1):
             else:
                 print(f"⚠️ Попытка {attempt + 1} неудачна, повтор через {delay}с...")
             
+            # Ожидание перед повтором выполнит асинхронная обертка
+            if deferred and not _retry_context.final_attempt:
+                raise QueryRetryNeeded(str(e)) from e
+            
             if attempt == max_retries - 1:
                 print(f"❌ Ошибка после {max_retries} попыток: {e}")
                 return None
@@ -67,53 +126,184 @@ def safe_execute(query_func, max_retries=5, delay=1):
             time.sleep(min(delay * (2 ** attempt), 10))
     return None
 
+def run_with_deferred_retries(final_attempt: bool, func, *args, **kwargs):
+    """Выполнить функцию API так, чтобы safe_execute не спал между попытками"""
+    _retry_context.deferred = True
+    _retry_context.final_attempt = final_attempt
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _retry_context.deferred = False
+
 def get_thai_time():
-    """Получить текущее время в тайском часовом поясе"""
-    thai_tz = pytz.timezone('Asia/Bangkok')
-    utc_now = datetime.now(pytz.UTC)
-    thai_now = utc_now.astimezone(thai_tz)
-    return thai_now
+    """Получить текущее время в часовом поясе по умолчанию (timeutils.DEFAULT_TIMEZONE)"""
+    return timeutils.local_now()
 
 def get_thai_date():
-    """Получить текущую дату в тайском часовом поясе"""
-    return get_thai_time().date()
+    """Получить текущую дату в часовом поясе по умолчанию"""
+    return timeutils.local_date()
+
+# ==================== LRU-КЭШИ ====================
+
+def _lru_get(cache: OrderedDict, lock: threading.Lock, key, stats: Dict[str, int]) -> Optional[Dict[str, Any]]:
+    """Получить неустаревшую запись LRU-кэша"""
+    with lock:
+        entry = cache.get(key)
+        if entry is not None and time.time() < entry['expires_at']:
+            cache.move_to_end(key)
+            stats['hits'] += 1
+            return entry
+        if entry is not None:
+            del cache[key]
+        stats['misses'] += 1
+        return None
+
+def _lru_put(cache: OrderedDict, lock: threading.Lock, key, entry: Dict[str, Any], ttl: float,
+             max_size: int, stats: Dict[str, int]):
+    """Положить запись в LRU-кэш, вытесняя самые давно использованные"""
+    entry['expires_at'] = time.time() + ttl
+    with lock:
+        cache[key] = entry
+        cache.move_to_end(key)
+        while len(cache) > max_size:
+            cache.popitem(last=False)
+            stats['evictions'] += 1
+
+def _lru_stats(cache: OrderedDict, lock: threading.Lock, stats: Dict[str, int]) -> Dict[str, Any]:
+    """Статистика LRU-кэша"""
+    with lock:
+        size = len(cache)
+    lookups = stats['hits'] + stats['misses']
+    return {
+        'size': size,
+        'hits': stats['hits'],
+        'misses': stats['misses'],
+        'evictions': stats['evictions'],
+        'hit_ratio': stats['hits'] / lookups if lookups else 0.0
+    }
+
+# ==================== КЭШ СОСТОЯНИЯ СЕМЬИ ====================
+
+# Последние события и настройки семьи. Записи через бота обновляют кэш на месте,
+# а время жизни ограничивает устаревание после изменений в обход бота (дашборд)
+FAMILY_STATE_TTL = 600  # 10 минут в секундах
+FAMILY_STATE_MAX_SIZE = 5000
+FAMILY_EVENT_TABLES = {kind.value: kind.table for kind in EventKind}
+
+family_state_cache: OrderedDict = OrderedDict()
+_family_state_lock = threading.Lock()
+_family_state_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+def _load_family_state(family_id: int) -> Dict[str, Any]:
+    """Загрузить состояние семьи из локальной копии или БД"""
+    mirrored = local_mirror.get_family_state(family_id)
+    if mirrored is not None:
+        return mirrored
+    settings_result = supabase.table('settings').select('*').eq('family_id', family_id).execute()
+    latest = event_store.latest_events([family_id])[family_id]
+    return {
+        'settings': settings_result.data[0] if settings_result.data else None,
+        'last_events': {kind.value: timestamp for kind, timestamp in latest.items()}
+    }
+
+def get_latest_events_bulk(family_ids: Optional[List[int]],
+                           tables: Iterable[str] = tuple(FAMILY_EVENT_TABLES.values())) -> Dict[int, Dict[str, Optional[datetime]]]:
+    """Время последнего события по таблицам событий для многих семей (None - для всех) одним вызовом
+    функции get_latest_events: {family_id: {'feedings': время или None, ...}}"""
+    kinds_by_table = {kind.table: kind for kind in EventKind}
+    try:
+        latest = event_store.latest_events(family_ids, [kinds_by_table[table] for table in tables])
+    except Exception as e:
+        print(f"❌ Ошибка получения последних событий: {e}")
+        return {}
+    return {family_id: {kind.table: timestamp for kind, timestamp in times.items()}
+            for family_id, times in latest.items()}
+
+def get_family_state(family_id: int) -> Optional[Dict[str, Any]]:
+    """Получить состояние семьи (последние события и настройки) из кэша или БД"""
+    state = _lru_get(family_state_cache, _family_state_lock, family_id, _family_state_stats)
+    if state is not None:
+        return state
+    try:
+        state = _load_family_state(family_id)
+    except Exception as e:
+        print(f"❌ Ошибка загрузки состояния семьи: {e}")
+        return None
+    _lru_put(family_state_cache, _family_state_lock, family_id, state, FAMILY_STATE_TTL, FAMILY_STATE_MAX_SIZE, _family_state_stats)
+    return state
+
+def _remember_family_event(family_id: int, event_type: str, timestamp: datetime):
+    """Обновить время последнего события в кэше после записи"""
+    with _family_state_lock:
+        state = family_state_cache.get(family_id)
+        if state is None:
+            return
+        last = state['last_events'].get(event_type)
+        if last is None or timestamp > last:
+            state['last_events'][event_type] = timestamp
+
+def _remember_family_settings(family_id: int, update_data: Dict[str, Any]):
+    """Обновить настройки семьи в кэше и локальной копии после записи"""
+    local_mirror.update_rows('settings', update_data, family_id=family_id)
+    with _family_state_lock:
+        state = family_state_cache.get(family_id)
+        if state is None:
+            return
+        if state['settings'] is None:
+            # Настроек в кэше нет - перечитаем их при следующем обращении
+            del family_state_cache[family_id]
+            return
+        state['settings'] = {**state['settings'], **update_data}
+
+def invalidate_family_state(family_id: int = None):
+    """Сбросить кэш состояния семьи"""
+    with _family_state_lock:
+        if family_id is None:
+            family_state_cache.clear()
+        else:
+            family_state_cache.pop(family_id, None)
 
 # ==================== ФУНКЦИИ ДЛЯ РАБОТЫ С СЕМЬЯМИ ====================
 
-def get_family_id(user_id: int) -> Optional[int]:
-    """Получить ID семьи пользователя с кэшированием"""
-    current_time = time.time()
+def get_membership(user_id: int) -> Optional[Dict[str, Any]]:
+    """Получить членство пользователя (family_id, роль, имя) с кэшированием"""
+    entry = _lru_get(membership_cache, _membership_lock, user_id, _membership_stats)
+    if entry is not None:
+        return entry
     
-    # Проверяем кэш
-    if user_id in family_id_cache:
-        cached_data = family_id_cache[user_id]
-        if current_time - cached_data['timestamp'] < CACHE_TTL:
-            return cached_data['family_id']
-        else:
-            # Удаляем устаревший кэш
-            del family_id_cache[user_id]
+    # Отсутствие в локальной копии не кэшируется: пользователь мог вступить в семью через другой процесс
+    member = local_mirror.get_membership(user_id)
+    if member is not None:
+        entry = {'family_id': member['family_id'], 'role': member['role'], 'name': member['name']}
+        _lru_put(membership_cache, _membership_lock, user_id, entry, MEMBERSHIP_CACHE_TTL, MEMBERSHIP_CACHE_MAX_SIZE, _membership_stats)
+        return entry
     
     def query():
-        result = supabase.table('family_members').select('family_id').eq('user_id', user_id).execute()
+        result = supabase.table('family_members').select('family_id, role, name').eq('user_id', user_id).execute()
         if result.data:
-            return result.data[0]['family_id']
-        return None
-    
-    result = safe_execute(query)
-    if result is None:
-        # Если произошла ошибка подключения, попробуем еще раз с увеличенной задержкой
-        print(f"🔄 Повторная попытка получения family_id для пользователя {user_id}")
-        time.sleep(2)
-        result = safe_execute(query)
+            member = result.data[0]
+            return {'family_id': member['family_id'], 'role': member['role'], 'name': member['name']}
+        # Пользователь не состоит в семье - это тоже результат, который стоит закэшировать
+        return {'family_id': None, 'role': None, 'name': None}
     
-    # Кэшируем результат (даже если None)
-    if result is not None:
-        family_id_cache[user_id] = {
-            'family_id': result,
-            'timestamp': current_time
-        }
+    entry = safe_execute(query)
+    if entry is None:
+        # Ошибка подключения: не кэшируем
+        return None
     
-    return result
+    ttl = MEMBERSHIP_CACHE_TTL if entry['family_id'] else MEMBERSHIP_NEGATIVE_TTL
+    _lru_put(membership_cache, _membership_lock, user_id, entry, ttl, MEMBERSHIP_CACHE_MAX_SIZE, _membership_stats)
+    return entry
+
+def invalidate_membership(user_id: int):
+    """Сбросить кэш членства пользователя"""
+    with _membership_lock:
+        membership_cache.pop(user_id, None)
+
+def get_family_id(user_id: int) -> Optional[int]:
+    """Получить ID семьи пользователя с кэшированием"""
+    membership = get_membership(user_id)
+    return membership['family_id'] if membership else None
 
 def create_family(name: str, user_id: int) -> Optional[int]:
     """Создать новую семью"""
@@ -121,17 +311,19 @@ def create_family(name: str, user_id: int) -> Optional[int]:
         # Создаем семью
         family_result = supabase.table('families').insert({'name': name}).execute()
         family_id = family_result.data[0]['id']
+        local_mirror.upsert_rows('families', family_result.data)
         
         # Добавляем пользователя в семью
-        supabase.table('family_members').insert({
+        member_result = supabase.table('family_members').insert({
             'family_id': family_id,
             'user_id': user_id,
             'role': 'Родитель',
             'name': 'Неизвестно'
         }).execute()
+        local_mirror.upsert_rows('family_members', member_result.data)
         
         # Создаем настройки по умолчанию
-        supabase.table('settings').insert({
+        settings_result = supabase.table('settings').insert({
             'family_id': family_id,
             'feed_interval': 3,
             'diaper_interval': 2,
@@ -146,22 +338,27 @@ def create_family(name: str, user_id: int) -> Optional[int]:
             'activity_reminder_interval': 2,
             'baby_age_months': 0
         }).execute()
+        local_mirror.upsert_rows('settings', settings_result.data)
         
         return family_id
     
     result = safe_execute(query)
     
     # Очищаем кэш для этого пользователя при создании семьи
-    if result and user_id in family_id_cache:
-        del family_id_cache[user_id]
+    if result:
+        invalidate_membership(user_id)
     
     return result
 
 def join_family_by_code(code: str, user_id: int) -> Tuple[Optional[int], str]:
     """Присоединить пользователя к семье по коду приглашения"""
-    def query():
+    # Неверный код проверяем до запроса, чтобы не тратить на него повторные попытки
+    try:
         family_id = int(code)
-        
+    except ValueError:
+        return None, "Неверный код приглашения"
+    
+    def query():
         # Проверяем, существует ли семья
         family_result = supabase.table('families').select('id, name').eq('id', family_id).execute()
         if not family_result.data:
@@ -175,12 +372,13 @@ def join_family_by_code(code: str, user_id: int) -> Tuple[Optional[int], str]:
             return None, "Вы уже состоите в семье"
         
         # Добавляем пользователя в семью
-        supabase.table('family_members').insert({
+        member_result = supabase.table('family_members').insert({
             'family_id': family_id,
             'user_id': user_id,
             'role': 'Родитель',
             'name': 'Неизвестно'
         }).execute()
+        local_mirror.upsert_rows('family_members', member_result.data)
         
         return family_id, family['name']
     
@@ -189,19 +387,22 @@ def join_family_by_code(code: str, user_id: int) -> Tuple[Optional[int], str]:
         if result:
             family_id, family_name = result
             # Очищаем кэш для этого пользователя при присоединении к семье
-            if user_id in family_id_cache:
-                del family_id_cache[user_id]
+            if family_id:
+                invalidate_membership(user_id)
             return family_id, family_name
         else:
             return None, "Ошибка присоединения к семье"
-    except ValueError:
-        return None, "Неверный код приглашения"
+    except QueryRetryNeeded:
+        raise
     except Exception as e:
         print(f"❌ Ошибка присоединения к семье: {e}")
         return None, "Ошибка присоединения к семье"
 
 def get_family_name(family_id: int) -> str:
     """Получить название семьи по ID"""
+    family = local_mirror.get_family(family_id)
+    if family is not None:
+        return family['name']
     try:
         result = supabase.table('families').select('name').eq('id', family_id).execute()
         if result.data:
@@ -213,15 +414,10 @@ def get_family_name(family_id: int) -> str:
 
 def get_member_info(user_id: int) -> Tuple[Optional[str], Optional[str]]:
     """Получить информацию о члене семьи"""
-    try:
-        result = supabase.table('family_members').select('role, name').eq('user_id', user_id).execute()
-        if result.data:
-            member = result.data[0]
-            return member['role'], member['name']
-        return None, None
-    except Exception as e:
-        print(f"❌ Ошибка получения информации о члене семьи: {e}")
-        return None, None
+    membership = get_membership(user_id)
+    if membership and membership['family_id']:
+        return membership['role'], membership['name']
+    return None, None
 
 def set_member_role(user_id: int, role: str, name: str) -> bool:
     """Установить роль и имя для члена семьи"""
@@ -230,6 +426,8 @@ def set_member_role(user_id: int, role: str, name: str) -> bool:
             'role': role,
             'name': name
         }).eq('user_id', user_id).execute()
+        local_mirror.update_rows('family_members', {'role': role, 'name': name}, user_id=user_id)
+        invalidate_membership(user_id)
         return True
     except Exception as e:
         print(f"❌ Ошибка установки роли: {e}")
@@ -237,6 +435,9 @@ def set_member_role(user_id: int, role: str, name: str) -> bool:
 
 def get_family_members_with_roles(family_id: int) -> List[Tuple[int, str, str]]:
     """Получить всех членов семьи с ролями"""
+    members = local_mirror.get_family_members(family_id)
+    if members is not None:
+        return [(member['user_id'], member['role'], member['name']) for member in members]
     try:
         result = supabase.table('family_members').select('user_id, role, name').eq('family_id', family_id).execute()
         return [(member['user_id'], member['role'], member['name']) for member in result.data]
@@ -244,102 +445,81 @@ def get_family_members_with_roles(family_id: int) -> List[Tuple[int, str, str]]:
         print(f"❌ Ошибка получения членов семьи: {e}")
         return []
 
+# ==================== ФУНКЦИИ ДЛЯ СОБЫТИЙ ====================
+
+def _add_event(user_id: int, kind: EventKind, minutes_ago: int = 0,
+               duplicate_minutes: Optional[int] = None, **extra) -> bool:
+    """Записать событие от имени пользователя; семья, роль и имя берутся из кэша членства.
+    Если задан duplicate_minutes и событие этого вида уже было за это время, запись не создается"""
+    membership = get_membership(user_id)
+    if not membership or not membership['family_id']:
+        return False
+    family_id = membership['family_id']
+
+    if duplicate_minutes and has_recent_event(family_id, kind, duplicate_minutes):
+        return False  # Возвращаем False для индикации дубликата
+
+    timestamp = timeutils.utc_now() - timedelta(minutes=minutes_ago)
+    record_family_events([event_store.new_event(
+        kind, family_id, user_id, timestamp,
+        membership['role'] or 'Родитель', membership['name'] or 'Неизвестно', **extra
+    )])
+    return True
+
+def record_family_events(events: List[Dict[str, Any]]):
+    """Записать пачку событий (по запросу на таблицу) и обновить кэш состояния семей"""
+    event_store.record_events(events)
+    for event in events:
+        _remember_family_event(event['family_id'], EventKind(event['kind']).value, event['timestamp'])
+
+def get_last_event_time(family_id: int, kind: EventKind) -> Optional[datetime]:
+    """Получить время последнего события вида kind для семьи"""
+    state = get_family_state(family_id)
+    return state['last_events'][EventKind(kind).value] if state else None
+
+def has_recent_event(family_id: int, kind: EventKind, minutes_threshold: int = 30) -> bool:
+    """Проверить, было ли событие вида kind в последние N минут"""
+    last_event = get_last_event_time(family_id, kind)
+    if not last_event:
+        return False
+    minutes_ago = int((timeutils.utc_now() - last_event).total_seconds() / 60)
+    return minutes_ago < minutes_threshold
+
 # ==================== ФУНКЦИИ ДЛЯ КОРМЛЕНИЙ ====================
 
 def add_feeding(user_id: int, minutes_ago: int = 0, force: bool = False) -> bool:
     """Добавить запись о кормлении"""
     try:
-        family_id = get_family_id(user_id)
-        if not family_id:
-            return False
-        
         # Проверяем, не было ли кормления в последние 30 минут (если не принудительно)
-        if not force and check_recent_feeding(family_id, 30):
-            return False  # Возвращаем False для индикации дубликата
-        
-        role, name = get_member_info(user_id)
-        if not role:
-            role, name = 'Родитель', 'Неизвестно'
-        
-        timestamp = get_thai_time() - timedelta(minutes=minutes_ago)
-        
-        supabase.table('feedings').insert({
-            'family_id': family_id,
-            'author_id': user_id,
-            'timestamp': timestamp.isoformat(),
-            'author_role': role,
-            'author_name': name
-        }).execute()
-        
-        return True
+        return _add_event(user_id, EventKind.FEEDING, minutes_ago, duplicate_minutes=None if force else 30)
+    except QueryRetryNeeded:
+        raise
     except Exception as e:
         print(f"❌ Ошибка добавления кормления: {e}")
         return False
 
 def get_last_feeding_time(user_id: int) -> Optional[datetime]:
     """Получить время последнего кормления"""
-    try:
-        family_id = get_family_id(user_id)
-        if not family_id:
-            return None
-        
-        result = supabase.table('feedings').select('timestamp').eq('family_id', family_id).order('timestamp', desc=True).limit(1).execute()
-        
-        if result.data:
-            timestamp_str = result.data[0]['timestamp']
-            # Конвертируем UTC время в тайское время
-            utc_time = datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
-            thai_tz = pytz.timezone('Asia/Bangkok')
-            return utc_time.astimezone(thai_tz)
-        return None
-    except Exception as e:
-        print(f"❌ Ошибка получения времени последнего кормления: {e}")
+    family_id = get_family_id(user_id)
+    if not family_id:
         return None
+    return get_last_feeding_time_for_family(family_id)
 
 def get_last_feeding_time_for_family(family_id: int) -> Optional[datetime]:
     """Получить время последнего кормления для семьи"""
     try:
-        result = supabase.table('feedings').select('timestamp').eq('family_id', family_id).order('timestamp', desc=True).limit(1).execute()
-        
-        if result.data:
-            timestamp_str = result.data[0]['timestamp']
-            # Конвертируем UTC время в тайское время
-            utc_time = datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
-            thai_tz = pytz.timezone('Asia/Bangkok')
-            return utc_time.astimezone(thai_tz)
-        return None
+        return get_last_event_time(family_id, EventKind.FEEDING)
     except Exception as e:
         print(f"❌ Ошибка получения времени последнего кормления для семьи: {e}")
         return None
 
-# ==================== ФУНКЦИИ ДЛЯ ПОДГУЗНИКОВ ====================
-
 def add_diaper_change(user_id: int, minutes_ago: int = 0, force: bool = False) -> bool:
     """Добавить запись о смене подгузника"""
     try:
-        family_id = get_family_id(user_id)
-        if not family_id:
-            return False
-        
         # Проверяем, не было ли смены подгузника в последние 30 минут (если не принудительно)
-        if not force and check_recent_diaper_change(family_id, 30):
-            return False  # Возвращаем False для индикации дубликата
-        
-        role, name = get_member_info(user_id)
-        if not role:
-            role, name = 'Родитель', 'Неизвестно'
-        
-        timestamp = get_thai_time() - timedelta(minutes=minutes_ago)
-        
-        supabase.table('diapers').insert({
-            'family_id': family_id,
-            'author_id': user_id,
-            'timestamp': timestamp.isoformat(),
-            'author_role': role,
-            'author_name': name
-        }).execute()
-        
-        return True
+        return _add_event(user_id, EventKind.DIAPER, minutes_ago, duplicate_minutes=None if force else 30)
+    except QueryRetryNeeded:
+        raise
     except Exception as e:
         print(f"❌ Ошибка добавления смены подгузника: {e}")
         return False
@@ -347,15 +527,7 @@ def add_diaper_change(user_id: int, minutes_ago: int = 0, force: bool = False) -
 def get_last_diaper_change_time_for_family(family_id: int) -> Optional[datetime]:
     """Получить время последней смены подгузника для семьи"""
     try:
-        result = supabase.table('diapers').select('timestamp').eq('family_id', family_id).order('timestamp', desc=True).limit(1).execute()
-        
-        if result.data:
-            timestamp_str = result.data[0]['timestamp']
-            # Конвертируем UTC время в тайское время
-            utc_time = datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
-            thai_tz = pytz.timezone('Asia/Bangkok')
-            return utc_time.astimezone(thai_tz)
-        return None
+        return get_last_event_time(family_id, EventKind.DIAPER)
     except Exception as e:
         print(f"❌ Ошибка получения времени последней смены подгузника: {e}")
         return None
@@ -367,15 +539,7 @@ def get_last_diaper_change_for_family(family_id: int) -> Optional[datetime]:
 def check_recent_feeding(family_id: int, minutes_threshold: int = 30) -> bool:
     """Проверить, было ли кормление в последние N минут"""
     try:
-        last_feeding = get_last_feeding_time_for_family(family_id)
-        if not last_feeding:
-            return False
-        
-        now = get_thai_time()
-        time_diff = now - last_feeding
-        minutes_ago = int(time_diff.total_seconds() / 60)
-        
-        return minutes_ago < minutes_threshold
+        return has_recent_event(family_id, EventKind.FEEDING, minutes_threshold)
     except Exception as e:
         print(f"❌ Ошибка проверки последнего кормления: {e}")
         return False
@@ -383,15 +547,7 @@ def check_recent_feeding(family_id: int, minutes_threshold: int = 30) -> bool:
 def check_recent_diaper_change(family_id: int, minutes_threshold: int = 30) -> bool:
     """Проверить, была ли смена подгузника в последние N минут"""
     try:
-        last_diaper = get_last_diaper_change_time_for_family(family_id)
-        if not last_diaper:
-            return False
-        
-        now = get_thai_time()
-        time_diff = now - last_diaper
-        minutes_ago = int(time_diff.total_seconds() / 60)
-        
-        return minutes_ago < minutes_threshold
+        return has_recent_event(family_id, EventKind.DIAPER, minutes_threshold)
     except Exception as e:
         print(f"❌ Ошибка проверки последней смены подгузника: {e}")
         return False
@@ -401,9 +557,9 @@ def check_recent_diaper_change(family_id: int, minutes_threshold: int = 30) -> b
 def get_user_intervals(family_id: int) -> Tuple[int, int]:
     """Получить интервалы кормления и смены подгузников"""
     try:
-        result = supabase.table('settings').select('feed_interval, diaper_interval').eq('family_id', family_id).execute()
-        if result.data:
-            settings = result.data[0]
+        state = get_family_state(family_id)
+        if state and state['settings']:
+            settings = state['settings']
             return settings['feed_interval'], settings['diaper_interval']
         return 3, 2
     except Exception as e:
@@ -421,6 +577,7 @@ def set_user_interval(family_id: int, feed_interval: Optional[int] = None, diape
         
         if update_data:
             supabase.table('settings').update(update_data).eq('family_id', family_id).execute()
+            _remember_family_settings(family_id, update_data)
         return True
     except Exception as e:
         print(f"❌ Ошибка установки интервалов: {e}")
@@ -429,9 +586,9 @@ def set_user_interval(family_id: int, feed_interval: Optional[int] = None, diape
 def get_birth_date(family_id: int) -> Optional[str]:
     """Получить дату рождения малыша"""
     try:
-        result = supabase.table('settings').select('baby_birth_date').eq('family_id', family_id).execute()
-        if result.data and result.data[0]['baby_birth_date']:
-            return result.data[0]['baby_birth_date']
+        state = get_family_state(family_id)
+        if state and state['settings'] and state['settings'].get('baby_birth_date'):
+            return state['settings']['baby_birth_date']
         return None
     except Exception as e:
         print(f"❌ Ошибка получения даты рождения: {e}")
@@ -441,6 +598,7 @@ def set_birth_date(family_id: int, birth_date: str) -> bool:
     """Установить дату рождения малыша"""
     try:
         supabase.table('settings').update({'baby_birth_date': birth_date}).eq('family_id', family_id).execute()
+        _remember_family_settings(family_id, {'baby_birth_date': birth_date})
         
         # Автоматически вычисляем и обновляем возраст
         age_months = get_baby_age_months(family_id)
@@ -453,31 +611,30 @@ def set_birth_date(family_id: int, birth_date: str) -> bool:
         print(f"❌ Ошибка установки даты рождения: {e}")
         return False
 
+def baby_age_months(birth_date_str: str, today) -> int:
+    """Возраст малыша в месяцах на дату today по дате рождения 'YYYY-MM-DD'"""
+    birth_date = datetime.strptime(birth_date_str, '%Y-%m-%d')
+    
+    # Вычисляем возраст в месяцах
+    age_months = (today.year - birth_date.year) * 12 + (today.month - birth_date.month)
+    
+    # Если день рождения еще не наступил в этом месяце, уменьшаем на 1
+    if today.day < birth_date.day:
+        age_months -= 1
+    
+    # Возраст не может быть отрицательным
+    return max(0, age_months)
+
 def get_baby_age_months(family_id: int) -> int:
     """Получить возраст малыша в месяцах на основе даты рождения"""
     try:
-        from datetime import datetime
-        
         # Получаем дату рождения
         birth_date_str = get_birth_date(family_id)
         if not birth_date_str:
             return 0
         
-        # Парсим дату рождения
-        birth_date = datetime.strptime(birth_date_str, '%Y-%m-%d')
-        
-        # Получаем текущую дату
-        now = get_thai_time()
-        
-        # Вычисляем возраст в месяцах
-        age_months = (now.year - birth_date.year) * 12 + (now.month - birth_date.month)
-        
-        # Если день рождения еще не наступил в этом месяце, уменьшаем на 1
-        if now.day < birth_date.day:
-            age_months -= 1
-        
-        # Возраст не может быть отрицательным
-        return max(0, age_months)
+        # Месяц сменяется в полночь по местному времени семьи
+        return baby_age_months(birth_date_str, timeutils.local_date(get_family_timezone(family_id)))
         
     except Exception as e:
         print(f"❌ Ошибка получения возраста малыша: {e}")
@@ -487,6 +644,7 @@ def set_baby_age_months(family_id: int, age_months: int) -> bool:
     """Установить возраст малыша в месяцах"""
     try:
         supabase.table('settings').update({'baby_age_months': age_months}).eq('family_id', family_id).execute()
+        _remember_family_settings(family_id, {'baby_age_months': age_months})
         return True
     except Exception as e:
         print(f"❌ Ошибка установки возраста малыша: {e}")
@@ -497,25 +655,9 @@ def set_baby_age_months(family_id: int, age_months: int) -> bool:
 def add_bath(user_id: int, minutes_ago: int = 0) -> bool:
     """Добавить запись о купании"""
     try:
-        family_id = get_family_id(user_id)
-        if not family_id:
-            return False
-        
-        role, name = get_member_info(user_id)
-        if not role:
-            role, name = 'Родитель', 'Неизвестно'
-        
-        timestamp = get_thai_time() - timedelta(minutes=minutes_ago)
-        
-        supabase.table('baths').insert({
-            'family_id': family_id,
-            'author_id': user_id,
-            'timestamp': timestamp.isoformat(),
-            'author_role': role,
-            'author_name': name
-        }).execute()
-        
-        return True
+        return _add_event(user_id, EventKind.BATH, minutes_ago)
+    except QueryRetryNeeded:
+        raise
     except Exception as e:
         print(f"❌ Ошибка добавления купания: {e}")
         return False
@@ -523,41 +665,17 @@ def add_bath(user_id: int, minutes_ago: int = 0) -> bool:
 def get_last_bath_time_for_family(family_id: int) -> Optional[datetime]:
     """Получить время последнего купания для семьи"""
     try:
-        result = supabase.table('baths').select('timestamp').eq('family_id', family_id).order('timestamp', desc=True).limit(1).execute()
-        
-        if result.data:
-            timestamp_str = result.data[0]['timestamp']
-            return datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
-        return None
+        return get_last_event_time(family_id, EventKind.BATH)
     except Exception as e:
         print(f"❌ Ошибка получения времени последнего купания: {e}")
         return None
 
-# ==================== ФУНКЦИИ ДЛЯ АКТИВНОСТЕЙ ====================
-
 def add_activity(user_id: int, activity_type: str = 'Игра', minutes_ago: int = 0) -> bool:
     """Добавить запись об активности"""
     try:
-        family_id = get_family_id(user_id)
-        if not family_id:
-            return False
-        
-        role, name = get_member_info(user_id)
-        if not role:
-            role, name = 'Родитель', 'Неизвестно'
-        
-        timestamp = get_thai_time() - timedelta(minutes=minutes_ago)
-        
-        supabase.table('activities').insert({
-            'family_id': family_id,
-            'author_id': user_id,
-            'timestamp': timestamp.isoformat(),
-            'activity_type': activity_type,
-            'author_role': role,
-            'author_name': name
-        }).execute()
-        
-        return True
+        return _add_event(user_id, EventKind.ACTIVITY, minutes_ago, activity_type=activity_type)
+    except QueryRetryNeeded:
+        raise
     except Exception as e:
         print(f"❌ Ошибка добавления активности: {e}")
         return False
@@ -565,87 +683,217 @@ def add_activity(user_id: int, activity_type: str = 'Игра', minutes_ago: int
 def get_last_activity_time_for_family(family_id: int) -> Optional[datetime]:
     """Получить время последней активности для семьи"""
     try:
-        result = supabase.table('activities').select('timestamp').eq('family_id', family_id).order('timestamp', desc=True).limit(1).execute()
-        
-        if result.data:
-            timestamp_str = result.data[0]['timestamp']
-            return datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
-        return None
+        return get_last_event_time(family_id, EventKind.ACTIVITY)
     except Exception as e:
         print(f"❌ Ошибка получения времени последней активности: {e}")
         return None
 
+# ==================== ФУНКЦИИ ДЛЯ СНА ====================
 
-# ==================== ФУНКЦИИ ДЛЯ СТАТИСТИКИ ====================
+def load_open_sleep_sessions(family_ids: Optional[List[int]] = None):
+    """Загрузить открытые сессии сна (всех семей или указанных) в индекс одним запросом
+    (частичный индекс idx_sleep_sessions_open)"""
+    def open_sessions():
+        query = supabase.table('sleep_sessions').select('id, family_id, start_time').is_('end_time', 'null')
+        return (query.in_('family_id', family_ids) if family_ids is not None else query).order('id')
 
-def get_feeding_stats(family_id: int, days: int = 7) -> Dict[str, Any]:
-    """Получить статистику кормлений"""
+    rows = event_store.fetch_all_rows(open_sessions)
+    sleep_index.load(({**row, 'start_time': timeutils.parse_timestamp(row['start_time'])} for row in rows), family_ids)
+
+def _sleep_index_authoritative() -> bool:
+    """Индекс сна полон, если загружен и сон отмечает только этот процесс.
+    При нескольких воркерах сон отмечает воркер, принимающий сообщения, поэтому индекс перечитывается"""
+    return sleep_index.is_loaded() and not sharding.is_sharded()
+
+def get_open_sleep_session(family_id: int) -> Optional[Tuple[int, datetime]]:
+    """Открытая сессия сна семьи: (id, начало сна) или None, если малыш не спит"""
+    if not _sleep_index_authoritative():
+        load_open_sleep_sessions([family_id] if sharding.is_sharded() else None)
+    return sleep_index.get(family_id)
+
+def get_sleep_start_time(family_id: int) -> Optional[datetime]:
+    """Когда малыш уснул (None, если не спит)"""
     try:
-        start_date = get_thai_time() - timedelta(days=days)
-        
-        result = supabase.table('feedings').select('timestamp').eq('family_id', family_id).gte('timestamp', start_date.isoformat()).execute()
-        
-        return {
-            'count': len(result.data),
-            'last_time': get_last_feeding_time_for_family(family_id)
-        }
+        session = get_open_sleep_session(family_id)
+        return session[1] if session else None
     except Exception as e:
-        print(f"❌ Ошибка получения статистики кормлений: {e}")
-        return {'count': 0, 'last_time': None}
+        print(f"❌ Ошибка получения сессии сна: {e}")
+        return None
 
-def get_diaper_stats(family_id: int, days: int = 7) -> Dict[str, Any]:
-    """Получить статистику смен подгузников"""
+def start_sleep(user_id: int, minutes_ago: int = 0) -> bool:
+    """Начать сессию сна; False, если малыш уже спит или запись не удалась"""
     try:
-        start_date = get_thai_time() - timedelta(days=days)
-        
-        result = supabase.table('diapers').select('timestamp').eq('family_id', family_id).gte('timestamp', start_date.isoformat()).execute()
-        
-        return {
-            'count': len(result.data),
-            'last_time': get_last_diaper_change_time_for_family(family_id)
-        }
+        membership = get_membership(user_id)
+        if not membership or not membership['family_id']:
+            return False
+        family_id = membership['family_id']
+        if get_open_sleep_session(family_id):
+            return False
+
+        start_time = timeutils.utc_now() - timedelta(minutes=minutes_ago)
+        # Вторую открытую сессию семьи не даст создать уникальный частичный индекс
+        result = safe_execute(lambda: supabase.table('sleep_sessions').insert({
+            'family_id': family_id,
+            'author_id': user_id,
+            'start_time': start_time.isoformat(),
+            'author_role': membership['role'] or 'Родитель',
+            'author_name': membership['name'] or 'Неизвестно'
+        }).execute())
+        if not result or not result.data:
+            return False
+        sleep_index.start(family_id, result.data[0]['id'], start_time)
+        return True
+    except QueryRetryNeeded:
+        raise
     except Exception as e:
-        print(f"❌ Ошибка получения статистики подгузников: {e}")
-        return {'count': 0, 'last_time': None}
+        print(f"❌ Ошибка начала сна: {e}")
+        return False
 
-def get_bath_stats(family_id: int, days: int = 7) -> Dict[str, Any]:
-    """Получить статистику купаний"""
+def stop_sleep(family_id: int) -> Optional[int]:
+    """Завершить открытую сессию сна; возвращает длительность сна в минутах или None"""
     try:
-        start_date = get_thai_time() - timedelta(days=days)
-        
-        result = supabase.table('baths').select('timestamp').eq('family_id', family_id).gte('timestamp', start_date.isoformat()).execute()
-        
-        return {
-            'count': len(result.data),
-            'last_time': get_last_bath_time_for_family(family_id)
+        session = get_open_sleep_session(family_id)
+        if not session:
+            return None
+        session_id, start_time = session
+        end_time = timeutils.utc_now()
+        duration_minutes = max(0, int((end_time - start_time).total_seconds() // 60))
+        result = safe_execute(lambda: supabase.table('sleep_sessions').update({
+            'end_time': end_time.isoformat(),
+            'duration_minutes': duration_minutes
+        }).eq('id', session_id).execute())
+        if result is None:
+            return None
+        sleep_index.stop(family_id)
+        return duration_minutes
+    except QueryRetryNeeded:
+        raise
+    except Exception as e:
+        print(f"❌ Ошибка завершения сна: {e}")
+        return None
+
+def get_woken_families(since: datetime) -> Optional[List[int]]:
+    """Семьи, малыш которых проснулся не раньше since (индекс idx_sleep_sessions_end_time); None при ошибке"""
+    try:
+        rows = event_store.fetch_all_rows(
+            lambda: supabase.table('sleep_sessions').select('id, family_id').gte('end_time', since.isoformat()).order('id')
+        )
+        return list(dict.fromkeys(row['family_id'] for row in rows))
+    except Exception as e:
+        print(f"❌ Ошибка получения проснувшихся малышей: {e}")
+        return None
+
+# ==================== ФУНКЦИИ ДЛЯ СТАТИСТИКИ ====================
+
+FAMILY_STATS_DAYS = 7
+# Сбрасывается, если функция get_family_stats не создана в базе (см. supabase_schema.sql)
+_stats_rpc_available = True
+
+def _empty_event_stats(last_time: Optional[datetime] = None) -> Dict[str, Any]:
+    return {'count': 0, 'last_time': last_time, 'mean_interval_minutes': None, 'per_day': {}}
+
+def _is_missing_function_error(error: Exception) -> bool:
+    """Ошибка PostgREST об отсутствующей SQL-функции"""
+    return getattr(error, 'code', None) in ('PGRST202', '42883')
+
+def _family_stats_from_rpc(data: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    stats = {}
+    for event_type in FAMILY_EVENT_TABLES:
+        row = (data or {}).get(event_type) or {}
+        stats[event_type] = {
+            'count': row.get('count') or 0,
+            'last_time': timeutils.parse_timestamp(row['last_time']) if row.get('last_time') else None,
+            'mean_interval_minutes': row.get('mean_interval_minutes'),
+            'per_day': row.get('per_day') or {},
+        }
+    return stats
+
+def _family_stats_fallback(family_id: int, since: datetime) -> Dict[str, Dict[str, Any]]:
+    """Статистика без RPC: количество считает сервер (count='exact'), строки не загружаются.
+    Из разбивки по дням доступен только сегодняшний день"""
+    state = get_family_state(family_id)
+    last_events = state['last_events'] if state else {}
+    today_start = timeutils.local_day_start(get_family_timezone(family_id))
+    stats = {}
+    for event_type, table in FAMILY_EVENT_TABLES.items():
+        counts = []
+        for start in (since, today_start):
+            result = supabase.table(table).select('id', count='exact', head=True).eq('family_id', family_id).gte('timestamp', start.isoformat()).execute()
+            counts.append(result.count or 0)
+        stats[event_type] = {
+            **_empty_event_stats(last_events.get(event_type)),
+            'count': counts[0],
+            'per_day': {today_start.date().isoformat(): counts[1]},
         }
+    return stats
+
+def get_family_stats(family_id: int, days: int = FAMILY_STATS_DAYS) -> Dict[str, Dict[str, Any]]:
+    """Статистика всех событий семьи за days дней: количество, последнее время,
+    средний интервал и разбивка по дням - одним запросом к RPC get_family_stats"""
+    global _stats_rpc_available
+    since = timeutils.utc_now() - timedelta(days=days)
+    try:
+        if _stats_rpc_available:
+            try:
+                result = supabase.rpc('get_family_stats', {
+                    'p_family_id': family_id,
+                    'p_since': since.isoformat(),
+                    'p_timezone': get_family_timezone(family_id),
+                }).execute()
+                return _family_stats_from_rpc(result.data)
+            except Exception as rpc_error:
+                if not _is_missing_function_error(rpc_error):
+                    raise
+                print("⚠️ Функция get_family_stats не найдена в базе, статистика считается через count-запросы")
+                _stats_rpc_available = False
+        return _family_stats_fallback(family_id, since)
     except Exception as e:
-        print(f"❌ Ошибка получения статистики купаний: {e}")
-        return {'count': 0, 'last_time': None}
+        print(f"❌ Ошибка получения статистики: {e}")
+        return {event_type: _empty_event_stats() for event_type in FAMILY_EVENT_TABLES}
+
+def get_feeding_stats(family_id: int, days: int = 7) -> Dict[str, Any]:
+    """Получить статистику кормлений"""
+    return get_family_stats(family_id, days)['feeding']
+
+def get_diaper_stats(family_id: int, days: int = 7) -> Dict[str, Any]:
+    """Получить статистику смен подгузников"""
+    return get_family_stats(family_id, days)['diaper']
+
+def get_bath_stats(family_id: int, days: int = 7) -> Dict[str, Any]:
+    """Получить статистику купаний"""
+    return get_family_stats(family_id, days)['bath']
 
 def get_activity_stats(family_id: int, days: int = 7) -> Dict[str, Any]:
     """Получить статистику активностей"""
+    return get_family_stats(family_id, days)['activity']
+
+def get_settings_overview(family_id: int) -> Optional[Dict[str, Any]]:
+    """Данные экрана настроек: настройки из кэша состояния семьи и статистика одним запросом"""
     try:
-        start_date = get_thai_time() - timedelta(days=days)
-        
-        result = supabase.table('activities').select('timestamp').eq('family_id', family_id).gte('timestamp', start_date.isoformat()).execute()
-        
+        state = get_family_state(family_id)
+        settings = dict(state['settings']) if state and state['settings'] else {}
+        stats = get_family_stats(family_id)
+        today = timeutils.local_date(get_family_timezone(family_id)).isoformat()
         return {
-            'count': len(result.data),
-            'last_time': get_last_activity_time_for_family(family_id)
+            'settings': settings,
+            'feed_interval': settings.get('feed_interval', 3),
+            'diaper_interval': settings.get('diaper_interval', 2),
+            'birth_date': settings.get('baby_birth_date'),
+            'today': {event_type: event_stats['per_day'].get(today, 0) for event_type, event_stats in stats.items()},
+            'stats': stats,
         }
     except Exception as e:
-        print(f"❌ Ошибка получения статистики активностей: {e}")
-        return {'count': 0, 'last_time': None}
+        print(f"❌ Ошибка получения данных экрана настроек: {e}")
+        return None
 
 # ==================== ФУНКЦИИ ДЛЯ НАСТРОЕК УВЕДОМЛЕНИЙ ====================
 
 def get_notification_settings(family_id: int) -> Dict[str, Any]:
     """Получить настройки уведомлений"""
     try:
-        result = supabase.table('settings').select('*').eq('family_id', family_id).execute()
-        if result.data:
-            return result.data[0]
+        state = get_family_state(family_id)
+        if state and state['settings']:
+            return dict(state['settings'])
         return {}
     except Exception as e:
         print(f"❌ Ошибка получения настроек уведомлений: {e}")
@@ -655,49 +903,42 @@ def update_notification_settings(family_id: int, settings: Dict[str, Any]) -> bo
     """Обновить настройки уведомлений"""
     try:
         supabase.table('settings').update(settings).eq('family_id', family_id).execute()
+        _remember_family_settings(family_id, settings)
         return True
     except Exception as e:
         print(f"❌ Ошибка обновления настроек уведомлений: {e}")
         return False
 
+def get_family_timezone(family_id: int) -> str:
+    """Часовой пояс семьи из кэша настроек (settings.timezone)"""
+    state = get_family_state(family_id)
+    settings = state['settings'] if state and state['settings'] else {}
+    timezone_name = settings.get('timezone')
+    return timezone_name if timeutils.is_valid_timezone(timezone_name) else timeutils.DEFAULT_TIMEZONE
+
+def set_family_timezone(family_id: int, timezone_name: str) -> bool:
+    """Установить часовой пояс семьи (имя IANA, например Europe/Moscow)"""
+    if not timeutils.is_valid_timezone(timezone_name):
+        return False
+    return update_notification_settings(family_id, {'timezone': timezone_name})
+
 # ==================== ФУНКЦИИ ДЛЯ СОВЕТОВ ====================
 
+DEFAULT_TIP = "💡 Помните: каждый малыш уникален! Следуйте рекомендациям педиатра и доверяйте своей интуиции."
+
 def get_random_tip(age_months: int) -> Optional[str]:
-    """Получить случайный совет для возраста из базы данных"""
+    """Получить случайный совет для возраста из каталога советов.
+    Если для точного возраста советов нет, берется ближайший меньший, затем больший возраст"""
     try:
-        import random
-        
-        # Получаем советы из базы данных для точного возраста
-        result = supabase.table('tips').select('content').eq('age_months', age_months).execute()
-        
-        if result.data:
-            return random.choice(result.data)['content']
-        
-        # Если нет советов для точного возраста, ищем ближайший доступный возраст
-        # Сначала ищем для меньших возрастов (более подходящие советы)
-        for check_age in range(age_months - 1, -1, -1):
-            result = supabase.table('tips').select('content').eq('age_months', check_age).execute()
-            if result.data:
-                return random.choice(result.data)['content']
-        
-        # Если не нашли для меньших возрастов, ищем для больших возрастов
-        for check_age in range(age_months + 1, 13):  # до 12 месяцев
-            result = supabase.table('tips').select('content').eq('age_months', check_age).execute()
-            if result.data:
-                return random.choice(result.data)['content']
-        
-        # Если вообще нет советов в базе данных, возвращаем общий совет
-        return "💡 Помните: каждый малыш уникален! Следуйте рекомендациям педиатра и доверяйте своей интуиции."
-        
+        return tips_catalog.random_tip(age_months) or DEFAULT_TIP
     except Exception as e:
         print(f"❌ Ошибка получения совета: {e}")
-        return "💡 Помните: каждый малыш уникален! Следуйте рекомендациям педиатра и доверяйте своей интуиции."
+        return DEFAULT_TIP
 
 def get_tips_by_category(age_months: int, category: str) -> List[str]:
     """Получить советы по категории для возраста"""
     try:
-        result = supabase.table('tips').select('content').eq('age_months', age_months).eq('category', category).execute()
-        return [tip['content'] for tip in result.data]
+        return tips_catalog.get_tips(age_months, category, nearest=False)
     except Exception as e:
         print(f"❌ Ошибка получения советов по категории: {e}")
         return []
@@ -705,9 +946,7 @@ def get_tips_by_category(age_months: int, category: str) -> List[str]:
 def get_all_categories() -> List[str]:
     """Получить все доступные категории советов"""
     try:
-        result = supabase.table('tips').select('category').execute()
-        categories = list(set([tip['category'] for tip in result.data]))
-        return sorted(categories)
+        return tips_catalog.get_categories()
     except Exception as e:
         print(f"❌ Ошибка получения категорий: {e}")
         return []
@@ -717,8 +956,7 @@ def get_all_categories() -> List[str]:
 def get_feeding_history(family_id: int, limit: int = 10) -> List[Dict[str, Any]]:
     """Получить историю кормлений"""
     try:
-        result = supabase.table('feedings').select('*').eq('family_id', family_id).order('timestamp', desc=True).limit(limit).execute()
-        return result.data
+        return event_store.event_history(family_id, EventKind.FEEDING, limit)
     except Exception as e:
         print(f"❌ Ошибка получения истории кормлений: {e}")
         return []
@@ -726,8 +964,7 @@ def get_feeding_history(family_id: int, limit: int = 10) -> List[Dict[str, Any]]
 def get_diaper_history(family_id: int, limit: int = 10) -> List[Dict[str, Any]]:
     """Получить историю смен подгузников"""
     try:
-        result = supabase.table('diapers').select('*').eq('family_id', family_id).order('timestamp', desc=True).limit(limit).execute()
-        return result.data
+        return event_store.event_history(family_id, EventKind.DIAPER, limit)
     except Exception as e:
         print(f"❌ Ошибка получения истории подгузников: {e}")
         return []
@@ -735,8 +972,7 @@ def get_diaper_history(family_id: int, limit: int = 10) -> List[Dict[str, Any]]:
 def get_bath_history(family_id: int, limit: int = 10) -> List[Dict[str, Any]]:
     """Получить историю купаний"""
     try:
-        result = supabase.table('baths').select('*').eq('family_id', family_id).order('timestamp', desc=True).limit(limit).execute()
-        return result.data
+        return event_store.event_history(family_id, EventKind.BATH, limit)
     except Exception as e:
         print(f"❌ Ошибка получения истории купаний: {e}")
         return []
@@ -744,8 +980,7 @@ def get_bath_history(family_id: int, limit: int = 10) -> List[Dict[str, Any]]:
 def get_activity_history(family_id: int, limit: int = 10) -> List[Dict[str, Any]]:
     """Получить историю активностей"""
     try:
-        result = supabase.table('activities').select('*').eq('family_id', family_id).order('timestamp', desc=True).limit(limit).execute()
-        return result.data
+        return event_store.event_history(family_id, EventKind.ACTIVITY, limit)
     except Exception as e:
         print(f"❌ Ошибка получения истории активностей: {e}")
         return []
@@ -767,6 +1002,8 @@ def test_connection() -> bool:
         else:
             print("❌ Не удалось подключиться к Supabase после повторных попыток")
             return False
+    except QueryRetryNeeded:
+        raise
     except Exception as e:
         print(f"❌ Критическая ошибка подключения к Supabase: {e}")
         return False
@@ -792,7 +1029,7 @@ def get_families_needing_feeding_reminder() -> List[Dict[str, Any]]:
                 continue
             
             # Вычисляем время с последнего кормления
-            now = get_thai_time()
+            now = timeutils.utc_now()
             time_diff = now - last_feeding
             hours_since_feeding = time_diff.total_seconds() / 3600
             
@@ -828,7 +1065,7 @@ def get_families_needing_diaper_reminder() -> List[Dict[str, Any]]:
                 continue
             
             # Вычисляем время с последней смены
-            now = get_thai_time()
+            now = timeutils.utc_now()
             time_diff = now - last_diaper
             hours_since_diaper = time_diff.total_seconds() / 3600
             
@@ -854,6 +1091,39 @@ def get_family_members_for_notification(family_id: int) -> List[int]:
         print(f"❌ Ошибка получения членов семьи для уведомлений: {e}")
         return []
 
+def evaluate_smart_reminder_conditions(settings: Dict[str, Any], last_feeding: Optional[datetime],
+                                       last_diaper: Optional[datetime], now: datetime) -> Dict[str, Any]:
+    """Вычислить условия напоминаний по уже загруженным данным (без запросов к БД)"""
+    feed_interval = settings.get('feed_interval', 3)
+    diaper_interval = settings.get('diaper_interval', 2)
+    
+    # Проверяем кормление
+    if last_feeding:
+        hours_since_feeding = (now - last_feeding).total_seconds() / 3600
+        needs_feeding = hours_since_feeding >= feed_interval
+    else:
+        # Если кормлений не было, напоминаем сразу
+        needs_feeding = True
+        hours_since_feeding = 24  # Большое значение для отображения
+    
+    # Проверяем смену подгузника
+    if last_diaper:
+        hours_since_diaper = (now - last_diaper).total_seconds() / 3600
+        needs_diaper = hours_since_diaper >= diaper_interval
+    else:
+        # Если смен подгузника не было, напоминаем сразу
+        needs_diaper = True
+        hours_since_diaper = 24  # Большое значение для отображения
+    
+    return {
+        'needs_feeding': needs_feeding,
+        'needs_diaper': needs_diaper,
+        'hours_since_feeding': hours_since_feeding,
+        'hours_since_diaper': hours_since_diaper,
+        'feed_interval': feed_interval,
+        'diaper_interval': diaper_interval
+    }
+
 def check_smart_reminder_conditions(family_id: int) -> Dict[str, Any]:
     """Проверить условия для напоминаний"""
     try:
@@ -862,106 +1132,73 @@ def check_smart_reminder_conditions(family_id: int) -> Dict[str, Any]:
         if not settings:
             return {'needs_feeding': False, 'needs_diaper': False}
         
-        feed_interval = settings.get('feed_interval', 3)
-        diaper_interval = settings.get('diaper_interval', 2)
-        
-        # Проверяем кормление
-        last_feeding = get_last_feeding_time_for_family(family_id)
-        needs_feeding = False
-        hours_since_feeding = 0
+        return evaluate_smart_reminder_conditions(
+            settings,
+            get_last_feeding_time_for_family(family_id),
+            get_last_diaper_change_time_for_family(family_id),
+            timeutils.utc_now()
+        )
+    except Exception as e:
+        print(f"❌ Ошибка проверки условий напоминаний: {e}")
+        return {'needs_feeding': False, 'needs_diaper': False}
+
+def build_smart_reminder_message(conditions: Dict[str, Any]) -> Optional[str]:
+    """Собрать текст напоминания по вычисленным условиям"""
+    if not conditions.get('needs_feeding') and not conditions.get('needs_diaper'):
+        return None
+    
+    # Определяем основной заголовок в зависимости от того, что нужно
+    if conditions['needs_feeding'] and conditions['needs_diaper']:
+        message = "🔔 **Время кормления и смены подгузника!**\n\n"
+    elif conditions['needs_feeding']:
+        message = "🍼 **Время кормления!**\n\n"
+    else:
+        message = "💩 **Время смены подгузника!**\n\n"
+    
+    if conditions['needs_feeding']:
+        hours = int(conditions['hours_since_feeding'])
+        minutes = int((conditions['hours_since_feeding'] - hours) * 60)
         
-        if last_feeding:
-            now = get_thai_time()
-            time_diff = now - last_feeding
-            hours_since_feeding = time_diff.total_seconds() / 3600
-            needs_feeding = hours_since_feeding >= feed_interval
+        if hours > 0:
+            time_str = f"{hours}ч {minutes}м"
         else:
-            # Если кормлений не было, напоминаем через 1 час
-            needs_feeding = True
-            hours_since_feeding = 24  # Большое значение для отображения
+            time_str = f"{minutes}м"
         
-        # Проверяем смену подгузника
-        last_diaper = get_last_diaper_change_time_for_family(family_id)
-        needs_diaper = False
-        hours_since_diaper = 0
+        if conditions['hours_since_feeding'] >= 24:
+            message += f"🍼 **Кормление:**\n"
+            message += f"• Последний раз кормили: давно\n"
+            message += f"• Интервал: {conditions['feed_interval']}ч\n\n"
+        else:
+            message += f"🍼 **Кормление:**\n"
+            message += f"• Прошло: {time_str}\n"
+            message += f"• Интервал: {conditions['feed_interval']}ч\n\n"
+    
+    if conditions['needs_diaper']:
+        hours = int(conditions['hours_since_diaper'])
+        minutes = int((conditions['hours_since_diaper'] - hours) * 60)
         
-        if last_diaper:
-            now = get_thai_time()
-            time_diff = now - last_diaper
-            hours_since_diaper = time_diff.total_seconds() / 3600
-            needs_diaper = hours_since_diaper >= diaper_interval
+        if hours > 0:
+            time_str = f"{hours}ч {minutes}м"
         else:
-            # Если смен подгузника не было, напоминаем через 1 час
-            needs_diaper = True
-            hours_since_diaper = 24  # Большое значение для отображения
+            time_str = f"{minutes}м"
         
-        return {
-            'needs_feeding': needs_feeding,
-            'needs_diaper': needs_diaper,
-            'hours_since_feeding': hours_since_feeding,
-            'hours_since_diaper': hours_since_diaper,
-            'feed_interval': feed_interval,
-            'diaper_interval': diaper_interval
-        }
-    except Exception as e:
-        print(f"❌ Ошибка проверки условий напоминаний: {e}")
-        return {'needs_feeding': False, 'needs_diaper': False}
+        if conditions['hours_since_diaper'] >= 24:
+            message += f"💩 **Смена подгузника:**\n"
+            message += f"• Последняя смена: давно\n"
+            message += f"• Интервал: {conditions['diaper_interval']}ч\n\n"
+        else:
+            message += f"💩 **Смена подгузника:**\n"
+            message += f"• Прошло: {time_str}\n"
+            message += f"• Интервал: {conditions['diaper_interval']}ч\n\n"
+    
+    message += "💡 **Быстрые действия:**"
+    
+    return message
 
 def get_smart_reminder_message(family_id: int) -> Optional[str]:
     """Получить сообщение напоминания для семьи"""
     try:
-        conditions = check_smart_reminder_conditions(family_id)
-        
-        if not conditions['needs_feeding'] and not conditions['needs_diaper']:
-            return None
-        
-        # Определяем основной заголовок в зависимости от того, что нужно
-        if conditions['needs_feeding'] and conditions['needs_diaper']:
-            message = "🔔 **Время кормления и смены подгузника!**\n\n"
-        elif conditions['needs_feeding']:
-            message = "🍼 **Время кормления!**\n\n"
-        else:
-            message = "💩 **Время смены подгузника!**\n\n"
-        
-        if conditions['needs_feeding']:
-            hours = int(conditions['hours_since_feeding'])
-            minutes = int((conditions['hours_since_feeding'] - hours) * 60)
-            
-            if hours > 0:
-                time_str = f"{hours}ч {minutes}м"
-            else:
-                time_str = f"{minutes}м"
-            
-            if conditions['hours_since_feeding'] >= 24:
-                message += f"🍼 **Кормление:**\n"
-                message += f"• Последний раз кормили: давно\n"
-                message += f"• Интервал: {conditions['feed_interval']}ч\n\n"
-            else:
-                message += f"🍼 **Кормление:**\n"
-                message += f"• Прошло: {time_str}\n"
-                message += f"• Интервал: {conditions['feed_interval']}ч\n\n"
-        
-        if conditions['needs_diaper']:
-            hours = int(conditions['hours_since_diaper'])
-            minutes = int((conditions['hours_since_diaper'] - hours) * 60)
-            
-            if hours > 0:
-                time_str = f"{hours}ч {minutes}м"
-            else:
-                time_str = f"{minutes}м"
-            
-            if conditions['hours_since_diaper'] >= 24:
-                message += f"💩 **Смена подгузника:**\n"
-                message += f"• Последняя смена: давно\n"
-                message += f"• Интервал: {conditions['diaper_interval']}ч\n\n"
-            else:
-                message += f"💩 **Смена подгузника:**\n"
-                message += f"• Прошло: {time_str}\n"
-                message += f"• Интервал: {conditions['diaper_interval']}ч\n\n"
-        
-        message += "💡 **Быстрые действия:**"
-        
-        return message
+        return build_smart_reminder_message(check_smart_reminder_conditions(family_id))
     except Exception as e:
         print(f"❌ Ошибка создания сообщения напоминания: {e}")
         return None
@@ -988,7 +1225,7 @@ def get_time_until_next_feeding(family_id: int) -> Optional[float]:
         if not last_feeding:
             return None
         
-        now = get_thai_time()
+        now = timeutils.utc_now()
         time_diff = now - last_feeding
         hours_since_feeding = time_diff.total_seconds() / 3600
         
@@ -1012,7 +1249,7 @@ def get_time_until_next_diaper_change(family_id: int) -> Optional[float]:
         if not last_diaper:
             return None
         
-        now = get_thai_time()
+        now = timeutils.utc_now()
         time_diff = now - last_diaper
         hours_since_diaper = time_diff.total_seconds() / 3600
         
@@ -1059,6 +1296,37 @@ def check_pre_reminder_conditions(family_id: int) -> Dict[str, Any]:
         print(f"❌ Ошибка проверки предварительных условий: {e}")
         return {'needs_pre_feeding': False, 'needs_pre_diaper': False}
 
+def evaluate_overdue_reminder_conditions(settings: Dict[str, Any], last_feeding: Optional[datetime],
+                                         last_diaper: Optional[datetime], now: datetime) -> Dict[str, Any]:
+    """Вычислить условия просроченных напоминаний по уже загруженным данным"""
+    feed_interval = settings.get('feed_interval', 3)
+    diaper_interval = settings.get('diaper_interval', 2)
+    
+    # Проверяем кормление
+    needs_overdue_feeding = False
+    hours_since_feeding = 0
+    
+    if last_feeding:
+        hours_since_feeding = (now - last_feeding).total_seconds() / 3600
+        # Если прошло больше интервала + 20 минут (~0.333 часа)
+        needs_overdue_feeding = hours_since_feeding >= (feed_interval + (20.0 / 60.0))
+    
+    # Проверяем смену подгузника
+    needs_overdue_diaper = False
+    hours_since_diaper = 0
+    
+    if last_diaper:
+        hours_since_diaper = (now - last_diaper).total_seconds() / 3600
+        # Если прошло больше интервала + 20 минут (~0.333 часа)
+        needs_overdue_diaper = hours_since_diaper >= (diaper_interval + (20.0 / 60.0))
+    
+    return {
+        'needs_overdue_feeding': needs_overdue_feeding,
+        'needs_overdue_diaper': needs_overdue_diaper,
+        'hours_since_feeding': hours_since_feeding,
+        'hours_since_diaper': hours_since_diaper
+    }
+
 def check_overdue_reminder_conditions(family_id: int) -> Dict[str, Any]:
     """Проверить условия для напоминаний о пропущенных событиях (через 20 минут после времени)"""
     try:
@@ -1066,39 +1334,12 @@ def check_overdue_reminder_conditions(family_id: int) -> Dict[str, Any]:
         if not settings:
             return {'needs_overdue_feeding': False, 'needs_overdue_diaper': False}
         
-        feed_interval = settings.get('feed_interval', 3)
-        diaper_interval = settings.get('diaper_interval', 2)
-        
-        # Проверяем кормление
-        last_feeding = get_last_feeding_time_for_family(family_id)
-        needs_overdue_feeding = False
-        
-        if last_feeding:
-            now = get_thai_time()
-            time_diff = now - last_feeding
-            hours_since_feeding = time_diff.total_seconds() / 3600
-            
-            # Если прошло больше интервала + 20 минут (~0.333 часа)
-            needs_overdue_feeding = hours_since_feeding >= (feed_interval + (20.0 / 60.0))
-        
-        # Проверяем смену подгузника
-        last_diaper = get_last_diaper_change_time_for_family(family_id)
-        needs_overdue_diaper = False
-        
-        if last_diaper:
-            now = get_thai_time()
-            time_diff = now - last_diaper
-            hours_since_diaper = time_diff.total_seconds() / 3600
-            
-            # Если прошло больше интервала + 20 минут (~0.333 часа)
-            needs_overdue_diaper = hours_since_diaper >= (diaper_interval + (20.0 / 60.0))
-        
-        return {
-            'needs_overdue_feeding': needs_overdue_feeding,
-            'needs_overdue_diaper': needs_overdue_diaper,
-            'hours_since_feeding': hours_since_feeding if last_feeding else 0,
-            'hours_since_diaper': hours_since_diaper if last_diaper else 0
-        }
+        return evaluate_overdue_reminder_conditions(
+            settings,
+            get_last_feeding_time_for_family(family_id),
+            get_last_diaper_change_time_for_family(family_id),
+            timeutils.utc_now()
+        )
     except Exception as e:
         print(f"❌ Ошибка проверки условий просроченных напоминаний: {e}")
         return {'needs_overdue_feeding': False, 'needs_overdue_diaper': False}
@@ -1144,51 +1385,53 @@ def get_pre_reminder_message(family_id: int) -> Optional[str]:
         print(f"❌ Ошибка создания предварительного сообщения: {e}")
         return None
 
-def get_overdue_reminder_message(family_id: int) -> Optional[str]:
-    """Получить сообщение напоминания о просроченных событиях (через 20 минут)"""
-    try:
-        conditions = check_overdue_reminder_conditions(family_id)
-        
-        if not conditions['needs_overdue_feeding'] and not conditions['needs_overdue_diaper']:
-            return None
+def build_overdue_reminder_message(conditions: Dict[str, Any]) -> Optional[str]:
+    """Собрать текст напоминания о просроченных событиях по вычисленным условиям"""
+    if not conditions.get('needs_overdue_feeding') and not conditions.get('needs_overdue_diaper'):
+        return None
+    
+    # Определяем основной заголовок
+    if conditions['needs_overdue_feeding'] and conditions['needs_overdue_diaper']:
+        message = "🚨 **Пропущено время кормления и смены подгузника!**\n\n"
+    elif conditions['needs_overdue_feeding']:
+        message = "🚨 **Пропущено время кормления!**\n\n"
+    else:
+        message = "🚨 **Пропущено время смены подгузника!**\n\n"
+    
+    if conditions['needs_overdue_feeding']:
+        hours = int(conditions['hours_since_feeding'])
+        minutes = int((conditions['hours_since_feeding'] - hours) * 60)
         
-        # Определяем основной заголовок
-        if conditions['needs_overdue_feeding'] and conditions['needs_overdue_diaper']:
-            message = "🚨 **Пропущено время кормления и смены подгузника!**\n\n"
-        elif conditions['needs_overdue_feeding']:
-            message = "🚨 **Пропущено время кормления!**\n\n"
+        if hours > 0:
+            time_str = f"{hours}ч {minutes}м"
         else:
-            message = "🚨 **Пропущено время смены подгузника!**\n\n"
-        
-        if conditions['needs_overdue_feeding']:
-            hours = int(conditions['hours_since_feeding'])
-            minutes = int((conditions['hours_since_feeding'] - hours) * 60)
-            
-            if hours > 0:
-                time_str = f"{hours}ч {minutes}м"
-            else:
-                time_str = f"{minutes}м"
-            
-            message += f"🍼 **Кормление:**\n"
-            message += f"• Прошло: {time_str}\n"
-            message += f"• Пропущено на 20+ минут\n\n"
+            time_str = f"{minutes}м"
         
-        if conditions['needs_overdue_diaper']:
-            hours = int(conditions['hours_since_diaper'])
-            minutes = int((conditions['hours_since_diaper'] - hours) * 60)
-            
-            if hours > 0:
-                time_str = f"{hours}ч {minutes}м"
-            else:
-                time_str = f"{minutes}м"
-            
-            message += f"💩 **Смена подгузника:**\n"
-            message += f"• Прошло: {time_str}\n"
-            message += f"• Пропущено на 20+ минут\n\n"
+        message += f"🍼 **Кормление:**\n"
+        message += f"• Прошло: {time_str}\n"
+        message += f"• Пропущено на 20+ минут\n\n"
+    
+    if conditions['needs_overdue_diaper']:
+        hours = int(conditions['hours_since_diaper'])
+        minutes = int((conditions['hours_since_diaper'] - hours) * 60)
         
-        message += "💡 **Немедленные действия:**"
+        if hours > 0:
+            time_str = f"{hours}ч {minutes}м"
+        else:
+            time_str = f"{minutes}м"
         
-        return message
+        message += f"💩 **Смена подгузника:**\n"
+        message += f"• Прошло: {time_str}\n"
+        message += f"• Пропущено на 20+ минут\n\n"
+    
+    message += "💡 **Немедленные действия:**"
+    
+    return message
+
+def get_overdue_reminder_message(family_id: int) -> Optional[str]:
+    """Получить сообщение напоминания о просроченных событиях (через 20 минут)"""
+    try:
+        return build_overdue_reminder_message(check_overdue_reminder_conditions(family_id))
     except Exception as e:
         print(f"❌ Ошибка создания сообщения о просроченных событиях: {e}")
         return None
@@ -1210,93 +1453,411 @@ def create_notification_tracking_table():
         print(f"❌ Ошибка создания таблицы отслеживания: {e}")
         return False
 
-def log_notification_sent(family_id: int, notification_type: str, event_time: datetime) -> bool:
-    """Записать отправленное уведомление"""
+# Типы уведомлений по группам событий: подтверждаются одним запросом
+NOTIFICATION_TYPES_BY_GROUP = {
+    'feeding': ('pre_feeding', 'due_feeding', 'overdue_feeding'),
+    'diaper': ('pre_diaper', 'due_diaper', 'overdue_diaper'),
+}
+
+# Буфер записей notification_tracking: проверка напоминаний копит их
+# и записывает одной вставкой в конце прохода (flush_notification_log)
+NOTIFICATION_LOG_BATCH_SIZE = 500
+_notification_log_buffer: List[Dict[str, Any]] = []
+_notification_log_lock = threading.Lock()
+
+def _notification_row(family_id: int, notification_type: str, event_time: datetime,
+                      sent_at: datetime) -> Dict[str, Any]:
+    return {
+        'family_id': family_id,
+        'notification_type': notification_type,
+        'event_time': event_time.isoformat(),
+        'sent_at': sent_at.isoformat(),
+        'status': 'sent'
+    }
+
+def log_notification_sent(family_id: int, notification_type: str, event_time: datetime,
+                          buffered: bool = False) -> bool:
+    """Записать отправленное уведомление (buffered - отложить до flush_notification_log)"""
+    sent_at = timeutils.utc_now()
+    row = _notification_row(family_id, notification_type, event_time, sent_at)
+    if buffered:
+        with _notification_log_lock:
+            _notification_log_buffer.append(row)
+            full = len(_notification_log_buffer) >= NOTIFICATION_LOG_BATCH_SIZE
+        notification_index.record_sent(family_id, notification_type, sent_at)
+        if full:
+            flush_notification_log()
+        return True
     try:
-        supabase.table('notification_tracking').insert({
-            'family_id': family_id,
-            'notification_type': notification_type,
-            'event_time': event_time.isoformat(),
-            'sent_at': get_thai_time().isoformat(),
-            'status': 'sent'
-        }).execute()
+        supabase.table('notification_tracking').insert(row).execute()
+        notification_index.record_sent(family_id, notification_type, sent_at)
         return True
     except Exception as e:
         print(f"❌ Ошибка записи уведомления: {e}")
         return False
 
+def flush_notification_log() -> int:
+    """Записать накопленные уведомления пакетами; при ошибке строки остаются в буфере"""
+    with _notification_log_lock:
+        rows = _notification_log_buffer[:]
+        _notification_log_buffer.clear()
+    written = 0
+    for start in range(0, len(rows), NOTIFICATION_LOG_BATCH_SIZE):
+        batch = rows[start:start + NOTIFICATION_LOG_BATCH_SIZE]
+        try:
+            supabase.table('notification_tracking').insert(batch).execute()
+            written += len(batch)
+        except Exception as e:
+            print(f"❌ Ошибка записи уведомлений ({len(rows) - written} шт. будут записаны позже): {e}")
+            with _notification_log_lock:
+                _notification_log_buffer[:0] = rows[written:]
+            break
+    return written
+
+def _notification_index_authoritative() -> bool:
+    """Индекс уведомлений полон, если загружен и все отметки делает этот процесс.
+    При нескольких воркерах подтверждения приходят через другой воркер, поэтому индекс перечитывается"""
+    return notification_index.is_loaded() and not sharding.is_sharded()
+
 def check_recent_notification(family_id: int, notification_type: str, minutes_threshold: int = 5) -> bool:
     """Проверить, было ли отправлено уведомление недавно"""
+    if _notification_index_authoritative():
+        return notification_index.has_recent(family_id, notification_type, minutes_threshold, timeutils.utc_now())
     try:
+        # Покрывается индексом (family_id, notification_type, status, sent_at)
         query = supabase.table('notification_tracking').select('sent_at').eq('family_id', family_id).eq('notification_type', notification_type).eq('status', 'sent')
 
         if minutes_threshold is not None and minutes_threshold > 0:
-            threshold_time = get_thai_time() - timedelta(minutes=minutes_threshold)
+            threshold_time = timeutils.utc_now() - timedelta(minutes=minutes_threshold)
             query = query.gte('sent_at', threshold_time.isoformat())
 
-        result = query.execute()
+        result = query.limit(1).execute()
 
         return len(result.data) > 0
     except Exception as e:
         print(f"❌ Ошибка проверки недавних уведомлений: {e}")
         return False
 
-def acknowledge_notification(family_id: int, notification_type: str) -> bool:
-    """Отметить уведомление как подтвержденное"""
+def acknowledge_notifications(family_id: int, notification_types: List[str]) -> bool:
+    """Отметить уведомления указанных типов как подтвержденные одним запросом"""
+    # Еще не записанные отметки из буфера тоже подтверждаются, иначе они попадут в БД как 'sent'
+    with _notification_log_lock:
+        for row in _notification_log_buffer:
+            if row['family_id'] == family_id and row['notification_type'] in notification_types:
+                row['status'] = 'acknowledged'
     try:
         supabase.table('notification_tracking').update({
             'status': 'acknowledged'
-        }).eq('family_id', family_id).eq('notification_type', notification_type).eq('status', 'sent').execute()
+        }).eq('family_id', family_id).in_('notification_type', list(notification_types)).eq('status', 'sent').execute()
+        notification_index.acknowledge(family_id, notification_types)
         return True
     except Exception as e:
         print(f"❌ Ошибка подтверждения уведомления: {e}")
         return False
 
+def acknowledge_notification(family_id: int, notification_type: str) -> bool:
+    """Отметить уведомление как подтвержденное"""
+    return acknowledge_notifications(family_id, [notification_type])
+
+def acknowledge_notification_group(family_id: int, group: str) -> bool:
+    """Подтвердить все уведомления группы ('feeding' или 'diaper')"""
+    return acknowledge_notifications(family_id, NOTIFICATION_TYPES_BY_GROUP[group])
+
 def cleanup_old_notifications(days: int = 7) -> bool:
     """Очистить старые записи уведомлений"""
     try:
-        cutoff_time = get_thai_time() - timedelta(days=days)
+        cutoff_time = timeutils.utc_now() - timedelta(days=days)
         supabase.table('notification_tracking').delete().lt('sent_at', cutoff_time.isoformat()).execute()
         return True
     except Exception as e:
         print(f"❌ Ошибка очистки старых уведомлений: {e}")
         return False
 
+# ==================== МАССОВАЯ ПРОВЕРКА НАПОМИНАНИЙ ====================
+
+# Окно, в котором ищем последние кормления/смены; семьи без событий в окне
+# считаются семьями без событий (интервалы не превышают нескольких часов)
+REMINDER_SWEEP_LOOKBACK_HOURS = 48
+
+# Сроки следующего кормления и смены подгузника (последнее событие + интервал),
+# которые триггеры БД пересчитывают при записи события и смене интервала:
+# вид события -> (колонка срока, колонка интервала, интервал по умолчанию)
+NEXT_DUE_COLUMNS = {
+    EventKind.FEEDING: ('next_feeding_due_at', 'feed_interval', 3),
+    EventKind.DIAPER: ('next_diaper_due_at', 'diaper_interval', 2),
+}
+
+# Колонки настроек, нужные проверке напоминаний
+REMINDER_SETTINGS_COLUMNS = 'family_id, feed_interval, diaper_interval, sleep_monitoring_enabled'
+
+# Сбрасывается, если колонок сроков нет в settings (см. supabase_schema.sql)
+_next_due_available = True
+
+def _is_missing_column_error(error: Exception) -> bool:
+    """Ошибка PostgREST об отсутствующей колонке"""
+    return getattr(error, 'code', None) in ('42703', 'PGRST204')
+
+def _load_due_settings(now: datetime, since: datetime, family_ids: Optional[List[int]],
+                       due_within_minutes: Optional[int]) -> List[Dict[str, Any]]:
+    """Настройки семей со сроками событий. Без family_ids и с due_within_minutes
+    берутся только семьи, у которых срок события наступил или наступит в ближайшие
+    due_within_minutes минут - по индексу на колонке срока. Семьи без событий (срок NULL)
+    и с последним событием раньше since тоже выбираются: им напоминание нужно сразу"""
+    columns = (f'{REMINDER_SETTINGS_COLUMNS}, '
+               + ', '.join(column for column, _, _ in NEXT_DUE_COLUMNS.values()))
+    if family_ids is not None or due_within_minutes is None:
+        return event_store.fetch_all_rows(
+            lambda: (supabase.table('settings').select(columns).in_('family_id', family_ids)
+                     if family_ids is not None else supabase.table('settings').select(columns)).order('family_id')
+        )
+    until = now + timedelta(minutes=due_within_minutes)
+    rows = {}
+    for column, _, _ in NEXT_DUE_COLUMNS.values():
+        for row in event_store.fetch_all_rows(
+            lambda column=column: supabase.table('settings').select(columns)
+            .gte(column, since.isoformat()).lte(column, until.isoformat()).order('family_id')
+        ):
+            rows[row['family_id']] = row
+        for row in event_store.fetch_all_rows(
+            lambda column=column: supabase.table('settings').select(columns)
+            .or_(f'{column}.is.null,{column}.lt."{since.isoformat()}"').order('family_id')
+        ):
+            rows[row['family_id']] = row
+    return list(rows.values())
+
+def _last_events_from_due(settings_rows: List[Dict[str, Any]], kind: EventKind,
+                          since: datetime) -> Dict[int, datetime]:
+    """Время последнего события, восстановленное по сроку: срок - интервал"""
+    column, interval_column, default_interval = NEXT_DUE_COLUMNS[kind]
+    last_events = {}
+    for row in settings_rows:
+        if not row.get(column):
+            continue
+        last_event = timeutils.parse_timestamp(row[column]) - timedelta(hours=row.get(interval_column) or default_interval)
+        if last_event >= since:
+            last_events[row['family_id']] = last_event
+    return last_events
+
+def load_reminder_snapshot(family_ids: Optional[List[int]] = None,
+                           notification_window_minutes: int = 1440,
+                           family_filter=None,
+                           due_within_minutes: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    """Загрузить все данные для проверки напоминаний за постоянное число запросов.
+    family_filter отбирает семьи для проверки (например, семьи шарда воркера);
+    due_within_minutes ограничивает полную проверку семьями, срок которых близко"""
+    global _next_due_available
+    try:
+        now = timeutils.utc_now()
+        since = now - timedelta(hours=REMINDER_SWEEP_LOOKBACK_HOURS)
+
+        def scoped(query):
+            return query.in_('family_id', family_ids) if family_ids is not None else query
+
+        settings_rows = None
+        if _next_due_available:
+            try:
+                settings_rows = _load_due_settings(now, since, family_ids, due_within_minutes)
+                last_feeding = _last_events_from_due(settings_rows, EventKind.FEEDING, since)
+                last_diaper = _last_events_from_due(settings_rows, EventKind.DIAPER, since)
+            except Exception as e:
+                if not _is_missing_column_error(e):
+                    raise
+                print("⚠️ В settings нет колонок сроков событий (supabase_schema.sql); "
+                      "напоминания проверяются по таблицам событий")
+                _next_due_available = False
+                settings_rows = None
+
+        if settings_rows is None:
+            settings_rows = event_store.fetch_all_rows(
+                lambda: scoped(supabase.table('settings').select(REMINDER_SETTINGS_COLUMNS)).order('family_id')
+            )
+            latest = event_store.latest_events(family_ids, (EventKind.FEEDING, EventKind.DIAPER), since)
+            last_feeding = {family_id: times[EventKind.FEEDING] for family_id, times in latest.items()
+                            if times[EventKind.FEEDING] is not None}
+            last_diaper = {family_id: times[EventKind.DIAPER] for family_id, times in latest.items()
+                           if times[EventKind.DIAPER] is not None}
+
+        member_rows = event_store.fetch_all_rows(
+            lambda: scoped(supabase.table('family_members').select('family_id, user_id')).order('family_id').order('user_id')
+        )
+        members = {}
+        for row in member_rows:
+            members.setdefault(row['family_id'], []).append(row['user_id'])
+
+        # Отправленные уведомления берутся из индекса в памяти; notification_tracking
+        # читается, только пока индекс не загружен или его может менять другой воркер
+        if family_ids is None:
+            notification_index.prune(now, notification_window_minutes)
+        if not _notification_index_authoritative():
+            notifications_since = now - timedelta(minutes=notification_window_minutes)
+            notification_rows = event_store.fetch_all_rows(
+                lambda: scoped(
+                    supabase.table('notification_tracking').select('id, family_id, notification_type, sent_at')
+                    .eq('status', 'sent').gte('sent_at', notifications_since.isoformat())
+                ).order('id')
+            )
+            notification_index.load(
+                ({**row, 'sent_at': timeutils.parse_timestamp(row['sent_at'])} for row in notification_rows),
+                family_ids
+            )
+        notifications = notification_index.snapshot(family_ids)
+
+        # Спящие малыши берутся из индекса сна; полная проверка перечитывает его
+        # одним запросом и подхватывает сессии, записанные в обход бота
+        if family_ids is None or not _sleep_index_authoritative():
+            load_open_sleep_sessions(family_ids)
+        sleeping = sleep_index.snapshot(family_ids)
+
+        return {
+            'now': now,
+            'settings': {row['family_id']: row for row in settings_rows
+                         if family_filter is None or family_filter(row['family_id'])},
+            'last_feeding': last_feeding,
+            'last_diaper': last_diaper,
+            'members': members,
+            'notifications': notifications,
+            'sleeping': sleeping
+        }
+    except Exception as e:
+        print(f"❌ Ошибка загрузки данных для напоминаний: {e}")
+        return None
+
+def has_recent_notification(snapshot: Dict[str, Any], family_id: int, notification_type: str,
+                            minutes_threshold: int = 5) -> bool:
+    """Аналог check_recent_notification, работающий по загруженному снимку"""
+    sent_times = snapshot['notifications'].get((family_id, notification_type))
+    if not sent_times:
+        return False
+    if minutes_threshold is None or minutes_threshold <= 0:
+        return True
+    threshold_time = snapshot['now'] - timedelta(minutes=minutes_threshold)
+    return any(sent_at >= threshold_time for sent_at in sent_times)
+
+def is_sleep_paused(snapshot: Dict[str, Any], family_id: int) -> bool:
+    """Малыш спит, и напоминания о кормлении и подгузнике ждут пробуждения (settings.sleep_monitoring_enabled)"""
+    settings = snapshot['settings'].get(family_id) or {}
+    return family_id in snapshot['sleeping'] and settings.get('sleep_monitoring_enabled') is not False
+
+def remember_notification_sent(snapshot: Dict[str, Any], family_id: int, notification_type: str, sent_at: datetime):
+    """Отметить отправленное уведомление в снимке, чтобы не отправить его повторно в том же проходе"""
+    snapshot['notifications'].setdefault((family_id, notification_type), []).append(sent_at)
+
+# ==================== ЕЖЕДНЕВНЫЕ УВЕДОМЛЕНИЯ ====================
+
+# Вид уведомления -> колонка settings с моментом следующей отправки (ее ведет триггер)
+DIGEST_COLUMNS = {
+    'tips': 'next_tips_at',
+    'bath': 'next_bath_at',
+}
+DIGEST_SETTINGS_COLUMNS = ('family_id, baby_birth_date, baby_age_months, bath_reminder_period, timezone, '
+                           + ', '.join(DIGEST_COLUMNS.values()))
+
+# Сбрасываются, если колонок моментов или функции get_event_counts нет в БД (см. supabase_schema.sql)
+_digests_available = True
+_event_counts_rpc_available = True
+
+def load_due_digests(now: datetime) -> Optional[Dict[str, List[Dict[str, Any]]]]:
+    """Настройки семей, у которых наступил момент совета дня или купания, - по индексам на колонках моментов"""
+    global _digests_available
+    if not _digests_available:
+        return None
+    try:
+        return {
+            kind: event_store.fetch_all_rows(
+                lambda column=column: supabase.table('settings').select(DIGEST_SETTINGS_COLUMNS)
+                .lte(column, now.isoformat()).order('family_id')
+            )
+            for kind, column in DIGEST_COLUMNS.items()
+        }
+    except Exception as e:
+        if _is_missing_column_error(e):
+            print("⚠️ В settings нет колонок next_tips_at/next_bath_at (supabase_schema.sql); ежедневные уведомления выключены")
+            _digests_available = False
+        else:
+            print(f"❌ Ошибка загрузки ежедневных уведомлений: {e}")
+        return None
+
+def get_family_members_bulk(family_ids: List[int]) -> Optional[Dict[int, List[int]]]:
+    """user_id членов семей из списка одним запросом (None при ошибке)"""
+    try:
+        rows = event_store.fetch_all_rows(
+            lambda: supabase.table('family_members').select('family_id, user_id')
+            .in_('family_id', family_ids).order('family_id').order('user_id')
+        )
+    except Exception as e:
+        print(f"❌ Ошибка получения членов семей: {e}")
+        return None
+    members = {}
+    for row in rows:
+        members.setdefault(row['family_id'], []).append(row['user_id'])
+    return members
+
+def get_event_counts_bulk(family_ids: List[int], since: datetime) -> Optional[Dict[int, Dict[str, int]]]:
+    """Количество событий по таблицам для семей из списка с момента since - одним вызовом
+    get_event_counts (None, если сводка недоступна)"""
+    global _event_counts_rpc_available
+    if not _event_counts_rpc_available:
+        return None
+    if not family_ids:
+        return {}
+    params = {'p_family_ids': family_ids, 'p_since': since.isoformat()}
+    try:
+        rows = event_store.fetch_all_rows(
+            lambda: supabase.rpc('get_event_counts', params).order('family_id').order('event_table')
+        )
+    except Exception as e:
+        if _is_missing_function_error(e):
+            print("⚠️ Функция get_event_counts не найдена в базе, сводка за сутки не добавляется к совету дня")
+            _event_counts_rpc_available = False
+        else:
+            print(f"❌ Ошибка получения сводки событий: {e}")
+        return None
+    counts = {}
+    for row in rows:
+        counts.setdefault(row['family_id'], {})[row['event_table']] = row['event_count']
+    return counts
+
+def advance_digests(kind: str, family_ids: List[int]) -> bool:
+    """Сдвинуть моменты уведомлений вида kind на следующий раз после постановки в очередь"""
+    try:
+        supabase.rpc('advance_digests', {'p_kind': kind, 'p_family_ids': family_ids}).execute()
+        return True
+    except Exception as e:
+        print(f"❌ Ошибка сдвига моментов уведомлений ({kind}): {e}")
+        return False
+
 # ==================== ФУНКЦИИ ДЛЯ УПРАВЛЕНИЯ КЭШЕМ ====================
 
 def clear_family_cache(user_id: int = None):
-    """Очистить кэш family_id"""
+    """Очистить кэш членства (family_id, роль, имя)"""
     if user_id:
-        if user_id in family_id_cache:
-            del family_id_cache[user_id]
-            print(f"🧹 Кэш family_id очищен для пользователя {user_id}")
+        invalidate_membership(user_id)
+        print(f"🧹 Кэш family_id очищен для пользователя {user_id}")
     else:
-        family_id_cache.clear()
+        with _membership_lock:
+            membership_cache.clear()
         print("🧹 Весь кэш family_id очищен")
 
 def get_cache_stats():
-    """Получить статистику кэша"""
-    current_time = time.time()
-    active_entries = 0
-    expired_entries = 0
-    
-    for user_id, data in family_id_cache.items():
-        if current_time - data['timestamp'] < CACHE_TTL:
-            active_entries += 1
-        else:
-            expired_entries += 1
-    
+    """Получить статистику кэшей"""
     return {
-        'total_entries': len(family_id_cache),
-        'active_entries': active_entries,
-        'expired_entries': expired_entries
+        'membership': _lru_stats(membership_cache, _membership_lock, _membership_stats),
+        'family_state': _lru_stats(family_state_cache, _family_state_lock, _family_state_stats),
+        'notification_index': notification_index.get_index_stats(),
+        'sleep_index': sleep_index.get_index_stats(),
+        'local_mirror': local_mirror.get_mirror_stats()
     }
 
 # ==================== ИНИЦИАЛИЗАЦИЯ ====================
 
 def init_supabase():
-    """Инициализация Supabase (проверка подключения)"""
+    """Инициализация Supabase (создание клиента и проверка подключения)"""
     print("🔄 Инициализация Supabase...")
+    try:
+        get_client()
+    except Exception as e:
+        print(f"❌ Ошибка создания Supabase клиента: {e}")
+        return False
     if test_connection():
         print("✅ Supabase инициализирован успешно")
         return True
@@ -105,24 +105,76 @@ CREATE TABLE IF NOT EXISTS settings (
     baby_age_months INTEGER DEFAULT 0,
     baby_birth_date TEXT,
     birth_date TEXT,
+    -- Часовой пояс семьи (имя IANA): сегодняшний день в статистике и время ежедневных уведомлений
+    timezone TEXT DEFAULT 'Asia/Bangkok',
+    -- Сроки следующего кормления и смены подгузника (последнее событие + интервал), их ведут триггеры
+    next_feeding_due_at TIMESTAMP WITH TIME ZONE,
+    next_diaper_due_at TIMESTAMP WITH TIME ZONE,
+    -- Ближайшие моменты совета дня и напоминания о купании (по местному времени семьи), их ведет триггер
+    next_tips_at TIMESTAMP WITH TIME ZONE,
+    next_bath_at TIMESTAMP WITH TIME ZONE,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
     updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
 );
 
+-- Колонки для баз, созданных до их появления
+ALTER TABLE settings ADD COLUMN IF NOT EXISTS next_feeding_due_at TIMESTAMP WITH TIME ZONE;
+ALTER TABLE settings ADD COLUMN IF NOT EXISTS next_diaper_due_at TIMESTAMP WITH TIME ZONE;
+ALTER TABLE settings ADD COLUMN IF NOT EXISTS timezone TEXT DEFAULT 'Asia/Bangkok';
+ALTER TABLE settings ADD COLUMN IF NOT EXISTS next_tips_at TIMESTAMP WITH TIME ZONE;
+ALTER TABLE settings ADD COLUMN IF NOT EXISTS next_bath_at TIMESTAMP WITH TIME ZONE;
+
+-- Отправленные напоминания (для пауз между повторами и подтверждений)
+CREATE TABLE IF NOT EXISTS notification_tracking (
+    id BIGSERIAL PRIMARY KEY,
+    family_id INTEGER REFERENCES families(id) ON DELETE CASCADE,
+    notification_type TEXT NOT NULL,
+    event_time TIMESTAMP WITH TIME ZONE,
+    sent_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    status TEXT DEFAULT 'sent'
+);
+
+-- Аренды воркеров: владение шардами семей и лидерство для общих задач (очистка)
+CREATE TABLE IF NOT EXISTS worker_leases (
+    name TEXT PRIMARY KEY,
+    holder TEXT NOT NULL,
+    expires_at TIMESTAMP WITH TIME ZONE NOT NULL
+);
+
 -- Создание индексов для оптимизации запросов
 CREATE INDEX IF NOT EXISTS idx_family_members_user_id ON family_members(user_id);
-CREATE INDEX IF NOT EXISTS idx_feedings_family_id ON feedings(family_id);
-CREATE INDEX IF NOT EXISTS idx_feedings_timestamp ON feedings(timestamp);
-CREATE INDEX IF NOT EXISTS idx_diapers_family_id ON diapers(family_id);
-CREATE INDEX IF NOT EXISTS idx_diapers_timestamp ON diapers(timestamp);
-CREATE INDEX IF NOT EXISTS idx_baths_family_id ON baths(family_id);
-CREATE INDEX IF NOT EXISTS idx_baths_timestamp ON baths(timestamp);
-CREATE INDEX IF NOT EXISTS idx_activities_family_id ON activities(family_id);
-CREATE INDEX IF NOT EXISTS idx_activities_timestamp ON activities(timestamp);
+-- События семьи по времени: последнее событие и события за период читаются из одного
+-- составного индекса (для последнего события - index-only scan без сортировки)
+CREATE INDEX IF NOT EXISTS idx_feedings_family_timestamp ON feedings(family_id, timestamp DESC);
+CREATE INDEX IF NOT EXISTS idx_diapers_family_timestamp ON diapers(family_id, timestamp DESC);
+CREATE INDEX IF NOT EXISTS idx_baths_family_timestamp ON baths(family_id, timestamp DESC);
+CREATE INDEX IF NOT EXISTS idx_activities_family_timestamp ON activities(family_id, timestamp DESC);
+-- Отдельные индексы по family_id и timestamp заменены составными
+DROP INDEX IF EXISTS idx_feedings_family_id;
+DROP INDEX IF EXISTS idx_feedings_timestamp;
+DROP INDEX IF EXISTS idx_diapers_family_id;
+DROP INDEX IF EXISTS idx_diapers_timestamp;
+DROP INDEX IF EXISTS idx_baths_family_id;
+DROP INDEX IF EXISTS idx_baths_timestamp;
+DROP INDEX IF EXISTS idx_activities_family_id;
+DROP INDEX IF EXISTS idx_activities_timestamp;
 CREATE INDEX IF NOT EXISTS idx_sleep_sessions_family_id ON sleep_sessions(family_id);
 CREATE INDEX IF NOT EXISTS idx_sleep_sessions_start_time ON sleep_sessions(start_time);
+-- Открытые сессии сна (малыш спит): индекс сна бота загружается по нему одним запросом,
+-- и у семьи не может быть двух открытых сессий одновременно
+CREATE UNIQUE INDEX IF NOT EXISTS idx_sleep_sessions_open ON sleep_sessions(family_id) WHERE end_time IS NULL;
+-- Недавние пробуждения: по ним воркеры-владельцы шардов сразу проверяют отложенные напоминания
+CREATE INDEX IF NOT EXISTS idx_sleep_sessions_end_time ON sleep_sessions(end_time);
 CREATE INDEX IF NOT EXISTS idx_tips_age_months ON tips(age_months);
 CREATE INDEX IF NOT EXISTS idx_tips_category ON tips(category);
+-- Проверка напоминаний выбирает семьи, срок которых наступает в ближайшее время
+CREATE INDEX IF NOT EXISTS idx_settings_next_feeding_due_at ON settings(next_feeding_due_at);
+CREATE INDEX IF NOT EXISTS idx_settings_next_diaper_due_at ON settings(next_diaper_due_at);
+CREATE INDEX IF NOT EXISTS idx_settings_next_tips_at ON settings(next_tips_at);
+CREATE INDEX IF NOT EXISTS idx_settings_next_bath_at ON settings(next_bath_at);
+-- Проверка недавних уведомлений семьи и подтверждение группы уведомлений
+CREATE INDEX IF NOT EXISTS idx_notification_tracking_lookup ON notification_tracking(family_id, notification_type, status, sent_at DESC);
+CREATE INDEX IF NOT EXISTS idx_notification_tracking_sent_at ON notification_tracking(sent_at);
 
 -- Функция для автоматического обновления updated_at
 CREATE OR REPLACE FUNCTION update_updated_at_column()
@@ -134,11 +186,308 @@ END;
 $$ language 'plpgsql';
 
 -- Триггер для автоматического обновления updated_at в таблице settings
+DROP TRIGGER IF EXISTS update_settings_updated_at ON settings;
 CREATE TRIGGER update_settings_updated_at 
     BEFORE UPDATE ON settings 
     FOR EACH ROW 
     EXECUTE FUNCTION update_updated_at_column();
 
+-- Пересчет срока в settings после записи, изменения или удаления кормления/смены подгузника
+CREATE OR REPLACE FUNCTION refresh_next_due_at()
+RETURNS TRIGGER AS $$
+DECLARE
+    target_family INTEGER := CASE WHEN TG_OP = 'DELETE' THEN OLD.family_id ELSE NEW.family_id END;
+BEGIN
+    IF TG_TABLE_NAME = 'feedings' THEN
+        UPDATE settings
+        SET next_feeding_due_at = (SELECT MAX(timestamp) FROM feedings WHERE family_id = target_family)
+                                  + make_interval(hours => feed_interval)
+        WHERE family_id = target_family;
+    ELSE
+        UPDATE settings
+        SET next_diaper_due_at = (SELECT MAX(timestamp) FROM diapers WHERE family_id = target_family)
+                                 + make_interval(hours => diaper_interval)
+        WHERE family_id = target_family;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS feedings_next_due_at ON feedings;
+CREATE TRIGGER feedings_next_due_at
+    AFTER INSERT OR UPDATE OF timestamp, family_id OR DELETE ON feedings
+    FOR EACH ROW
+    EXECUTE FUNCTION refresh_next_due_at();
+
+DROP TRIGGER IF EXISTS diapers_next_due_at ON diapers;
+CREATE TRIGGER diapers_next_due_at
+    AFTER INSERT OR UPDATE OF timestamp, family_id OR DELETE ON diapers
+    FOR EACH ROW
+    EXECUTE FUNCTION refresh_next_due_at();
+
+-- Пересчет сроков при создании настроек семьи и смене интервалов
+CREATE OR REPLACE FUNCTION set_settings_next_due_at()
+RETURNS TRIGGER AS $$
+BEGIN
+    NEW.next_feeding_due_at = (SELECT MAX(timestamp) FROM feedings WHERE family_id = NEW.family_id)
+                              + make_interval(hours => NEW.feed_interval);
+    NEW.next_diaper_due_at = (SELECT MAX(timestamp) FROM diapers WHERE family_id = NEW.family_id)
+                             + make_interval(hours => NEW.diaper_interval);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS settings_next_due_at ON settings;
+CREATE TRIGGER settings_next_due_at
+    BEFORE INSERT OR UPDATE OF feed_interval, diaper_interval ON settings
+    FOR EACH ROW
+    EXECUTE FUNCTION set_settings_next_due_at();
+
+-- Заполнение сроков для уже существующих семей
+UPDATE settings SET feed_interval = feed_interval WHERE next_feeding_due_at IS NULL AND next_diaper_due_at IS NULL;
+
+-- Часовой пояс семьи или пояс по умолчанию, если имя пустое или неизвестно PostgreSQL
+-- (как timeutils.get_zone): ошибка в settings.timezone не должна ломать запись настроек
+CREATE OR REPLACE FUNCTION safe_timezone(p_timezone TEXT)
+RETURNS TEXT AS $$
+BEGIN
+    IF p_timezone IS NULL OR p_timezone = '' THEN
+        RETURN 'Asia/Bangkok';
+    END IF;
+    PERFORM NOW() AT TIME ZONE p_timezone;
+    RETURN p_timezone;
+EXCEPTION WHEN invalid_parameter_value THEN
+    RETURN 'Asia/Bangkok';
+END;
+$$ LANGUAGE plpgsql STABLE;
+
+-- Первый момент после p_after, когда в часовом поясе p_timezone наступает p_hour:p_minute
+CREATE OR REPLACE FUNCTION next_local_time(
+    p_hour INTEGER,
+    p_minute INTEGER,
+    p_timezone TEXT,
+    p_after TIMESTAMP WITH TIME ZONE
+)
+RETURNS TIMESTAMP WITH TIME ZONE AS $$
+    SELECT CASE
+        WHEN (local_day + make_time(p_hour, p_minute, 0)) AT TIME ZONE zone > p_after
+            THEN (local_day + make_time(p_hour, p_minute, 0)) AT TIME ZONE zone
+        ELSE (local_day + 1 + make_time(p_hour, p_minute, 0)) AT TIME ZONE zone
+    END
+    FROM (SELECT safe_timezone(p_timezone) AS zone) family_zone,
+         LATERAL (SELECT (p_after AT TIME ZONE zone)::date AS local_day) today;
+$$ LANGUAGE sql STABLE;
+
+-- Моменты совета дня и купания пересчитываются при создании настроек и смене времени,
+-- включения или часового пояса; выключенное уведомление момента не имеет
+CREATE OR REPLACE FUNCTION set_settings_digest_at()
+RETURNS TRIGGER AS $$
+DECLARE
+    zone TEXT := safe_timezone(NEW.timezone);
+BEGIN
+    IF TG_OP = 'INSERT' OR NEW.tips_enabled IS DISTINCT FROM OLD.tips_enabled
+       OR NEW.tips_time_hour IS DISTINCT FROM OLD.tips_time_hour OR NEW.tips_time_minute IS DISTINCT FROM OLD.tips_time_minute
+       OR NEW.timezone IS DISTINCT FROM OLD.timezone OR NEW.next_tips_at IS NULL THEN
+        NEW.next_tips_at = CASE WHEN COALESCE(NEW.tips_enabled, TRUE) THEN
+            next_local_time(COALESCE(NEW.tips_time_hour, 9), COALESCE(NEW.tips_time_minute, 0), zone, NOW()) END;
+    END IF;
+    IF TG_OP = 'INSERT' OR NEW.bath_reminder_enabled IS DISTINCT FROM OLD.bath_reminder_enabled
+       OR NEW.bath_reminder_hour IS DISTINCT FROM OLD.bath_reminder_hour OR NEW.bath_reminder_minute IS DISTINCT FROM OLD.bath_reminder_minute
+       OR NEW.timezone IS DISTINCT FROM OLD.timezone OR NEW.next_bath_at IS NULL THEN
+        NEW.next_bath_at = CASE WHEN COALESCE(NEW.bath_reminder_enabled, TRUE) THEN
+            next_local_time(COALESCE(NEW.bath_reminder_hour, 19), COALESCE(NEW.bath_reminder_minute, 0), zone, NOW()) END;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS settings_digest_at ON settings;
+CREATE TRIGGER settings_digest_at
+    BEFORE INSERT OR UPDATE OF tips_enabled, tips_time_hour, tips_time_minute, bath_reminder_enabled,
+        bath_reminder_hour, bath_reminder_minute, timezone, next_tips_at, next_bath_at ON settings
+    FOR EACH ROW
+    EXECUTE FUNCTION set_settings_digest_at();
+
+-- Заполнение моментов для уже существующих семей
+UPDATE settings SET next_tips_at = NULL WHERE next_tips_at IS NULL AND next_bath_at IS NULL;
+
+-- Сдвиг моментов после постановки уведомлений в очередь: совет - на следующий день,
+-- купание - через bath_reminder_period дней (после простоя бота - на ближайший момент)
+CREATE OR REPLACE FUNCTION advance_digests(p_kind TEXT, p_family_ids INTEGER[])
+RETURNS VOID AS $$
+BEGIN
+    IF p_kind = 'tips' THEN
+        UPDATE settings
+        SET next_tips_at = next_local_time(COALESCE(tips_time_hour, 9), COALESCE(tips_time_minute, 0),
+                                           timezone, NOW())
+        WHERE family_id = ANY(p_family_ids) AND next_tips_at <= NOW();
+    ELSIF p_kind = 'bath' THEN
+        UPDATE settings
+        SET next_bath_at = next_local_time(COALESCE(bath_reminder_hour, 19), COALESCE(bath_reminder_minute, 0),
+                                           timezone,
+                                           GREATEST(NOW(), next_bath_at + make_interval(days => GREATEST(COALESCE(bath_reminder_period, 1), 1) - 1)))
+        WHERE family_id = ANY(p_family_ids) AND next_bath_at <= NOW();
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Количество событий по таблицам для списка семей с момента p_since (сводка дня),
+-- по индексам (family_id, timestamp DESC)
+CREATE OR REPLACE FUNCTION get_event_counts(
+    p_family_ids INTEGER[],
+    p_since TIMESTAMP WITH TIME ZONE
+)
+RETURNS TABLE (family_id INTEGER, event_table TEXT, event_count BIGINT) AS $$
+    SELECT feedings.family_id, 'feedings', COUNT(*) FROM feedings
+    WHERE feedings.family_id = ANY(p_family_ids) AND feedings.timestamp >= p_since GROUP BY feedings.family_id
+    UNION ALL
+    SELECT diapers.family_id, 'diapers', COUNT(*) FROM diapers
+    WHERE diapers.family_id = ANY(p_family_ids) AND diapers.timestamp >= p_since GROUP BY diapers.family_id
+    UNION ALL
+    SELECT baths.family_id, 'baths', COUNT(*) FROM baths
+    WHERE baths.family_id = ANY(p_family_ids) AND baths.timestamp >= p_since GROUP BY baths.family_id
+    UNION ALL
+    SELECT activities.family_id, 'activities', COUNT(*) FROM activities
+    WHERE activities.family_id = ANY(p_family_ids) AND activities.timestamp >= p_since GROUP BY activities.family_id;
+$$ LANGUAGE sql STABLE;
+
+-- Сводная статистика семьи по всем таблицам событий за один запрос:
+-- количество за период, время последнего события, средний интервал (в минутах)
+-- и количество по дням в часовом поясе семьи
+-- (прежний вариант без p_timezone удаляется, чтобы вызов не был неоднозначным)
+DROP FUNCTION IF EXISTS get_family_stats(INTEGER, TIMESTAMP WITH TIME ZONE);
+CREATE OR REPLACE FUNCTION get_family_stats(
+    p_family_id INTEGER,
+    p_since TIMESTAMP WITH TIME ZONE,
+    p_timezone TEXT DEFAULT 'Asia/Bangkok'
+)
+RETURNS JSONB AS $$
+    WITH events AS (
+        SELECT 'feeding' AS event_type, timestamp FROM feedings WHERE family_id = p_family_id AND timestamp >= p_since
+        UNION ALL
+        SELECT 'diaper', timestamp FROM diapers WHERE family_id = p_family_id AND timestamp >= p_since
+        UNION ALL
+        SELECT 'bath', timestamp FROM baths WHERE family_id = p_family_id AND timestamp >= p_since
+        UNION ALL
+        SELECT 'activity', timestamp FROM activities WHERE family_id = p_family_id AND timestamp >= p_since
+    ),
+    latest AS (
+        SELECT 'feeding' AS event_type, (SELECT MAX(timestamp) FROM feedings WHERE family_id = p_family_id) AS last_time
+        UNION ALL
+        SELECT 'diaper', (SELECT MAX(timestamp) FROM diapers WHERE family_id = p_family_id)
+        UNION ALL
+        SELECT 'bath', (SELECT MAX(timestamp) FROM baths WHERE family_id = p_family_id)
+        UNION ALL
+        SELECT 'activity', (SELECT MAX(timestamp) FROM activities WHERE family_id = p_family_id)
+    ),
+    totals AS (
+        SELECT event_type,
+               COUNT(*) AS event_count,
+               EXTRACT(EPOCH FROM MAX(timestamp) - MIN(timestamp)) / 60 / NULLIF(COUNT(*) - 1, 0) AS mean_interval_minutes
+        FROM events
+        GROUP BY event_type
+    ),
+    per_day AS (
+        SELECT event_type, jsonb_object_agg(day, day_count) AS days
+        FROM (
+            SELECT event_type, to_char(timestamp AT TIME ZONE zone, 'YYYY-MM-DD') AS day, COUNT(*) AS day_count
+            FROM events, (SELECT safe_timezone(p_timezone) AS zone) family_zone
+            GROUP BY 1, 2
+        ) daily
+        GROUP BY event_type
+    )
+    SELECT jsonb_object_agg(latest.event_type, jsonb_build_object(
+        'count', COALESCE(totals.event_count, 0),
+        'last_time', latest.last_time,
+        'mean_interval_minutes', totals.mean_interval_minutes,
+        'per_day', COALESCE(per_day.days, '{}'::jsonb)
+    ))
+    FROM latest
+    LEFT JOIN totals USING (event_type)
+    LEFT JOIN per_day USING (event_type);
+$$ LANGUAGE sql STABLE;
+
+-- Время последнего события по таблицам для семей p_family_ids (NULL - для всех семей) за один запрос.
+-- Для каждой семьи и таблицы читается одна запись индекса (family_id, timestamp DESC);
+-- семьи без событий (или без событий после p_since) в результат не попадают
+CREATE OR REPLACE FUNCTION get_latest_events(
+    p_family_ids INTEGER[] DEFAULT NULL,
+    p_tables TEXT[] DEFAULT ARRAY['feedings', 'diapers', 'baths', 'activities'],
+    p_since TIMESTAMP WITH TIME ZONE DEFAULT NULL
+)
+RETURNS TABLE (family_id INTEGER, event_table TEXT, last_time TIMESTAMP WITH TIME ZONE) AS $$
+    WITH family_list AS (
+        SELECT families.id FROM families
+        WHERE p_family_ids IS NULL OR families.id = ANY(p_family_ids)
+    )
+    SELECT family_list.id, 'feedings', latest.timestamp
+    FROM family_list
+    CROSS JOIN LATERAL (
+        SELECT feedings.timestamp FROM feedings
+        WHERE feedings.family_id = family_list.id AND (p_since IS NULL OR feedings.timestamp >= p_since)
+        ORDER BY feedings.timestamp DESC
+        LIMIT 1
+    ) latest
+    WHERE 'feedings' = ANY(p_tables)
+    UNION ALL
+    SELECT family_list.id, 'diapers', latest.timestamp
+    FROM family_list
+    CROSS JOIN LATERAL (
+        SELECT diapers.timestamp FROM diapers
+        WHERE diapers.family_id = family_list.id AND (p_since IS NULL OR diapers.timestamp >= p_since)
+        ORDER BY diapers.timestamp DESC
+        LIMIT 1
+    ) latest
+    WHERE 'diapers' = ANY(p_tables)
+    UNION ALL
+    SELECT family_list.id, 'baths', latest.timestamp
+    FROM family_list
+    CROSS JOIN LATERAL (
+        SELECT baths.timestamp FROM baths
+        WHERE baths.family_id = family_list.id AND (p_since IS NULL OR baths.timestamp >= p_since)
+        ORDER BY baths.timestamp DESC
+        LIMIT 1
+    ) latest
+    WHERE 'baths' = ANY(p_tables)
+    UNION ALL
+    SELECT family_list.id, 'activities', latest.timestamp
+    FROM family_list
+    CROSS JOIN LATERAL (
+        SELECT activities.timestamp FROM activities
+        WHERE activities.family_id = family_list.id AND (p_since IS NULL OR activities.timestamp >= p_since)
+        ORDER BY activities.timestamp DESC
+        LIMIT 1
+    ) latest
+    WHERE 'activities' = ANY(p_tables);
+$$ LANGUAGE sql STABLE;
+
+-- Захват или продление аренды: удается, если аренда свободна, истекла, уже принадлежит
+-- p_holder или p_preempt (воркер забирает свой шард у временного владельца)
+CREATE OR REPLACE FUNCTION acquire_lease(
+    p_name TEXT,
+    p_holder TEXT,
+    p_ttl_seconds INTEGER,
+    p_preempt BOOLEAN DEFAULT FALSE
+)
+RETURNS BOOLEAN AS $$
+DECLARE
+    acquired BOOLEAN;
+BEGIN
+    INSERT INTO worker_leases AS lease (name, holder, expires_at)
+    VALUES (p_name, p_holder, NOW() + make_interval(secs => p_ttl_seconds))
+    ON CONFLICT (name) DO UPDATE
+        SET holder = EXCLUDED.holder, expires_at = EXCLUDED.expires_at
+        WHERE lease.holder = p_holder OR lease.expires_at < NOW() OR p_preempt
+    RETURNING TRUE INTO acquired;
+    RETURN COALESCE(acquired, FALSE);
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION release_lease(p_name TEXT, p_holder TEXT)
+RETURNS VOID AS $$
+    DELETE FROM worker_leases WHERE name = p_name AND holder = p_holder;
+$$ LANGUAGE sql;
+
 -- Включение Row Level Security (RLS) для безопасности
 ALTER TABLE families ENABLE ROW LEVEL SECURITY;
 ALTER TABLE family_members ENABLE ROW LEVEL SECURITY;
@@ -149,15 +498,31 @@ ALTER TABLE activities ENABLE ROW LEVEL SECURITY;
 ALTER TABLE sleep_sessions ENABLE ROW LEVEL SECURITY;
 ALTER TABLE settings ENABLE ROW LEVEL SECURITY;
 ALTER TABLE tips ENABLE ROW LEVEL SECURITY;
+ALTER TABLE notification_tracking ENABLE ROW LEVEL SECURITY;
+ALTER TABLE worker_leases ENABLE ROW LEVEL SECURITY;
 
 -- Политики безопасности (разрешаем все операции для аутентифицированных пользователей)
--- В реальном проекте здесь должны быть более строгие политики
+-- В реальном проекте здесь должны быть более строгие политики.
+-- Политики пересоздаются, чтобы схему можно было выполнить повторно на существующей базе
+DROP POLICY IF EXISTS "Enable all operations for authenticated users" ON families;
 CREATE POLICY "Enable all operations for authenticated users" ON families FOR ALL USING (true);
+DROP POLICY IF EXISTS "Enable all operations for authenticated users" ON family_members;
 CREATE POLICY "Enable all operations for authenticated users" ON family_members FOR ALL USING (true);
+DROP POLICY IF EXISTS "Enable all operations for authenticated users" ON feedings;
 CREATE POLICY "Enable all operations for authenticated users" ON feedings FOR ALL USING (true);
+DROP POLICY IF EXISTS "Enable all operations for authenticated users" ON diapers;
 CREATE POLICY "Enable all operations for authenticated users" ON diapers FOR ALL USING (true);
+DROP POLICY IF EXISTS "Enable all operations for authenticated users" ON baths;
 CREATE POLICY "Enable all operations for authenticated users" ON baths FOR ALL USING (true);
+DROP POLICY IF EXISTS "Enable all operations for authenticated users" ON activities;
 CREATE POLICY "Enable all operations for authenticated users" ON activities FOR ALL USING (true);
+DROP POLICY IF EXISTS "Enable all operations for authenticated users" ON sleep_sessions;
 CREATE POLICY "Enable all operations for authenticated users" ON sleep_sessions FOR ALL USING (true);
+DROP POLICY IF EXISTS "Enable all operations for authenticated users" ON settings;
 CREATE POLICY "Enable all operations for authenticated users" ON settings FOR ALL USING (true);
+DROP POLICY IF EXISTS "Enable all operations for authenticated users" ON tips;
 CREATE POLICY "Enable all operations for authenticated users" ON tips FOR ALL USING (true);
+DROP POLICY IF EXISTS "Enable all operations for authenticated users" ON notification_tracking;
+CREATE POLICY "Enable all operations for authenticated users" ON notification_tracking FOR ALL USING (true);
+DROP POLICY IF EXISTS "Enable all operations for authenticated users" ON worker_leases;
+CREATE POLICY "Enable all operations for authenticated users" ON worker_leases FOR ALL USING (true);
@@ -0,0 +1,169 @@
+"""
+HTTP-транспорт клиента Supabase
+Все запросы к PostgREST идут через один пул соединений httpx с HTTP/2 и
+keep-alive, поэтому проход по напоминаниям и обработчики не открывают новое
+TLS-соединение на каждый запрос. Таймауты подключения и чтения заданы явно,
+а предохранитель (circuit breaker) после серии сетевых ошибок на время
+отклоняет запросы сразу, не дожидаясь таймаутов и повторных попыток
+"""
+
+import os
+import threading
+import time
+from typing import Any, Dict
+
+import httpx
+from postgrest.utils import SyncClient
+
+SUPABASE_CONNECT_TIMEOUT = float(os.getenv('SUPABASE_CONNECT_TIMEOUT', '5'))
+SUPABASE_READ_TIMEOUT = float(os.getenv('SUPABASE_READ_TIMEOUT', '15'))
+SUPABASE_POOL_SIZE = int(os.getenv('SUPABASE_POOL_SIZE', '20'))
+# Простаивающее соединение держится дольше периода keep_alive_ping
+SUPABASE_KEEPALIVE_SECONDS = 330
+SUPABASE_HTTP2 = os.getenv('SUPABASE_HTTP2', '1') != '0'
+
+# Предохранитель: после BREAKER_FAILURE_THRESHOLD сетевых ошибок подряд запросы
+# отклоняются BREAKER_RESET_SECONDS секунд, затем один пробный запрос решает, закрыть ли его
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_SECONDS = 30
+# Ответы, которые означают недоступность Supabase, а не ошибку запроса
+UNAVAILABLE_STATUS_CODES = (502, 503, 504)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(httpx.ConnectError):
+    """Supabase недоступен, запрос отклонен предохранителем без обращения к сети"""
+
+
+class CircuitBreaker:
+    """Счетчик сетевых ошибок подряд с состояниями closed -> open -> half_open"""
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_seconds: float = BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.rejected = 0
+        self.trips = 0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Можно ли отправить запрос; в half_open пропускается один пробный"""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                print("✅ Связь с Supabase восстановлена, предохранитель закрыт")
+            self.state = CLOSED
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                if self.state == CLOSED:
+                    print(f"🔌 Supabase недоступен ({self.failures} ошибок подряд), запросы отклоняются "
+                          f"{self.reset_seconds} с")
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+                self._probe_in_flight = False
+                self.trips += 1
+
+    def is_open(self) -> bool:
+        with self._lock:
+            return self.state == OPEN and time.monotonic() - self.opened_at < self.reset_seconds
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'state': self.state, 'failures': self.failures, 'rejected': self.rejected, 'trips': self.trips}
+
+
+breaker = CircuitBreaker()
+
+
+class BreakerTransport(httpx.BaseTransport):
+    """Транспорт httpx, который учитывает ошибки в предохранителе и не ходит в сеть, пока он открыт"""
+
+    def __init__(self, transport: httpx.BaseTransport, circuit: CircuitBreaker):
+        self._transport = transport
+        self._circuit = circuit
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        if not self._circuit.allow():
+            raise CircuitOpenError("Supabase недоступен (предохранитель открыт)", request=request)
+        try:
+            response = self._transport.handle_request(request)
+        except Exception:
+            self._circuit.record_failure()
+            raise
+        if response.status_code in UNAVAILABLE_STATUS_CODES:
+            self._circuit.record_failure()
+        else:
+            self._circuit.record_success()
+        return response
+
+    def close(self):
+        self._transport.close()
+
+
+def build_session(base_url, headers) -> SyncClient:
+    """Сессия PostgREST с общим пулом соединений, таймаутами и предохранителем"""
+    transport = httpx.HTTPTransport(
+        http2=SUPABASE_HTTP2,
+        limits=httpx.Limits(
+            max_connections=SUPABASE_POOL_SIZE,
+            max_keepalive_connections=SUPABASE_POOL_SIZE,
+            keepalive_expiry=SUPABASE_KEEPALIVE_SECONDS,
+        ),
+        # Повтор только неудавшегося подключения: запрос еще не отправлен, повтор безопасен
+        retries=1,
+    )
+    return SyncClient(
+        base_url=base_url,
+        headers=headers,
+        timeout=httpx.Timeout(SUPABASE_READ_TIMEOUT, connect=SUPABASE_CONNECT_TIMEOUT),
+        transport=BreakerTransport(transport, breaker),
+        follow_redirects=True,
+    )
+
+
+def configure(client):
+    """Заменить сессию PostgREST клиента supabase сессией с настроенным транспортом"""
+    postgrest = client.postgrest
+    previous = postgrest.session
+    postgrest.session = build_session(previous.base_url, previous.headers)
+    previous.close()
+    return client
+
+
+def is_unavailable(error: Exception) -> bool:
+    """Запрос отклонен предохранителем: повторять его сейчас бессмысленно"""
+    return isinstance(error, CircuitOpenError) or breaker.is_open()
+
+
+def get_transport_stats() -> Dict[str, Any]:
+    return {
+        'http2': SUPABASE_HTTP2,
+        'pool_size': SUPABASE_POOL_SIZE,
+        'connect_timeout': SUPABASE_CONNECT_TIMEOUT,
+        'read_timeout': SUPABASE_READ_TIMEOUT,
+        'breaker': breaker.stats(),
+    }
@@ -0,0 +1,96 @@
+"""
+Время и часовые пояса
+Внутри бот работает с моментами в UTC: сравнения, интервалы и запросы к БД от
+часового пояса не зависят. К местному времени семьи (колонка settings.timezone,
+по умолчанию DEFAULT_TIMEZONE) время приводится только там, где важен календарь:
+сегодняшний день в статистике и ежедневные уведомления. Объекты часовых поясов
+создаются один раз, а одинаковые строки времени из БД разбираются один раз
+"""
+
+import os
+import re
+from datetime import date, datetime, timezone, tzinfo
+from functools import lru_cache
+from typing import Optional, Union
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+DEFAULT_TIMEZONE = os.getenv('DEFAULT_TIMEZONE', 'Asia/Bangkok')
+UTC = timezone.utc
+# Строки времени повторяются между проходами напоминаний (последние события, сроки)
+TIMESTAMP_CACHE_SIZE = 65536
+
+# Дробная часть секунд не из 6 цифр и смещение без минут ('+00'), которые
+# datetime.fromisoformat до Python 3.11 не разбирает
+_FRACTION_RE = re.compile(r'\.(\d+)')
+_SHORT_OFFSET_RE = re.compile(r'([+-]\d{2})$')
+
+
+@lru_cache(maxsize=256)
+def _load_zone(name: str) -> Optional[tzinfo]:
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return None
+
+
+def is_valid_timezone(name: Optional[str]) -> bool:
+    """Известен ли часовой пояс IANA (например, Europe/Moscow)"""
+    return bool(name) and _load_zone(name) is not None
+
+
+def get_zone(name: Optional[str] = None) -> tzinfo:
+    """Часовой пояс по имени; пустое или неизвестное имя - DEFAULT_TIMEZONE"""
+    zone = _load_zone(name) if name else None
+    return zone or _load_zone(DEFAULT_TIMEZONE) or UTC
+
+
+def utc_now() -> datetime:
+    """Текущий момент в UTC"""
+    return datetime.now(UTC)
+
+
+def local_now(tz_name: Optional[str] = None) -> datetime:
+    """Текущее местное время семьи"""
+    return datetime.now(get_zone(tz_name))
+
+
+def local_date(tz_name: Optional[str] = None) -> date:
+    """Сегодняшняя дата в часовом поясе семьи"""
+    return local_now(tz_name).date()
+
+
+def local_day_start(tz_name: Optional[str] = None) -> datetime:
+    """Начало сегодняшнего дня в часовом поясе семьи"""
+    return local_now(tz_name).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+@lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
+def _parse_string(value: str) -> datetime:
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        normalized = value.replace('Z', '+00:00')
+        normalized = _FRACTION_RE.sub(lambda match: '.' + match.group(1)[:6].ljust(6, '0'), normalized)
+        parsed = datetime.fromisoformat(_SHORT_OFFSET_RE.sub(r'\1:00', normalized))
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=UTC)
+    if parsed.utcoffset():
+        return parsed.astimezone(UTC)
+    return parsed
+
+
+def parse_timestamp(value: Union[str, datetime, None]) -> Optional[datetime]:
+    """Привести время из БД (строка ISO или datetime) к моменту в UTC; время без пояса считается UTC"""
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            return value.replace(tzinfo=UTC)
+        return value.astimezone(UTC)
+    return _parse_string(value)
+
+
+def to_local(value: Union[str, datetime, None], tz_name: Optional[str] = None) -> Optional[datetime]:
+    """Время из БД в часовом поясе семьи (для показа и календарных расчетов)"""
+    moment = parse_timestamp(value)
+    return moment.astimezone(get_zone(tz_name)) if moment else None
@@ -0,0 +1,126 @@
+"""
+Каталог советов в памяти
+Таблица tips - небольшой статичный справочник, поэтому она загружается целиком
+и индексируется по (возраст, категория). Для каждого возраста заранее вычислен
+ближайший возраст, для которого есть советы, так что выбор совета не обращается к БД
+"""
+
+import random
+import threading
+import time
+from typing import Dict, List, Optional
+
+TIPS_REFRESH_HOURS = 6
+MAX_TIP_AGE_MONTHS = 12
+
+# Индекс заменяется целиком при обновлении, поэтому читатели не берут блокировку.
+# Ключ категории None - советы всех категорий
+_catalog: Optional[Dict[str, object]] = None
+_load_lock = threading.Lock()
+
+
+def _client():
+    import supabase_client
+    return supabase_client.supabase
+
+
+def _nearest_ages(ages: List[int], max_age: int) -> Dict[int, int]:
+    """Для каждого возраста 0..max_age - возраст, чьи советы подходят лучше всего:
+    сам возраст, затем ближайший меньший, затем ближайший больший"""
+    nearest = {}
+    available = sorted(set(ages))
+    for age in range(max_age + 1):
+        younger = [a for a in available if a <= age]
+        if younger:
+            nearest[age] = younger[-1]
+        elif available:
+            nearest[age] = available[0]
+    return nearest
+
+
+def _build_catalog(rows: List[Dict[str, object]]) -> Dict[str, object]:
+    tips: Dict[Optional[str], Dict[int, List[str]]] = {None: {}}
+    for row in rows:
+        age, content = row['age_months'], row['content']
+        category = row.get('category')
+        tips[None].setdefault(age, []).append(content)
+        # Совет без категории (NULL) не подходит ни под одну категорию, как при фильтре eq('category', ...)
+        if category is not None:
+            tips.setdefault(category, {}).setdefault(age, []).append(content)
+
+    max_age = max([MAX_TIP_AGE_MONTHS] + list(tips[None]))
+    return {
+        'tips': tips,
+        'nearest': {category: _nearest_ages(list(by_age), max_age) for category, by_age in tips.items()},
+        'max_age': max_age,
+        'categories': sorted(category for category in tips if category is not None),
+        'loaded_at': time.time(),
+        'size': len(rows),
+    }
+
+
+def refresh() -> bool:
+    """Перечитать каталог советов из БД (по таймеру или по запросу)"""
+    global _catalog
+    import event_store
+    try:
+        client = _client()
+        rows = event_store.fetch_all_rows(
+            lambda: client.table('tips').select('id, age_months, content, category').order('id')
+        )
+    except Exception as e:
+        print(f"❌ Ошибка загрузки каталога советов: {e}")
+        import local_mirror
+        rows = local_mirror.get_tips()
+        if rows is None or _catalog is not None:
+            return False
+        # Без Supabase каталог собирается из локальной копии
+        print("🗄️ Советы берутся из локальной копии")
+    _catalog = _build_catalog(rows)
+    print(f"💡 Каталог советов загружен: {len(rows)} советов")
+    return True
+
+
+def _get_catalog() -> Optional[Dict[str, object]]:
+    """Каталог, загружаемый при первом обращении, если обновление еще не выполнялось"""
+    if _catalog is None:
+        with _load_lock:
+            if _catalog is None:
+                refresh()
+    return _catalog
+
+
+def get_tips(age_months: int, category: Optional[str] = None, nearest: bool = True) -> List[str]:
+    """Советы для возраста (и категории); при nearest берется ближайший возраст с советами"""
+    catalog = _get_catalog()
+    if not catalog:
+        return []
+    by_age = catalog['tips'].get(category)
+    if not by_age:
+        return []
+    if not nearest:
+        return list(by_age.get(age_months, []))
+    age = min(max(age_months, 0), catalog['max_age'])
+    resolved = catalog['nearest'][category].get(age)
+    return list(by_age.get(resolved, [])) if resolved is not None else []
+
+
+def random_tip(age_months: int, category: Optional[str] = None) -> Optional[str]:
+    """Случайный совет для возраста с учетом ближайших возрастов"""
+    tips = get_tips(age_months, category)
+    return random.choice(tips) if tips else None
+
+
+def get_categories() -> List[str]:
+    """Все категории советов"""
+    catalog = _get_catalog()
+    return list(catalog['categories']) if catalog else []
+
+
+def get_catalog_stats() -> Dict[str, object]:
+    """Размер и время загрузки каталога"""
+    catalog = _catalog
+    if not catalog:
+        return {'loaded': False}
+    return {'loaded': True, 'size': catalog['size'], 'categories': len(catalog['categories']),
+            'age_seconds': time.time() - catalog['loaded_at']}